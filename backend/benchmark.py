@@ -0,0 +1,961 @@
+"""
+Benchmarks for the ride animation pipeline. Correctness is checked by the tests/ suite.
+Run with: python -m backend.benchmark <command>
+"""
+
+import argparse
+import http.server
+import io
+import multiprocessing
+import os
+import re
+import resource
+import select
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import ffmpeg
+import numpy as np
+import requests
+from PIL import Image
+
+from backend.geometry import segment_distances, to_web_mercator, DISTANCE_MODES
+from backend.fit_decoder import decode_fit_records, RECORD_FIELDS, RECORD_MESG_NUM
+from backend.track import SEMICIRCLES_TO_DEGREES
+from backend.util import fit_crc
+from backend.storage import receive_fit_upload, UPLOAD_CHUNK_SIZE
+from backend.tile_cache import TileCache, basemap_image, resolve_tile_provider, parse_zoom
+from backend.video_writer import FFmpegFrameWriter, ENCODING_PROFILES
+
+FIELD_NUMS = {name: num for num, (name, _, _, _) in RECORD_FIELDS.items()}
+DEFAULT_FIELDS = ("timestamp", "position_lat", "position_long", "altitude",
+                  "speed", "heart_rate", "cadence")
+
+def stop_mask(n_points: int, stops: int = 0, stop_seconds: int = 120):
+    """
+    Returns a boolean mask of the records spent standing still: `stops` stops of
+    stop_seconds records each, spread evenly over the ride.
+    """
+    stopped = np.zeros(n_points, dtype=bool)
+    for start in np.linspace(0, n_points, stops + 2)[1:-1].astype(int):
+        stopped[start:start + stop_seconds] = True
+    return stopped
+
+def synthetic_track(n_points: int, seed: int = 0, stopped=None):
+    """
+    Returns (lat, lon) arrays for a synthetic 1 Hz ride of n_points records.
+    The route is a random walk at road-bike speeds starting in Kanagawa.
+    The rider stands still on records where the `stopped` mask is set.
+    """
+    rng = np.random.default_rng(seed)
+    speed = np.clip(rng.normal(8.0, 2.0, n_points), 0.0, 20.0)  # m/s
+    if stopped is not None:
+        speed[stopped] = 0.0
+    heading = np.cumsum(rng.normal(0.0, 0.05, n_points))
+    north = np.cumsum(speed * np.cos(heading))
+    east = np.cumsum(speed * np.sin(heading))
+    lat = 35.3 + north / 111_320.0
+    lon = 139.5 + east / (111_320.0 * np.cos(np.radians(lat)))
+    return lat, lon
+
+def write_fit(path: Path, n_points: int, *, layouts=(DEFAULT_FIELDS,), block: int = 50,
+              big_endian: bool = False, missing_rate: float = 0.0, events: bool = False, seed: int = 0,
+              stops: int = 0, stop_seconds: int = 120):
+    """
+    Writes a synthetic FIT activity with n_points record messages.
+    - layouts: record field sets; consecutive blocks of records cycle through them
+    - big_endian: write record definitions with big-endian architecture
+    - missing_rate: fraction of values replaced by the FIT invalid sentinel
+    - events: interleave an event message after every block of records
+    - stops, stop_seconds: stand still that many times for that many records, as at
+      traffic lights; speed and cadence drop to zero and heart rate settles
+    """
+    rng = np.random.default_rng(seed)
+    stopped = stop_mask(n_points, stops, stop_seconds)
+    lat, lon = synthetic_track(n_points, seed, stopped)
+    alt = 100 + np.cumsum(np.where(stopped, 0.0, rng.normal(0.0, 0.3, n_points)))
+    values = {
+        "timestamp": 1_000_000_000 + np.arange(n_points),
+        "position_lat": np.round(lat / SEMICIRCLES_TO_DEGREES),
+        "position_long": np.round(lon / SEMICIRCLES_TO_DEGREES),
+        "altitude": np.round((alt + 500) * 5),
+        "enhanced_altitude": np.round((alt + 500) * 5),
+        "speed": rng.integers(0, 15000, n_points),
+        "heart_rate": rng.integers(90, 180, n_points),
+        "cadence": rng.integers(0, 110, n_points),
+    }
+    if stops:
+        # Heart rate decays towards 90 bpm over each stop, changing every few seconds
+        last_moving = np.maximum.accumulate(np.where(~stopped, np.arange(n_points), 0))
+        run = np.arange(n_points) - last_moving
+        settled = 90 + (values["heart_rate"][last_moving] - 90) * np.exp(-run / 60)
+        values["heart_rate"] = np.where(stopped, np.round(settled), values["heart_rate"])
+        values["speed"] = np.where(stopped, 0, values["speed"])
+        values["cadence"] = np.where(stopped, 0, values["cadence"])
+    if missing_rate:
+        for name, _, _, invalid in RECORD_FIELDS.values():
+            values[name] = np.where(rng.random(n_points) < missing_rate, invalid, values[name])
+
+    endian = ">" if big_endian else "<"
+    arch = 1 if big_endian else 0
+    body = bytearray()
+    # file_id (activity) on local type 15, event on local type 14
+    body += struct.pack("<BBBHB", 0x4F, 0, 0, 0, 1) + struct.pack("<BBB", 0, 1, 0x00)
+    body += struct.pack("<BB", 0x0F, 4)
+    body += struct.pack("<BBBHB", 0x4E, 0, 0, 21, 3) + struct.pack("<9B", 253, 4, 0x86, 0, 1, 0x00, 1, 1, 0x00)
+
+    dtypes = []
+    for local, fields in enumerate(layouts):
+        body += struct.pack("<BBB", 0x40 | local, 0, arch) + struct.pack(endian + "HB", RECORD_MESG_NUM, len(fields))
+        for name in fields:
+            num = FIELD_NUMS[name]
+            _, base_type, np_type, _ = RECORD_FIELDS[num]
+            body += struct.pack("<BBB", num, np.dtype(np_type).itemsize, base_type)
+        dtypes.append(np.dtype([("header", "u1")] + [(name, endian + RECORD_FIELDS[FIELD_NUMS[name]][2])
+                                                     for name in fields]))
+
+    for i, start in enumerate(range(0, n_points, block)):
+        local = i % len(layouts)
+        rows = np.zeros(min(block, n_points - start), dtype=dtypes[local])
+        rows["header"] = local
+        for name in layouts[local]:
+            rows[name] = values[name][start:start + len(rows)]
+        body += rows.tobytes()
+        if events:
+            body += struct.pack("<BIBB", 0x0E, int(values["timestamp"][start]), 0, 3)
+
+    header = struct.pack("<BBHI4s", 14, 0x20, 2132, len(body), b".FIT")
+    content = header + struct.pack("<H", fit_crc(header)) + bytes(body)
+    Path(path).write_bytes(content + struct.pack("<H", fit_crc(content)))
+
+def fit_corpus(directory: Path, n_points: int):
+    """
+    Writes FIT files covering the layouts the fast decoder handles.
+    Returns a list of (name, path).
+    """
+    variants = {
+        "basic": {},
+        "enhanced_altitude": {"layouts": [("timestamp", "position_lat", "position_long",
+                                            "enhanced_altitude", "speed")]},
+        "both_altitudes": {"layouts": [("enhanced_altitude", "timestamp", "position_lat",
+                                         "position_long", "altitude", "heart_rate")]},
+        "big_endian": {"big_endian": True},
+        "missing_values": {"missing_rate": 0.05},
+        "mixed_layouts_events": {"layouts": [DEFAULT_FIELDS, DEFAULT_FIELDS[:5]], "events": True},
+    }
+    corpus = []
+    for i, (name, options) in enumerate(variants.items()):
+        path = directory / f"{name}.fit"
+        write_fit(path, n_points, seed=i, **options)
+        corpus.append((name, path))
+    return corpus
+
+class Checks:
+    """
+    Collects named pass/fail checks, printing each as it is recorded.
+    Call with (name, passed, detail); exit_code() is 0 only if every check passed.
+    """
+
+    def __init__(self, width: int = 28):
+        self.width = width
+        self.passed = []
+
+    def __call__(self, name: str, passed: bool, detail: str = "") -> bool:
+        self.passed.append(bool(passed))
+        print(f"{name:<{self.width}} {'OK' if passed else 'FAIL'}  {detail}")
+        return passed
+
+    def exit_code(self) -> int:
+        return 0 if all(self.passed) else 1
+
+def bench_fit_decoder(args):
+    """
+    Times the fast FIT decoder against fitparse on a generated corpus.
+    Field equality is checked in tests/test_fit_decoder.py.
+    """
+    from backend.ride_route_animator import RideRouteAnimator
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, path in fit_corpus(Path(tmp), args.points):
+            start = time.perf_counter()
+            fast = decode_fit_records(path)
+            fast_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            RideRouteAnimator(path, None)._load_fit_fitparse()
+            ref_time = time.perf_counter() - start
+
+            print(f"{name:<22} records={len(fast):7d}  fitparse={ref_time:7.3f}s  fast={fast_time:7.3f}s  "
+                  f"speedup={ref_time/fast_time:6.1f}x")
+    return 0
+
+def bench_render(args):
+    """
+    Renders a long synthetic ride with each worker count and reports the speedup.
+    """
+    from backend.ride_route_animator import RideRouteAnimator
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fit_path = Path(tmp) / "ride.fit"
+        write_fit(fit_path, args.points)
+        baseline = None
+        for workers in args.workers:
+            animator = RideRouteAnimator(fit_path, Path(tmp) / f"ride_{workers}.mp4", tile=args.tile,
+                                         zoom=args.zoom, step_frame=args.step_frame, workers=workers)
+            animator.load_fit()
+            animator.compute_geometry()
+            n_frames = len(animator.schedule_frames())
+
+            start = time.perf_counter()
+            animator.render_animation()
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"workers={workers:<3} frames={n_frames:6d}  time={elapsed:8.2f}s  "
+                  f"fps={n_frames/elapsed:7.1f}  speedup={baseline/elapsed:5.2f}x")
+    return 0
+
+class ChildMemorySampler:
+    """
+    Polls the peak RSS (VmHWM) of this process's child processes, such as ffmpeg,
+    from a background thread; use as a context manager. ru_maxrss cannot be used
+    for children, since it counts the parent's memory a child inherits before exec.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak_kb = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._poll, daemon=True)
+
+    def _poll(self):
+        pid = os.getpid()
+        while not self.stop.wait(self.interval):
+            children = Path(f"/proc/{pid}/task/{pid}/children")
+            for child in (children.read_text().split() if children.exists() else []):
+                try:
+                    status = Path(f"/proc/{child}/status").read_text()
+                except OSError:
+                    continue    # Exited meanwhile
+                for line in status.splitlines():
+                    if line.startswith("VmHWM:"):
+                        self.peak_kb = max(self.peak_kb, int(line.split()[1]))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+def _large_ride_run(fit_path, output_path, tile_url, target_duration, fps):
+    """
+    Runs the render pipeline on one file in a fresh process.
+    Returns per-stage wall times, the frame count and the peak RSS in MiB of the
+    process and of its largest child (ffmpeg).
+    """
+    from backend.ride_route_animator import RideRouteAnimator
+
+    animator = RideRouteAnimator(fit_path, output_path, tile=tile_url, zoom="auto",
+                                 target_duration=target_duration, fps=fps)
+    times = {}
+    with ChildMemorySampler() as children:
+        for stage, run in (("decode", animator.load_fit), ("geometry", animator.compute_geometry),
+                           ("render", animator.render_animation)):
+            start = time.perf_counter()
+            run()
+            times[stage] = time.perf_counter() - start
+    return {"records": len(animator.track), "frames": len(animator.frames), "times": times,
+            "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "ffmpeg_rss_mb": children.peak_kb / 1024}
+
+def bench_large_ride(args):
+    """
+    Renders generated rides of increasing size to a fixed video length, each in a fresh
+    process, and reports stage wall times and peak RSS. Exits non-zero if a video does
+    not have the frame count implied by --target-duration.
+    """
+    ok = True
+    ctx = multiprocessing.get_context("spawn")  # A forked child would inherit this process's RSS
+    expected = round(args.target_duration * args.fps)
+    with tempfile.TemporaryDirectory() as tmp, LocalTileServer() as server:
+        for points in args.points:
+            fit_path = Path(tmp) / f"ride_{points}.fit"
+            write_fit(fit_path, points)
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                result = pool.submit(_large_ride_run, fit_path, Path(tmp) / f"ride_{points}.mp4", server.url,
+                                     args.target_duration, args.fps).result()
+            size_mb = fit_path.stat().st_size / 2**20
+            fit_path.unlink()
+            times = result["times"]
+            passed = expected - 1 <= result["frames"] <= expected
+            ok &= passed
+            print(f"records={result['records']:8d}  file={size_mb:5.1f} MiB  frames={result['frames']:5d}  "
+                  f"decode={times['decode']:6.2f}s  geometry={times['geometry']:6.2f}s  "
+                  f"render={times['render']:6.2f}s  peak_rss={result['rss_mb']:7.1f} MiB  {'OK' if passed else 'FAIL'}")
+    return 0 if ok else 1
+
+def decoded_frames(path: Path, fps: int, size=(160, 120)) -> np.ndarray:
+    """
+    Decodes a video at a constant frame rate into downscaled grayscale frames.
+    """
+    out, _ = (
+        ffmpeg
+        .input(str(path))
+        .filter("fps", fps)
+        .filter("scale", *size)
+        .output("pipe:", format="rawvideo", pix_fmt="gray", loglevel="error")
+        .run(capture_stdout=True)
+    )
+    return np.frombuffer(out, np.uint8).reshape(-1, size[1], size[0])
+
+def bench_stops(args):
+    """
+    Renders a generated commute with long stops with and without holding unchanged
+    frames, then with stops collapsed. Exits non-zero if holding frames changes what
+    the video shows or collapsing does not shorten each stop to the requested length.
+    """
+    from backend.ride_route_animator import RideRouteAnimator
+
+    check = Checks(width=34)
+
+    configs = {
+        "every frame": {"reuse_frames": False},
+        "hold unchanged": {},
+        "collapse stops": {"collapse_stops": args.collapse},
+    }
+    with tempfile.TemporaryDirectory() as tmp, LocalTileServer() as server:
+        fit_path = Path(tmp) / "commute.fit"
+        write_fit(fit_path, args.points, stops=args.stops, stop_seconds=args.stop_seconds)
+        results = {}
+        for name, options in configs.items():
+            output_path = Path(tmp) / f"{name.replace(' ', '_')}.mp4"
+            animator = RideRouteAnimator(fit_path, output_path, tile=server.url, zoom=13,
+                                         fps=args.fps, step_frame=1, **options)
+            animator.prepare()
+            start = time.perf_counter()
+            animator.render_animation()
+            elapsed = time.perf_counter() - start
+            results[name] = (animator.frames, output_path, elapsed)
+            print(f"{name:<16} frames={len(animator.frames):6d}  time={elapsed:7.2f}s  "
+                  f"speedup={results['every frame'][2]/elapsed:5.2f}x")
+
+        frames, output_path, _ = results["hold unchanged"]
+        held, reference = decoded_frames(output_path, args.fps), decoded_frames(results["every frame"][1], args.fps)
+        same_length = len(held) == len(reference)
+        diff = np.abs(held.astype(np.int16) - reference.astype(np.int16)).mean() if same_length else float("nan")
+        check("held frames leave video unchanged", same_length and diff < 1.0,
+              f"frames={len(held)}/{len(reference)} mean_abs_diff={diff:.3f}")
+        keep = round(args.collapse * args.fps)
+        collapsed = results["collapse stops"][0]
+        dropped = len(frames) - len(collapsed)
+        check("each stop collapsed to --collapse", dropped == args.stops * (args.stop_seconds - keep),
+              f"dropped={dropped}")
+        paused = collapsed.paused[collapsed.paused > 0]
+        check("collapsed stops labelled with length",
+              len(paused) == args.stops * keep and np.allclose(paused, args.stop_seconds),
+              f"labelled={len(paused)}")
+    return check.exit_code()
+
+def webp_durations(path: Path):
+    """
+    Returns the frame durations in milliseconds of an animated WebP file.
+    """
+    data = Path(path).read_bytes()
+    durations = []
+    pos = 12    # RIFF header
+    while pos + 8 <= len(data):
+        tag, size = data[pos:pos + 4], struct.unpack("<I", data[pos + 4:pos + 8])[0]
+        if tag == b"ANMF":
+            durations.append(int.from_bytes(data[pos + 20:pos + 23], "little"))
+        pos += 8 + size + (size & 1)
+    return durations
+
+def played_frames(path: Path, fps: int) -> int:
+    """
+    Returns the number of frame periods a video, GIF or animated WebP plays for.
+    """
+    if Path(path).suffix == ".webp":
+        return round(sum(webp_durations(path)) * fps / 1000)
+    return len(decoded_frames(path, fps))
+
+def output_size(path: Path):
+    """
+    Returns the (width, height) of a video, GIF or animated WebP file.
+    """
+    if Path(path).suffix in (".gif", ".webp"):
+        with Image.open(path) as image:
+            return image.size
+    out, _ = (
+        ffmpeg
+        .input(str(path))
+        .output("pipe:", vframes=1, format="image2", vcodec="png", loglevel="error")
+        .run(capture_stdout=True)
+    )
+    return Image.open(io.BytesIO(out)).size
+
+def bench_image_output(args):
+    """
+    Renders the same ride to animated GIF and WebP at increasing frame counts, each in a
+    fresh process, and reports render time, file size and peak RSS of the renderer and
+    ffmpeg. Exits non-zero if an output has the wrong length or peak memory grows with
+    the frame count by more than --max-growth-mb.
+    """
+    ok = True
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp, LocalTileServer() as server:
+        fit_path = Path(tmp) / "ride.fit"
+        write_fit(fit_path, args.points)
+        for suffix in (".gif", ".webp"):
+            peaks = []
+            for frames in args.frames:
+                output_path = Path(tmp) / f"ride_{frames}{suffix}"
+                with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                    result = pool.submit(_large_ride_run, fit_path, output_path, server.url,
+                                         frames / args.fps, args.fps).result()
+                played = played_frames(output_path, args.fps)
+                passed = played == result["frames"]
+                ok &= passed
+                peaks.append(result["rss_mb"] + result["ffmpeg_rss_mb"])
+                print(f"{suffix:<6} frames={result['frames']:5d}  played={played:5d}  "
+                      f"render={result['times']['render']:7.2f}s  size={output_path.stat().st_size / 2**20:6.1f} MiB  "
+                      f"peak_rss={result['rss_mb']:7.1f} MiB  ffmpeg_rss={result['ffmpeg_rss_mb']:7.1f} MiB  "
+                      f"{'OK' if passed else 'FAIL'}")
+                output_path.unlink()
+            growth = peaks[-1] - peaks[0]
+            passed = growth <= args.max_growth_mb
+            ok &= passed
+            print(f"{suffix:<6} peak memory growth {args.frames[0]} -> {args.frames[-1]} frames: "
+                  f"{growth:+.1f} MiB  {'OK' if passed else 'FAIL'}")
+    return 0 if ok else 1
+
+def bench_renditions(args):
+    """
+    Renders a ride with every rendition fanned out from one pass, then as separate renders
+    (one per output, at the DPI giving its height), and reports the wall times.
+    Exits non-zero if a rendition has the wrong height or length.
+    """
+    from backend.ride_route_animator import RideRouteAnimator
+
+    ok = True
+    specs = [(int(height), output_format) for height, _, output_format in
+             (spec.partition(":") for spec in args.renditions)]
+    with tempfile.TemporaryDirectory() as tmp, LocalTileServer() as server:
+        fit_path = Path(tmp) / "ride.fit"
+        write_fit(fit_path, args.points)
+        options = {"tile": server.url, "zoom": 13, "fps": args.fps, "target_duration": args.frames / args.fps}
+
+        def render(output_path, **kwargs):
+            animator = RideRouteAnimator(fit_path, output_path, **options, **kwargs)
+            animator.prepare()
+            start = time.perf_counter()
+            animator.render_animation()
+            return animator, time.perf_counter() - start
+
+        renditions = [(Path(tmp) / f"{height}p.{output_format}", height) for height, output_format in specs]
+        animator, single = render(Path(tmp) / "main.mp4", dpi=args.dpi, renditions=renditions)
+        frames = len(animator.frames)
+        print(f"single pass      outputs={len(renditions) + 1}  frames={frames}  time={single:7.2f}s")
+        for path, height in renditions:
+            size, played = output_size(path), played_frames(path, args.fps)
+            passed = size[1] == height and played == frames
+            ok &= passed
+            print(f"  {path.name:<12} {size[0]:5d}x{size[1]:<5d} played={played:5d}  "
+                  f"size={path.stat().st_size / 2**20:6.2f} MiB  {'OK' if passed else 'FAIL'}")
+
+        _, separate = render(Path(tmp) / "separate_main.mp4", dpi=args.dpi)
+        main_height = output_size(Path(tmp) / "main.mp4")[1]
+        for path, height in renditions:
+            # A separate job renders at the DPI that gives the rendition's height directly,
+            # rounded to an even DPI so the frame size suits yuv420p
+            dpi = 2 * max(1, round(args.dpi * height / main_height / 2))
+            separate += render(path.with_name(f"separate_{path.name}"), dpi=dpi)[1]
+        print(f"separate renders outputs={len(renditions) + 1}  time={separate:7.2f}s  "
+              f"speedup={separate / single:5.2f}x")
+    return 0 if ok else 1
+
+def render_raw_frames(fit_path: Path, raw_path: Path, tile_url: str, frames: int, fps: int, dpi: int):
+    """
+    Renders a ride's frames once into a raw RGB file, so encoders can be timed on their own.
+    Returns the frame shape (height, width, 3) and the frame count.
+    """
+    from backend.ride_route_animator import RideRouteAnimator
+
+    animator = RideRouteAnimator(fit_path, None, tile=tile_url, zoom=13, fps=fps, dpi=dpi,
+                                 target_duration=frames / fps)
+    animator.prepare()
+    animator.schedule_frames()
+    compositor = animator.build_compositor()
+    with open(raw_path, "wb") as f:
+        for frame in range(len(animator.frames)):
+            f.write(compositor.render(frame, animator.frame_text(frame)).tobytes())
+    return (compositor.height, compositor.width, 3), len(animator.frames)
+
+def psnr(path: Path, raw_path: Path, shape, fps: int) -> float:
+    """
+    Returns the average PSNR in dB of an encoded video against the raw frames it was encoded from.
+    """
+    reference = ffmpeg.input(str(raw_path), format="rawvideo", pix_fmt="rgb24",
+                             s=f"{shape[1]}x{shape[0]}", framerate=fps)
+    _, err = (
+        ffmpeg
+        .filter([ffmpeg.input(str(path)), reference], "psnr")
+        .output("-", format="null")
+        .run(capture_stderr=True)
+    )
+    match = re.search(rb"average:(\S+)", err)
+    return float(match.group(1)) if match else float("nan")
+
+def bench_encoding(args):
+    """
+    Encodes the same rendered frames with each encoding profile and reports encode speed,
+    file size and PSNR against the raw frames, so profile defaults are chosen from data.
+    Exits non-zero if an output does not play every frame.
+    """
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp, LocalTileServer() as server:
+        fit_path, raw_path = Path(tmp) / "ride.fit", Path(tmp) / "frames.rgb"
+        write_fit(fit_path, args.points)
+        shape, count = render_raw_frames(fit_path, raw_path, server.url, args.frames, args.fps, args.dpi)
+        frames = np.memmap(raw_path, dtype=np.uint8, mode="r", shape=(count, *shape))
+        print(f"{count} frames {shape[1]}x{shape[0]} at {args.fps} fps, encoder threads={args.threads or 'auto'}")
+        for profile in args.profiles:
+            output_path = Path(tmp) / f"{profile}.mp4"
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.perf_counter()
+            writer = FFmpegFrameWriter(output_path, shape[1], shape[0], args.fps, profile=profile,
+                                       threads=args.threads)
+            for frame in frames:
+                writer.write(frame)
+            writer.close()
+            elapsed = time.perf_counter() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+            played = played_frames(output_path, args.fps)
+            passed = played == count
+            ok &= passed
+            settings = ENCODING_PROFILES[profile]
+            print(f"{profile:<9} preset={settings['preset']:<9} crf={settings['crf']:<3} "
+                  f"encode_fps={count / elapsed:7.1f}  cpu={cpu:6.2f}s  "
+                  f"size={output_path.stat().st_size / 2**20:6.2f} MiB  "
+                  f"psnr={psnr(output_path, raw_path, shape, args.fps):5.2f} dB  {'OK' if passed else 'FAIL'}")
+        del frames
+    return 0 if ok else 1
+
+def process_memory_kb(pid: int, field: str = "VmHWM") -> int:
+    """
+    Returns a memory figure in KiB (VmHWM: peak RSS, VmRSS: current RSS) of a process from /proc.
+    """
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith(f"{field}:"):
+            return int(line.split()[1])
+    return 0
+
+def storage_dirs(tmp) -> dict:
+    """
+    Creates the API's storage directories under tmp and returns them by environment variable.
+    """
+    dirs = {name: Path(tmp) / name.lower() for name in ("VIDEO_FILES_DIR", "THUMBNAIL_FILES_DIR", "FIT_FILES_DIR")}
+    for path in dirs.values():
+        path.mkdir(exist_ok=True)
+    return dirs
+
+@contextmanager
+def api_server(tmp, **env):
+    """
+    Runs the API with uvicorn on a free port, storing files under tmp, and yields (process, port).
+    Extra keyword arguments are set in its environment. Needs Redis, like the API.
+    """
+    env = {**os.environ, **{name: str(path) for name, path in storage_dirs(tmp).items()}, **env}
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(port),
+                            "--log-level", "warning"], env=env)
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"http://127.0.0.1:{port}/openapi.json", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        yield api, port
+    finally:
+        api.terminate()
+        api.wait()
+
+def chunked_upload(port, content: bytes, chunk_size: int = 64 * 1024, pause: float = 0.02):
+    """
+    Posts content to /upload as the "file" part of a multipart body with chunked transfer
+    encoding (no Content-Length), pausing between chunks, and stops sending once the API answers.
+    Returns (status code, bytes of the file sent before the answer).
+    """
+    boundary = "benchmark-boundary"
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="ride.fit"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n").encode()
+    body = head + content + f"\r\n--{boundary}--\r\n".encode()
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(f"POST /upload HTTP/1.1\r\nHost: 127.0.0.1\r\nTransfer-Encoding: chunked\r\n"
+                     f"Content-Type: multipart/form-data; boundary={boundary}\r\n\r\n".encode())
+        sent = 0
+        while sent < len(body) and not select.select([sock], [], [], pause)[0]:
+            chunk = body[sent:sent + chunk_size]
+            sock.sendall(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            sent += len(chunk)
+        if sent == len(body):
+            sock.sendall(b"0\r\n\r\n")
+        response = sock.recv(65536)
+    return int(response.split(b" ", 2)[1]), max(0, min(sent - len(head), len(content)))
+
+def bench_upload_endpoint(args):
+    """
+    Uploads generated FIT files to a running API with chunked transfer encoding, so no
+    Content-Length lets the API reject them up front. Reports how much of a valid, an
+    oversized and an invalid file the client sent before the API answered.
+    Status codes are checked in tests/test_upload.py. Needs Redis, like the API.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        small, large = Path(tmp) / "small.fit", Path(tmp) / "large.fit"
+        write_fit(small, 20_000)
+        write_fit(large, args.points)
+        uploads = {
+            "valid": small.read_bytes(),
+            "oversized": large.read_bytes(),
+            "invalid": np.random.default_rng(0).bytes(large.stat().st_size),
+        }
+
+        with api_server(tmp, MAX_UPLOAD_MB=str(args.limit_mb)) as (api, port):
+            for name, content in uploads.items():
+                start = time.perf_counter()
+                status, sent = chunked_upload(port, content)
+                elapsed = time.perf_counter() - start
+                print(f"{name:<10} status={status}  sent {sent / 2**20:6.1f} of {len(content) / 2**20:6.1f} MiB "
+                      f"(limit {args.limit_mb} MiB)  time={elapsed:.2f}s")
+    return 0
+
+def bench_video_serving(args):
+    """
+    Starts the API on a generated video of --size-mb and serves it to --clients concurrent
+    clients issuing random Range requests, each also downloading the whole file once.
+    Reports throughput and the API's peak RSS before and under load. ETag, 304, Range
+    and If-Range handling are checked in tests/test_downloads.py. Needs Redis, like the API.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        ticket_id = "benchmark-video-serving"
+        video_path = storage_dirs(tmp)["VIDEO_FILES_DIR"] / f"{ticket_id}.mp4"
+        rng = np.random.default_rng(0)
+        with open(video_path, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(rng.bytes(2**20))
+        size = video_path.stat().st_size
+
+        with api_server(tmp) as (api, port):
+            url, headers = f"http://127.0.0.1:{port}/video", {"ticket-id": ticket_id}
+
+            def download(session):
+                with session.get(url, headers=headers, stream=True) as response:
+                    for _ in response.iter_content(256 * 1024):
+                        pass
+
+            def client(seed):
+                rng = np.random.default_rng(seed)
+                transferred = 0
+                with requests.Session() as session:
+                    for _ in range(args.requests):
+                        start = int(rng.integers(size))
+                        end = min(size, start + int(rng.integers(1, args.range_kb * 1024))) - 1
+                        response = session.get(url, headers={**headers, "Range": f"bytes={start}-{end}"})
+                        transferred += len(response.content)
+                    download(session)
+                return transferred + size
+
+            # Warm up: the first download hashes the file for its ETag
+            start = time.perf_counter()
+            with requests.Session() as session:
+                download(session)
+            print(f"{'first download':<16} {size / 2**20:.0f} MiB  time={time.perf_counter() - start:.2f}s "
+                  f"(includes hashing for the ETag)")
+            baseline = process_memory_kb(api.pid)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                transferred = sum(pool.map(client, range(args.clients)))
+            elapsed = time.perf_counter() - start
+            peak = process_memory_kb(api.pid)
+            print(f"{'under load':<16} {args.clients * (args.requests + 1)} requests  "
+                  f"{transferred / 2**20 / elapsed:.0f} MiB/s  time={elapsed:.2f}s")
+            print(f"{'API peak RSS':<16} {baseline / 1024:.1f} -> {peak / 1024:.1f} MiB "
+                  f"({(peak - baseline) / 1024:+.1f} MiB)")
+    return 0
+
+class LocalTileServer:
+    """
+    Stand-in HTTP tile server on localhost serving generated PNG tiles at /{z}/{x}/{y}.png.
+    Counts the requests it serves; use as a context manager.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    z, x, y = (int(part) for part in self.path.strip("/").removesuffix(".png").split("/"))
+                except ValueError:
+                    self.send_error(404)
+                    return
+                time.sleep(delay)
+                with server.lock:
+                    server.requests += 1
+                buf = io.BytesIO()
+                Image.new("RGB", (256, 256), (x * 37 % 256, y * 59 % 256, z * 20 % 256)).save(buf, "PNG")
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(buf.tell()))
+                self.end_headers()
+                self.wfile.write(buf.getvalue())
+
+            def log_message(self, *args):
+                pass
+
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/{{z}}/{{x}}/{{y}}.png"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def _cached_mosaic(cache_path, max_bytes, bounds, zoom, url):
+    """Process pool entry point: builds one mosaic through the shared cache"""
+    _, _, counts = basemap_image(bounds, zoom, resolve_tile_provider(url), TileCache(cache_path, max_bytes))
+    return counts
+
+def bench_tile_cache(args):
+    """
+    Times the tile cache offline against a local tile server: cold and warm fetches, and
+    concurrent processes sharing one cache. Cache behaviour is checked in tests/test_tile_cache.py.
+    """
+    lat, lon = synthetic_track(args.points)
+    merc_x, merc_y = to_web_mercator(lat, lon)
+    bounds = (merc_x.min(), merc_y.min(), merc_x.max(), merc_y.max())
+    max_bytes = args.max_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp, LocalTileServer(delay=args.latency) as server:
+        cache_path = Path(tmp) / "tiles.sqlite3"
+        cache = TileCache(cache_path, max_bytes)
+        provider = resolve_tile_provider(server.url)
+
+        start = time.perf_counter()
+        _, _, cold = basemap_image(bounds, args.zoom, provider, cache)
+        cold_time = time.perf_counter() - start
+        start = time.perf_counter()
+        basemap_image(bounds, args.zoom, provider, cache)
+        warm_time = time.perf_counter() - start
+        print(f"{'cold fetch':<22} tiles={cold['tiles']:5d}  time={cold_time:7.3f}s")
+        print(f"{'warm fetch':<22} tiles={cold['tiles']:5d}  time={warm_time:7.3f}s  "
+              f"speedup={cold_time/warm_time:6.1f}x")
+
+        # Several processes fetch overlapping views of one zoom level at once
+        before = cache.stats()
+        zoom = args.zoom + 1
+        views = [(bounds[0] + i * (bounds[2] - bounds[0]) / 8, bounds[1], bounds[2], bounds[3])
+                 for i in range(args.processes)]
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            results = list(pool.map(_cached_mosaic, [cache_path] * len(views), [max_bytes] * len(views),
+                                    views, [zoom] * len(views), [server.url] * len(views)))
+        elapsed = time.perf_counter() - start
+        after = cache.stats()
+        print(f"{'concurrent processes':<22} lookups={sum(r['tiles'] for r in results):5d}  time={elapsed:7.3f}s  "
+              f"hits={after['hits'] - before['hits']} downloads={after['misses'] - before['misses']}")
+    return 0
+
+class ChainedFitStream:
+    """
+    Binary stream of one FIT file chained back to back `copies` times, produced as it is
+    read, so arbitrarily large valid uploads take no memory on the sending side.
+    """
+
+    def __init__(self, content: bytes, copies: int):
+        self.content = content
+        self.size = len(content) * copies
+        self.pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.size - self.pos if size < 0 else min(size, self.size - self.pos)
+        parts = []
+        while size > 0:
+            offset = self.pos % len(self.content)
+            part = self.content[offset:offset + size]
+            parts.append(part)
+            self.pos += len(part)
+            size -= len(part)
+        return b"".join(parts)
+
+def bench_upload(args):
+    """
+    Times generated FIT uploads through receive_fit_upload, then streams --concurrency
+    uploads of --upload-mb each at once and reports throughput and peak traced memory.
+    Validation and the memory bound are checked in tests/test_upload.py.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "ride.fit"
+        write_fit(source, args.points)
+        content = source.read_bytes()
+
+        start = time.perf_counter()
+        path, _ = receive_fit_upload(io.BytesIO(content), len(content), directory=tmp)
+        elapsed = time.perf_counter() - start
+        path.unlink()
+        print(f"{'single upload':<18} size={len(content) / 2**20:7.1f} MiB  time={elapsed:7.3f}s  "
+              f"({len(content) / elapsed / 2**20:.1f} MiB/s)")
+
+        # Uploads far larger than one chunk, streamed at once
+        copies = max(1, args.upload_mb * 2**20 // len(content))
+        streams = [ChainedFitStream(content, copies) for _ in range(args.concurrency)]
+        start = time.perf_counter()
+        tracemalloc.start()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda s: receive_fit_upload(s, s.size, directory=tmp), streams))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        elapsed = time.perf_counter() - start
+        for path, _ in results:
+            path.unlink()
+        total = sum(s.size for s in streams)
+        print(f"{'concurrent uploads':<18} uploads={args.concurrency}  streamed={total / 2**20:.0f} MiB  "
+              f"time={elapsed:.1f}s ({total / elapsed / 2**20:.1f} MiB/s)  peak={peak / 2**20:.1f} MiB "
+              f"({peak / args.concurrency / UPLOAD_CHUNK_SIZE:.1f} chunks per upload)")
+    return 0
+
+def bench_distance(args):
+    """
+    Times the vectorized distance modes against the per-pair geopy loop.
+    Accuracy is checked in tests/test_geometry.py.
+    """
+    from geopy.distance import geodesic
+
+    lat, lon = synthetic_track(args.points)
+
+    start = time.perf_counter()
+    reference = 0.0
+    for i in range(1, len(lat)):
+        reference += geodesic((lat[i-1], lon[i-1]), (lat[i], lon[i])).meters
+    baseline = time.perf_counter() - start
+    print(f"{'geopy loop':<12} total={reference/1000:10.3f} km  time={baseline:8.3f}s")
+
+    for mode in DISTANCE_MODES:
+        start = time.perf_counter()
+        total = segment_distances(lat, lon, mode).sum()
+        elapsed = time.perf_counter() - start
+        print(f"{mode:<12} total={total/1000:10.3f} km  time={elapsed:8.3f}s  speedup={baseline/elapsed:7.1f}x")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Ride animation pipeline benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("distance", help="Distance engine timing against geopy")
+    p.add_argument("--points", type=int, default=100_000, help="Number of synthetic track points")
+    p.set_defaults(func=bench_distance)
+
+    p = sub.add_parser("fit-decoder", help="Fast FIT decoder timing against fitparse")
+    p.add_argument("--points", type=int, default=20_000, help="Records per generated FIT file")
+    p.set_defaults(func=bench_fit_decoder)
+
+    p = sub.add_parser("render", help="Parallel segmented rendering speedup")
+    p.add_argument("--points", type=int, default=36_000, help="Records in the synthetic ride (1 Hz)")
+    p.add_argument("--step-frame", type=int, default=10, help="Frame step interval")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8], help="Worker counts to compare")
+    p.add_argument("--tile", default="OpenStreetMap.Mapnik", help="Tile provider")
+    p.add_argument("--zoom", type=parse_zoom, default=12, help="Tile zoom level or 'auto'")
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("tile-cache", help="Tile cache timing against a local tile server")
+    p.add_argument("--points", type=int, default=7_200, help="Records in the synthetic ride (1 Hz)")
+    p.add_argument("--zoom", type=int, default=13, help="Tile zoom level")
+    p.add_argument("--processes", type=int, default=4, help="Processes sharing the cache")
+    p.add_argument("--latency", type=float, default=0.02, help="Simulated tile server latency in seconds")
+    p.add_argument("--max-mb", type=int, default=64, help="Cache size cap in MiB")
+    p.set_defaults(func=bench_tile_cache)
+
+    p = sub.add_parser("large-ride", help="Peak RSS and wall time across ride sizes")
+    p.add_argument("--points", type=int, nargs="+", default=[50_000, 500_000, 3_000_000],
+                   help="Records per generated ride (3,000,000 is about 54 MB)")
+    p.add_argument("--target-duration", type=float, default=10, help="Video length in seconds")
+    p.add_argument("--fps", type=int, default=10, help="Frames per second")
+    p.set_defaults(func=bench_large_ride)
+
+    p = sub.add_parser("upload", help="Streaming FIT upload throughput and memory")
+    p.add_argument("--points", type=int, default=100_000, help="Records in the generated FIT file")
+    p.add_argument("--concurrency", type=int, default=8, help="Simultaneous uploads")
+    p.add_argument("--upload-mb", type=int, default=64,
+                   help="Size of each concurrent upload in MiB (chained copies of the generated file)")
+    p.set_defaults(func=bench_upload)
+
+    p = sub.add_parser("upload-endpoint", help="Chunked uploads against the running /upload endpoint")
+    p.add_argument("--points", type=int, default=300_000, help="Records in the oversized FIT file")
+    p.add_argument("--limit-mb", type=int, default=2, help="MAX_UPLOAD_MB of the API")
+    p.set_defaults(func=bench_upload_endpoint)
+
+    p = sub.add_parser("stops", help="Frame reuse and stop collapsing on a ride with long stops")
+    p.add_argument("--points", type=int, default=3_600, help="Records in the synthetic ride (1 Hz)")
+    p.add_argument("--stops", type=int, default=10, help="Stops spread over the ride")
+    p.add_argument("--stop-seconds", type=int, default=120, help="Length of each stop in seconds")
+    p.add_argument("--fps", type=int, default=10, help="Frames per second")
+    p.add_argument("--collapse", type=float, default=1.0, help="Video seconds each stop is collapsed to")
+    p.set_defaults(func=bench_stops)
+
+    p = sub.add_parser("image-output", help="Streaming animated GIF/WebP output memory")
+    p.add_argument("--points", type=int, default=7_200, help="Records in the synthetic ride (1 Hz)")
+    p.add_argument("--frames", type=int, nargs="+", default=[100, 800], help="Frame counts to compare")
+    p.add_argument("--fps", type=int, default=10, help="Frames per second")
+    p.add_argument("--max-growth-mb", type=float, default=64, help="Allowed peak RSS growth across frame counts")
+    p.set_defaults(func=bench_image_output)
+
+    p = sub.add_parser("renditions", help="Several renditions from one render against separate renders")
+    p.add_argument("--points", type=int, default=7_200, help="Records in the synthetic ride (1 Hz)")
+    p.add_argument("--frames", type=int, default=300, help="Frames per output")
+    p.add_argument("--fps", type=int, default=10, help="Frames per second")
+    p.add_argument("--dpi", type=int, default=120, help="Render DPI of the main output (120: 1440x1080)")
+    p.add_argument("--renditions", nargs="+", default=["480:mp4", "720:mp4", "240:gif"],
+                   help="Renditions as HEIGHT:FORMAT")
+    p.set_defaults(func=bench_renditions)
+
+    p = sub.add_parser("encoding", help="Encode speed, size and quality per encoding profile")
+    p.add_argument("--points", type=int, default=7_200, help="Records in the synthetic ride (1 Hz)")
+    p.add_argument("--frames", type=int, default=600, help="Frames to encode")
+    p.add_argument("--fps", type=int, default=10, help="Frames per second")
+    p.add_argument("--dpi", type=int, default=100, help="Render DPI (100: 1200x900)")
+    p.add_argument("--threads", type=int, default=0, help="Encoder threads (0: ffmpeg's default)")
+    p.add_argument("--profiles", nargs="+", choices=ENCODING_PROFILES, default=list(ENCODING_PROFILES),
+                   help="Profiles to compare")
+    p.set_defaults(func=bench_encoding)
+
+    p = sub.add_parser("video-serving", help="Range request throughput and API memory while serving a large video")
+    p.add_argument("--size-mb", type=int, default=256, help="Size of the generated video in MiB")
+    p.add_argument("--clients", type=int, default=16, help="Concurrent clients")
+    p.add_argument("--requests", type=int, default=50, help="Range requests per client")
+    p.add_argument("--range-kb", type=int, default=2048, help="Largest range requested in KiB")
+    p.set_defaults(func=bench_video_serving)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
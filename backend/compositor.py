@@ -0,0 +1,160 @@
+"""
+Static-background frame compositor for ride animations.
+
+The map, route line, elevation/speed profile and title are rasterized once.
+Each frame only composites the moving parts (route marker, elevation cursor
+and overlay text box) onto a copy of that buffer with NumPy and Pillow.
+"""
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from matplotlib import font_manager
+
+MARKER_COLOR = (255, 0, 0)          # Matches matplotlib 'ro'
+CURSOR_COLOR = (255, 0, 0)
+TEXT_COLOR = (255, 255, 255)
+TEXT_BOX_ALPHA = 0.5                # Black box behind the overlay text
+TEXT_BOX_PAD_PT = 4                 # matplotlib's default text bbox padding
+MARKER_SIZE_PT = 6 + 1              # markersize + markeredgewidth
+CURSOR_WIDTH_PT = 1.5
+SUPERSAMPLE = 4                     # Anti-aliasing factor for the marker sprite
+
+# Scratch canvas for text measurement; kept off the compositor so it stays picklable
+_MEASURE = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+class FrameCompositor:
+    """
+    Composites per-frame artists onto a pre-rendered RGB background.
+    Pixel positions for every track point are computed once up front.
+    Instances are picklable, so one rasterized background can be shared with worker processes.
+    """
+
+    def __init__(self, background, marker_px, cursor_px, cursor_rows, text_origin,
+                 *, dpi: int = 100, font_size: float = 10, line_spacing: float = 0):
+        """
+        - background: (H, W, 3) uint8 RGB buffer with the static layers
+        - marker_px: (N, 2) marker centers in image pixels (x right, y down)
+        - cursor_px: (N,) elevation cursor x positions in image pixels
+        - cursor_rows: (top, bottom) rows spanned by the elevation cursor
+        - text_origin: (x, y) top-left corner of the overlay text in image pixels
+        - line_spacing: extra pixels between overlay text lines
+        """
+        self.background = np.ascontiguousarray(background)
+        self.height, self.width = self.background.shape[:2]
+        self.marker_px = np.asarray(marker_px, dtype=np.float64)
+        self.cursor_px = np.asarray(cursor_px, dtype=np.float64)
+        self.cursor_rows = (max(0, int(cursor_rows[0])), min(self.height, int(cursor_rows[1])))
+        self.text_origin = text_origin
+        self.line_spacing = line_spacing
+
+        px_per_pt = dpi / 72
+        self.cursor_width = max(1, int(round(CURSOR_WIDTH_PT * px_per_pt)))
+        self.text_pad = TEXT_BOX_PAD_PT * px_per_pt
+        font_path = str(font_manager.findfont(font_manager.FontProperties()))
+        self.font = ImageFont.truetype(font_path, size=max(1, int(round(font_size * px_per_pt))))
+        self.marker_alpha = _disc_alpha(MARKER_SIZE_PT * px_per_pt)
+
+    @classmethod
+    def from_figure(cls, fig, ax_map, ax_elev, info_text, merc_x, merc_y, distances_km, dpi: int):
+        """
+        Rasterizes a figure holding only the static layers and maps the track to pixels.
+        info_text must hold a representative overlay string; it is measured and hidden.
+        """
+        renderer = fig.canvas.get_renderer()
+        height = int(round(fig.bbox.height))
+
+        # Measure the overlay text block so Pillow can reproduce its placement and line height
+        extent = info_text.get_window_extent(renderer)
+        text_origin = (extent.x0, height - extent.y1)
+        n_lines = info_text.get_text().count("\n") + 1
+        info_text.set_visible(False)
+
+        fig.canvas.draw()
+        background = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+
+        xy = ax_map.transData.transform(np.column_stack([merc_x, merc_y]))
+        marker_px = np.column_stack([xy[:, 0], height - xy[:, 1]])
+        cursor_px = ax_elev.transData.transform(
+            np.column_stack([distances_km, np.zeros(len(distances_km))]))[:, 0]
+        elev_box = ax_elev.get_window_extent(renderer)
+        cursor_rows = (height - elev_box.y1, height - elev_box.y0)
+
+        compositor = cls(background, marker_px, cursor_px, cursor_rows, text_origin,
+                         dpi=dpi, font_size=info_text.get_fontsize())
+        compositor.line_spacing = compositor._calibrate_spacing(info_text.get_text(), extent.height, n_lines)
+        return compositor
+
+    def render(self, index: int, text: str) -> np.ndarray:
+        """
+        Returns the RGB frame for track point `index` with the given overlay text.
+        """
+        frame = self.background.copy()
+        self._draw_cursor(frame, self.cursor_px[index])
+        self._draw_marker(frame, *self.marker_px[index])
+        return self._draw_text(frame, text)
+
+    def placement(self, index: int) -> tuple:
+        """
+        Returns the pixel placement of the moving artists for track point `index`:
+        (marker left, marker top, cursor left). Frames with equal placements differ only in their overlay text.
+        """
+        size = self.marker_alpha.shape[0]
+        x, y = self.marker_px[index]
+        return (int(round(x - size / 2)), int(round(y - size / 2)),
+                int(round(self.cursor_px[index] - self.cursor_width / 2)))
+
+    def _draw_cursor(self, frame, x):
+        left = int(round(x - self.cursor_width / 2))
+        left, right = max(0, left), min(self.width, left + self.cursor_width)
+        top, bottom = self.cursor_rows
+        frame[top:bottom, left:right] = CURSOR_COLOR
+
+    def _draw_marker(self, frame, x, y):
+        size = self.marker_alpha.shape[0]
+        left = int(round(x - size / 2))
+        top = int(round(y - size / 2))
+        # Clip the sprite to the frame
+        x0, y0 = max(0, left), max(0, top)
+        x1, y1 = min(self.width, left + size), min(self.height, top + size)
+        if x0 >= x1 or y0 >= y1:
+            return
+        alpha = self.marker_alpha[y0 - top:y1 - top, x0 - left:x1 - left, None]
+        region = frame[y0:y1, x0:x1].astype(np.float32)
+        frame[y0:y1, x0:x1] = (region * (1 - alpha) + np.asarray(MARKER_COLOR) * alpha).astype(np.uint8)
+
+    def _draw_text(self, frame, text):
+        x, y = self.text_origin
+        left, top, right, bottom = _MEASURE.multiline_textbbox(
+            (x, y), text, font=self.font, spacing=self.line_spacing)
+
+        # Darken the padded box, then draw the text on that crop only
+        pad = self.text_pad
+        x0, y0 = max(0, int(left - pad)), max(0, int(top - pad))
+        x1, y1 = min(self.width, int(right + pad)), min(self.height, int(bottom + pad))
+        box = (frame[y0:y1, x0:x1] * (1 - TEXT_BOX_ALPHA)).astype(np.uint8)
+        image = Image.fromarray(box)
+        ImageDraw.Draw(image).multiline_text(
+            (x - x0, y - y0), text, font=self.font, fill=TEXT_COLOR, spacing=self.line_spacing)
+        frame[y0:y1, x0:x1] = np.asarray(image)
+        return frame
+
+    def _calibrate_spacing(self, text, target_height, n_lines):
+        """
+        Returns the Pillow line spacing that makes the text block as tall as matplotlib's.
+        """
+        if n_lines < 2:
+            return 0
+        _, top, _, bottom = _MEASURE.multiline_textbbox((0, 0), text, font=self.font, spacing=0)
+        return max(0, (target_height - (bottom - top)) / (n_lines - 1))
+
+def _disc_alpha(diameter: float) -> np.ndarray:
+    """
+    Returns an anti-aliased disc alpha mask (float32, 0..1) of the given diameter in pixels.
+    """
+    size = int(np.ceil(diameter)) + 2
+    big = Image.new("L", (size * SUPERSAMPLE, size * SUPERSAMPLE), 0)
+    offset = (size - diameter) / 2 * SUPERSAMPLE
+    ImageDraw.Draw(big).ellipse(
+        (offset, offset, offset + diameter * SUPERSAMPLE, offset + diameter * SUPERSAMPLE), fill=255)
+    small = big.resize((size, size), Image.Resampling.LANCZOS)
+    return np.asarray(small, dtype=np.float32) / 255
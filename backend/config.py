@@ -8,4 +8,16 @@ REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
 
 VIDEO_FILES_DIR      = os.environ.get("VIDEO_FILES_DIR", "/app/storage/videos")
 FIT_FILES_DIR        = os.environ.get("FIT_FILES_DIR", "/app/storage/fits")
-THUMBNAIL_FILES_DIR  = os.environ.get("THUMBNAIL_FILES_DIR", "/app/storage/thumbnails")
\ No newline at end of file
+THUMBNAIL_FILES_DIR  = os.environ.get("THUMBNAIL_FILES_DIR", "/app/storage/thumbnails")
+MAX_UPLOAD_MB        = int(os.environ.get("MAX_UPLOAD_MB", "2"))   # Raise (e.g. 64) for multi-day rides
+TILE_CACHE_PATH      = os.environ.get("TILE_CACHE_PATH", "/app/storage/tiles/tiles.sqlite3")
+TILE_CACHE_MAX_MB    = int(os.environ.get("TILE_CACHE_MAX_MB", "1024"))
+TILE_PREFETCH_ZOOMS  = [int(z) for z in os.environ.get("TILE_PREFETCH_ZOOMS", "13,12,14").split(",")]
+TILE_PREFETCH_SLOTS  = int(os.environ.get("TILE_PREFETCH_SLOTS", "1"))
+RESULT_CACHE_MAX_MB  = int(os.environ.get("RESULT_CACHE_MAX_MB", "4096"))
+RESULT_CACHE_MAX_AGE_DAYS = float(os.environ.get("RESULT_CACHE_MAX_AGE_DAYS", "30"))
+MAX_RENDER_WORKERS   = int(os.environ.get("MAX_RENDER_WORKERS", str(os.cpu_count() or 1)))   # Cap on AnimationParams.workers
+MAX_RENDER_SEGMENTS  = int(os.environ.get("MAX_RENDER_SEGMENTS", "16"))   # Cap on AnimationParams.segments
+MAX_TILE_BUDGET      = int(os.environ.get("MAX_TILE_BUDGET", "600"))   # Cap on AnimationParams.max_tiles
+MAX_CONCURRENT_PREVIEWS = int(os.environ.get("MAX_CONCURRENT_PREVIEWS", "2"))   # Previews rendered at once per API process
+MAX_RENDER_FRAMES    = int(os.environ.get("MAX_RENDER_FRAMES", "36000"))   # Cap on AnimationParams.max_frames
@@ -0,0 +1,216 @@
+"""
+Fast FIT decoder for the record fields used by the ride animator.
+
+Walks the message stream once, parsing each definition message a single time
+and collecting the offsets of `record` data messages. The fields of interest
+are then unpacked in bulk per message layout with numpy.frombuffer.
+The file is memory-mapped and records are unpacked in chunks, so memory stays
+bounded by the decoded track rather than the file size and message count.
+Anything the decoder does not handle raises UnsupportedFitError so callers can
+fall back to fitparse.
+"""
+
+import mmap
+import os
+import struct
+from dataclasses import fields
+from pathlib import Path
+
+import numpy as np
+
+from backend.track import Track, SEMICIRCLES_TO_DEGREES
+from backend.util import fit_crc
+
+RECORD_MESG_NUM = 20
+FIT_EPOCH_OFFSET = 631065600  # Seconds from Unix epoch to FIT epoch (1989-12-31 00:00 UTC)
+FIT_MIN_ABSOLUTE_TIME = 0x10000000  # Smaller timestamps are device-relative
+DECODE_CHUNK_RECORDS = 65536    # Record messages unpacked per chunk
+CRC_CHUNK_BYTES = 1 << 20       # Bytes checksummed per step
+
+# Record field number -> (name, FIT base type, numpy type, invalid value)
+RECORD_FIELDS = {
+    253: ("timestamp",         0x86, "u4", 0xFFFFFFFF),
+    0:   ("position_lat",      0x85, "i4", 0x7FFFFFFF),
+    1:   ("position_long",     0x85, "i4", 0x7FFFFFFF),
+    2:   ("altitude",          0x84, "u2", 0xFFFF),
+    78:  ("enhanced_altitude", 0x86, "u4", 0xFFFFFFFF),
+    6:   ("speed",             0x84, "u2", 0xFFFF),
+    3:   ("heart_rate",        0x02, "u1", 0xFF),
+    4:   ("cadence",           0x02, "u1", 0xFF),
+}
+
+class UnsupportedFitError(ValueError):
+    """Raised when a FIT file uses features the fast decoder does not handle."""
+
+def decode_fit_records(path: Path, check_crc: bool = True, chunk_records: int = DECODE_CHUNK_RECORDS) -> Track:
+    """
+    Decodes the record messages of a FIT file into a Track.
+    Records without position, altitude or timestamp are dropped, matching load_fit.
+    - check_crc: verify the file CRC (skip when the file was validated on upload)
+    - chunk_records: record messages unpacked at a time
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise UnsupportedFitError("Empty FIT file")
+        # Closed when garbage-collected, once no array views into it remain
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _decode(data, check_crc, chunk_records)
+    except (struct.error, IndexError, KeyError) as e:
+        raise UnsupportedFitError(f"Malformed FIT data: {e!r}") from e
+
+def _decode(data, check_crc: bool, chunk_records: int) -> Track:
+    header_size = data[0]
+    if header_size not in (12, 14) or data[8:12] != b".FIT":
+        raise UnsupportedFitError("Invalid FIT header")
+    data_size, = struct.unpack_from("<I", data, 4)
+    end = header_size + data_size
+    if end + 2 != len(data):
+        raise UnsupportedFitError("Chained or truncated FIT files are not supported")
+    if check_crc:
+        crc = 0
+        for start in range(0, len(data), CRC_CHUNK_BYTES):
+            crc = fit_crc(data[start:start + CRC_CHUNK_BYTES], crc)
+        if crc != 0:
+            raise UnsupportedFitError("FIT file CRC mismatch")
+
+    definitions = {}    # local message type -> (data size, record layout or None)
+    offsets = {}        # record layout -> start offsets of its data messages in the current chunk
+    chunks = []         # Tracks decoded from earlier chunks
+    pending = 0         # Record messages collected in the current chunk
+    pos = header_size
+    while pos < end:
+        header = data[pos]
+        if header & 0x80:
+            raise UnsupportedFitError("Compressed timestamp headers are not supported")
+        local = header & 0x0F
+
+        if header & 0x40:
+            pos, size, layout = _parse_definition(data, pos, has_dev_fields=bool(header & 0x20))
+            definitions[local] = (size, layout)
+            if layout is not None:
+                offsets.setdefault(layout, [])
+            continue
+
+        size, layout = definitions[local]
+        if layout is not None:
+            offsets[layout].append(pos + 1)
+            pending += 1
+            if pending == chunk_records:
+                chunks.append(_build_track(data, offsets))
+                offsets = {layout: [] for layout in offsets}
+                pending = 0
+        pos += 1 + size
+
+    if pos != end:
+        raise UnsupportedFitError("Message stream overruns the data section")
+    if pending or not chunks:
+        chunks.append(_build_track(data, offsets))
+    return _join_chunks(chunks)
+
+def _join_chunks(chunks: list) -> Track:
+    """
+    Concatenates decoded chunks field by field, releasing each field's pieces once joined,
+    so the peak is one track plus one field rather than two whole tracks.
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    parts = {f.name: [getattr(chunk, f.name) for chunk in chunks] for f in fields(Track)}
+    chunks.clear()
+    return Track(**{name: np.concatenate(parts.pop(name)) for name in list(parts)})
+
+def _parse_definition(data: bytes, pos: int, has_dev_fields: bool):
+    """
+    Parses a definition message starting at pos.
+    Returns (next position, data message size, record layout or None).
+    A layout is a hashable tuple of (field number, byte offset, numpy dtype string).
+    """
+    architecture = data[pos + 2]
+    if architecture not in (0, 1):
+        raise UnsupportedFitError(f"Unknown architecture {architecture}")
+    endian = ">" if architecture == 1 else "<"
+    global_num, = struct.unpack_from(endian + "H", data, pos + 3)
+    n_fields = data[pos + 5]
+    pos += 6
+
+    size = 0
+    layout = []
+    for i in range(n_fields):
+        num, field_size, base_type = data[pos + 3*i: pos + 3*i + 3]
+        if global_num == RECORD_MESG_NUM and num in RECORD_FIELDS:
+            _, expected_type, np_type, _ = RECORD_FIELDS[num]
+            if base_type != expected_type or field_size != np.dtype(np_type).itemsize:
+                raise UnsupportedFitError(f"Unexpected type {base_type:#x}/{field_size}B for record field {num}")
+            layout.append((num, size, endian + np_type))
+        size += field_size
+    pos += 3 * n_fields
+
+    if has_dev_fields:
+        n_dev = data[pos]
+        size += sum(data[pos + 1 + 3*i + 1] for i in range(n_dev))
+        pos += 1 + 3 * n_dev
+
+    if global_num != RECORD_MESG_NUM:
+        return pos, size, None
+    return pos, size, (size, tuple(layout))
+
+def _build_track(data, offsets: dict) -> Track:
+    """
+    Unpacks the collected record messages into a Track, in file order.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts = []
+    columns = {num: [] for num in RECORD_FIELDS}
+    altitude_first = []
+
+    for (_, fields), layout_offsets in offsets.items():
+        layout_starts = np.asarray(layout_offsets, dtype=np.int64)
+        starts.append(layout_starts)
+        by_num = {num: (offset, dtype) for num, offset, dtype in fields}
+        for num, (_, _, np_type, invalid) in RECORD_FIELDS.items():
+            if num in by_num:
+                offset, dtype = by_num[num]
+                width = np.dtype(dtype).itemsize
+                raw = buf[(layout_starts + offset)[:, None] + np.arange(width)]
+                columns[num].append(raw.view(dtype).ravel().astype(np_type))
+            else:
+                columns[num].append(np.full(layout_starts.size, invalid, dtype=np_type))
+
+        # fitparse resolves get_value('enhanced_altitude') to the first match in definition
+        # order: field 78 itself, or the component expanded from altitude (field 2).
+        nums = [num for num, _, _ in fields]
+        first = 2 in nums and (78 not in nums or nums.index(2) < nums.index(78))
+        altitude_first.append(np.full(layout_starts.size, first, dtype=bool))
+
+    if not starts:
+        return Track.from_columns([], [], [], [], [], [], [])
+
+    order = np.argsort(np.concatenate(starts), kind="stable")
+    col = {num: np.concatenate(columns[num])[order] for num in RECORD_FIELDS}
+    ok = {num: col[num] != RECORD_FIELDS[num][3] for num in RECORD_FIELDS}
+    altitude_first = np.concatenate(altitude_first)[order]
+
+    # load_fit uses `enhanced_altitude or altitude`
+    altitude = col[2] / 5.0 - 500
+    enhanced = np.where(altitude_first, altitude, col[78] / 5.0 - 500)
+    enhanced_ok = np.where(altitude_first, ok[2], ok[78])
+    use_enhanced = enhanced_ok & (enhanced != 0)
+    alt = np.where(use_enhanced, enhanced, altitude)
+    alt_ok = use_enhanced | ok[2]
+
+    keep = ok[253] & ok[0] & ok[1] & alt_ok
+    timestamp = col[253][keep].astype(np.int64)
+    timestamp = np.where(timestamp >= FIT_MIN_ABSOLUTE_TIME, timestamp + FIT_EPOCH_OFFSET, timestamp)
+
+    return Track(
+        time=timestamp,
+        lat=col[0][keep] * SEMICIRCLES_TO_DEGREES,
+        lon=col[1][keep] * SEMICIRCLES_TO_DEGREES,
+        alt=alt[keep].astype(np.float32),
+        speed=np.where(ok[6], col[6] / 1000.0, 0)[keep].astype(np.float32),
+        hr=np.where(ok[3], col[3], 0)[keep].astype(np.uint8),
+        cad=np.where(ok[4], col[4], 0)[keep].astype(np.uint16),
+        speed_valid=ok[6][keep],
+        hr_valid=ok[3][keep],
+        cad_valid=ok[4][keep],
+    )
@@ -0,0 +1,96 @@
+"""
+Vectorized track geometry helpers.
+Computes segment and cumulative distances and Web Mercator projections
+over whole coordinate arrays in one call, and smooths elevation profiles.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from pyproj import Geod, Transformer
+from scipy.signal import savgol_filter
+
+EARTH_RADIUS_M = 6371008.8  # Mean Earth radius (IUGG)
+SMOOTH_WINDOW = 11          # Savitzky-Golay window length (points)
+SMOOTH_POLYORDER = 2
+SMOOTH_CHUNK = 65536        # Points filtered per chunk
+
+# "geodesic" solves on the WGS84 ellipsoid (Karney, same as geopy.distance.geodesic).
+# "haversine" assumes a sphere: ~0.3% error, but several times faster.
+DISTANCE_MODES = ("geodesic", "haversine")
+
+_geod = Geod(ellps="WGS84")
+
+def segment_distances(lat, lon, mode: str = "geodesic") -> np.ndarray:
+    """
+    Returns the distance in meters between each pair of consecutive points.
+    - lat, lon: coordinate arrays in degrees
+    - mode: one of DISTANCE_MODES
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if lat.size < 2:
+        return np.zeros(0, dtype=np.float64)
+
+    if mode == "geodesic":
+        _, _, dist = _geod.inv(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        return np.asarray(dist, dtype=np.float64)
+
+    if mode == "haversine":
+        phi = np.radians(lat)
+        dphi = np.diff(phi)
+        dlmb = np.radians(np.diff(lon))
+        a = np.sin(dphi / 2) ** 2 + np.cos(phi[:-1]) * np.cos(phi[1:]) * np.sin(dlmb / 2) ** 2
+        return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    raise ValueError(f"Unknown distance mode '{mode}'. Expected one of {DISTANCE_MODES}")
+
+def cumulative_distances(lat, lon, mode: str = "geodesic") -> np.ndarray:
+    """
+    Returns the cumulative distance in meters for each point, starting at 0.0.
+    """
+    segments = segment_distances(lat, lon, mode)
+    distances = np.zeros(len(lat), dtype=np.float64)
+    np.cumsum(segments, out=distances[1:])
+    return distances
+
+@lru_cache(maxsize=None)
+def _web_mercator_transformer() -> Transformer:
+    """
+    Returns the WGS84 -> Web Mercator transformer, built once per process.
+    """
+    return Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+
+def to_web_mercator(lat, lon):
+    """
+    Projects coordinate arrays in degrees to Web Mercator (EPSG:3857).
+    Returns (x, y) arrays in meters.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    x, y = _web_mercator_transformer().transform(lon, lat)
+    return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+def smooth_elevations(alt, window_length: int = SMOOTH_WINDOW, polyorder: int = SMOOTH_POLYORDER,
+                      chunk_size: int = SMOOTH_CHUNK) -> np.ndarray:
+    """
+    Applies a Savitzky-Golay filter to an elevation array in chunks of chunk_size points.
+    Each chunk is filtered with half a window of neighbours on both sides, so the result
+    matches filtering the whole array at once while temporaries stay chunk-sized.
+    """
+    alt = np.asarray(alt)
+    n = len(alt)
+    if n <= chunk_size:
+        return savgol_filter(alt, window_length=window_length, polyorder=polyorder)
+
+    half = window_length // 2
+    out = None
+    for start in range(0, n, chunk_size):
+        stop = min(n, start + chunk_size)
+        hi = min(n, stop + half)
+        lo = max(0, min(start - half, hi - window_length))
+        part = savgol_filter(alt[lo:hi], window_length=window_length, polyorder=polyorder)
+        if out is None:
+            out = np.empty(n, dtype=part.dtype)
+        out[start:stop] = part[start - lo:stop - lo]
+    return out
@@ -0,0 +1,95 @@
+"""
+Versioned, memory-mapped cache of a ride's parsed and projected track arrays.
+
+The file holds a JSON header followed by the raw arrays, each aligned to 64 bytes,
+so loading maps every array straight from the page cache with np.memmap instead of
+copying it. The header records the inputs the arrays were derived from (format
+version, FIT content hash and geometry options); a cache whose key does not match
+is treated as missing. Files are written to a temporary name and renamed into
+place, so readers never see a partial file.
+"""
+
+import json
+import os
+import struct
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+
+from backend.logger import get_logger
+from backend.util import file_sha256
+
+logger = get_logger(__name__)
+
+GEOMETRY_CACHE_VERSION = 1      # Bump when the stored arrays or their meaning change
+MAGIC = b"RIDEGEO\0"
+ALIGN = 64                      # Array offsets are multiples of this many bytes
+
+def geometry_key(fit_path: Path, no_elevation_smoothing: bool, distance_mode: str, fit_sha256: str = None) -> dict:
+    """
+    Returns the cache key for geometry derived from a FIT file with the given options.
+    Pass fit_sha256 when the file's content hash is already known; otherwise the file is hashed.
+    """
+    return {
+        "version": GEOMETRY_CACHE_VERSION,
+        "fit_sha256": fit_sha256 or file_sha256(fit_path),
+        "no_elevation_smoothing": bool(no_elevation_smoothing),
+        "distance_mode": distance_mode,
+    }
+
+def save_geometry(path: Path, key: dict, arrays: dict, meta: dict):
+    """
+    Writes named arrays and JSON-serializable metadata under a cache key.
+    """
+    path = Path(path)
+    header = {"key": key, "meta": meta, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    encoded = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 4 + len(encoded)) // ALIGN) * ALIGN
+
+    tmp_path = path.with_name(f"{path.name}.tmp-{uuid4()}")    # Concurrent previews may save the same ticket
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(encoded)) + encoded)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    logger.info(f"Saved geometry cache: {path} ({data_start + offset} bytes)")
+
+def load_geometry(path: Path, key: dict):
+    """
+    Maps the arrays of a geometry cache file read-only.
+    Returns (arrays, meta), or None when the file is missing, unreadable or has a different key.
+    """
+    path = Path(path)
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("bad magic")
+            size, = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(size))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning(f"Ignoring unreadable geometry cache {path}: {e}")
+        return None
+
+    if header["key"] != key:
+        logger.info(f"Geometry cache {path} is stale, rebuilding")
+        return None
+    data_start = -(-(len(MAGIC) + 4 + size) // ALIGN) * ALIGN
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        shape = tuple(spec["shape"])
+        if not np.prod(shape):
+            arrays[name] = np.empty(shape, dtype=spec["dtype"])   # mmap cannot map zero bytes
+            continue
+        arrays[name] = np.memmap(path, dtype=spec["dtype"], mode="r",
+                                 offset=data_start + spec["offset"], shape=shape)
+    return arrays, header["meta"]
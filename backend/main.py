@@ -2,27 +2,53 @@
 FastAPI entry point for the Ride Animation Service.
 Handles FIT upload, animation generation, status tracking, and file retrieval.
 """
-from fastapi import FastAPI, Header, HTTPException, UploadFile, File
-from pydantic import BaseModel
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Header, HTTPException
+from typing import List, Literal, Optional, Union
+from pydantic import BaseModel, Field, field_validator
+from fastapi.responses import FileResponse, Response
+from uuid import uuid4
+from threading import BoundedSemaphore
 from rq import Queue
+from rq.job import Job, JobStatus, Dependency
+from rq.exceptions import NoSuchJobError
+from python_multipart.exceptions import FormParserError
 
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 
 from backend.logger import get_logger
-from backend.util import validate_fit_header
 from backend.redis_client import get_redis_client
-from backend.ticket import create_ticket, update_status, get_status
-from backend.storage import save_fit_file, get_video_path, get_thumbnail_path
-from backend.tasks import run_animation_job
+from backend.ticket import (create_ticket, update_status, get_status, init_segments, cancel_prefetch,
+                            set_fit_sha256, set_outputs, get_outputs)
+from backend.storage import (FitUpload, commit_fit_file, UploadTooLarge,
+                             get_video_path, get_thumbnail_path, get_rendition_path,
+                             VIDEO_FORMATS, RENDITION_NAME)
+from backend.tasks import (run_animation_job, run_segment_job, run_join_job, run_prefetch_job, run_link_job,
+                           render_preview, ticket_fit_sha256)
+from backend.multipart_upload import receive_file_part, MalformedUpload
+from backend import result_cache
+from backend.tile_cache import TileCache
+from backend.config import (TILE_CACHE_PATH, TILE_CACHE_MAX_MB, MAX_UPLOAD_MB, MAX_RENDER_WORKERS,
+                            MAX_RENDER_SEGMENTS, MAX_TILE_BUDGET, MAX_CONCURRENT_PREVIEWS,
+                            MAX_RENDER_FRAMES)
 
 logger = get_logger(__name__)
 redis = get_redis_client()
-queue = Queue("default", connection=redis)
+queue = Queue("default", connection=get_redis_client(decode_responses=False))
+# Workers drain "default" before "prefetch", so prefetching never delays a render
+prefetch_queue = Queue("prefetch", connection=queue.connection)
 
-MAX_UPLOAD_SIZE = 2 * 1024 * 1024  # 2MB
+MAX_UPLOAD_SIZE = MAX_UPLOAD_MB * 1024 * 1024
+# /upload reads its body itself, so the form is described for the API docs here
+UPLOAD_REQUEST_BODY = {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object", "required": ["file"], "properties": {"file": {"type": "string", "format": "binary"}}}}}}}
+# Previews render in the API process; beyond this many at once, requests get 429
+preview_slots = BoundedSemaphore(MAX_CONCURRENT_PREVIEWS)
+# Regenerating a ticket replaces its files under the same URL, so clients revalidate
+# every time; a matching ETag costs a 304 without a body
+MEDIA_CACHE_CONTROL = "private, no-cache"
 
 class LimitUploadSizeMiddleware(BaseHTTPMiddleware):
     """
@@ -42,6 +68,14 @@ app = FastAPI(title="Ride Animation Service", description="Backend API for FIT-b
 # Add this middleware to your FastAPI app
 app.add_middleware(LimitUploadSizeMiddleware)
 
+class Rendition(BaseModel):
+    """
+    A further output encoded from the same rendered frames, addressed by name.
+    """
+    name: str = Field(pattern=RENDITION_NAME.pattern)
+    output_format: Literal["mp4", "gif", "webp"] = "mp4"
+    height: Optional[int] = Field(default=None, ge=16, le=4320)  # Pixels; None keeps the rendered size
+
 class AnimationParams(BaseModel):
     """
     Parameters for ride animation generation.
@@ -49,44 +83,110 @@ class AnimationParams(BaseModel):
     title: str
     fps: int = 10
     dpi: int = 100
-    zoom: int = 13
+    zoom: Union[int, Literal["auto"]] = 13
+    max_tiles: int = Field(150, ge=1, le=MAX_TILE_BUDGET)   # 0 (no limit) is left to the CLI
     step_frame: int = 60
+    schedule: Literal["time", "index"] = "index"   # "index" keeps step_frame counting records for existing clients
+    target_duration: Optional[float] = None
+    max_frames: int = Field(3600, ge=1, le=MAX_RENDER_FRAMES)
+    collapse_stops: Optional[float] = None
+    output_format: Literal["mp4", "gif", "webp"] = "mp4"
+    encoding_profile: Literal["draft", "standard", "archival"] = "standard"
     no_elevation_smoothing: bool = False
     tile: str = "OpenStreetMap.Mapnik"
+    distance_mode: Literal["geodesic", "haversine"] = "geodesic"
+    thumbnail_time: Optional[float] = None
+    workers: int = Field(1, ge=1, le=MAX_RENDER_WORKERS)   # Render processes forked by the worker
+    segments: int = Field(1, ge=1, le=MAX_RENDER_SEGMENTS)   # RQ sub-jobs the render fans out into
+    renditions: List[Rendition] = []
+
+    @field_validator("renditions")
+    @classmethod
+    def unique_rendition_names(cls, renditions):
+        names = [r.name for r in renditions]
+        if len(set(names)) != len(names):
+            raise ValueError("Rendition names must be unique")
+        return renditions
+
+@app.post("/upload", summary="Upload FIT file", response_description="Returns a ticket ID",
+          openapi_extra=UPLOAD_REQUEST_BODY)
+async def upload_fit(request: Request):
+    """
+    Accepts a FIT file upload (multipart form field "file") and returns a ticket ID for tracking.
+    """
+    def open_upload(filename, content_type):
+        # Check MIME type
+        if content_type not in ["application/octet-stream", "application/fit"]:
+            logger.warning(f"Upload rejected: invalid MIME type {content_type}")
+            raise HTTPException(status_code=400, detail="Invalid file type. Expected binary FIT file.")
+
+        # Check file extension
+        if not filename.lower().endswith(".fit"):
+            logger.warning(f"Upload rejected: invalid file type {filename}")
+            raise HTTPException(status_code=400, detail="Only .fit files are allowed")
+        return FitUpload(MAX_UPLOAD_SIZE)
 
-@app.post("/upload", summary="Upload FIT file", response_description="Returns a ticket ID")
-async def upload_fit(file: UploadFile = File(...)):
-    """
-    Accepts a FIT file upload and returns a ticket ID for tracking.
-    """
-        
-    # Check MIME type
-    if file.content_type not in ["application/octet-stream", "application/fit"]:
-        logger.warning(f"Upload rejected: invalid MIME type {file.content_type}")
-        raise HTTPException(status_code=400, detail="Invalid file type. Expected binary FIT file.")
-        
-    # Check file extension
-    if not file.filename.lower().endswith(".fit"):
-        logger.warning(f"Upload rejected: invalid file type {file.filename}")
-        raise HTTPException(status_code=400, detail="Only .fit files are allowed")
-        
-    # Read file content and check size
-    content = await file.read()
-    if len(content) > MAX_UPLOAD_SIZE:
-        logger.warning(f"Upload rejected after read: {len(content)} bytes")
+    # Stream the body to a temporary file as it arrives, enforcing the size limit and
+    # hashing and validating on the way; the body is never held in memory or spooled first
+    try:
+        upload = await receive_file_part(request, "file", open_upload, MAX_UPLOAD_SIZE)
+        digest = await run_in_threadpool(upload.finish)
+    except UploadTooLarge as e:
+        logger.warning(f"Upload rejected: {e}")
         raise HTTPException(status_code=413, detail="File too large")
-        
-    try:    
-        # Save and register ticket
+    except (MalformedUpload, FormParserError) as e:
+        logger.warning(f"Upload rejected: {e}")
+        raise HTTPException(status_code=400, detail=f"Invalid upload: {e}")
+    except ValueError as e:
+        logger.warning(f"Upload rejected: {e}")
+        raise HTTPException(status_code=400, detail=f"Invalid FIT file: {e}")
+    tmp_path = upload.tmp_path
+
+    try:
+        # Register ticket and move the validated file into place
         ticket_id = create_ticket()
-        save_fit_file(ticket_id, content)
+        commit_fit_file(tmp_path, ticket_id)
+        set_fit_sha256(ticket_id, digest)
         update_status(ticket_id, "upload_done")
+        enqueue_prefetch(ticket_id)
         return {"ticket_id": ticket_id}
     except Exception as e:
         logger.warning(f"Upload failed: {e}")
+        tmp_path.unlink(missing_ok=True)
         update_status(ticket_id, "upload_error")
         raise HTTPException(status_code=500, detail="Failed to upload FIT file")
 
+def make_prefetch_job_id(ticket_id: str) -> str:
+    """
+    Returns the RQ job ID of the ticket's tile prefetch.
+    """
+    return f"prefetch-{ticket_id}"
+
+def enqueue_prefetch(ticket_id):
+    """
+    Enqueues a best-effort tile prefetch for an uploaded ticket.
+    Failing to enqueue it never fails the upload.
+    """
+    try:
+        prefetch_queue.enqueue(run_prefetch_job, args=(ticket_id,),
+            job_id=make_prefetch_job_id(ticket_id), job_timeout=600, result_ttl=3600, failure_ttl=3600)
+    except Exception as e:
+        logger.warning(f"Failed to enqueue tile prefetch for {ticket_id}: {e}")
+
+def stop_prefetch(ticket_id):
+    """
+    Cancels the ticket's tile prefetch: drops it while still queued, or asks it to stop if running.
+    """
+    try:
+        cancel_prefetch(ticket_id)
+        job = Job.fetch(make_prefetch_job_id(ticket_id), connection=queue.connection)
+        if job.get_status() == JobStatus.QUEUED:
+            job.cancel()
+    except NoSuchJobError:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to cancel tile prefetch for {ticket_id}: {e}")
+
 def on_failure_generate(job, connection, type, value, traceback):
     """
     Callback for job failure to update ticket status.
@@ -94,6 +194,9 @@ def on_failure_generate(job, connection, type, value, traceback):
     ticket_id = job.args[0]
     logger.warning(f"Failure callback triggered for ticket_id={ticket_id}, error={value}")
     update_status(ticket_id, "generate_error")
+    # A failed segment leaves its join job deferred for good; let identical requests render again
+    if job.meta.get("result_key"):
+        result_cache.release_inflight(job.meta["result_key"], job.meta["render_job_id"])
     
 def on_success_generate(job, connection, result):
     """
@@ -116,13 +219,137 @@ def generate_animation(params: AnimationParams, ticket_id: str = Header(...)):
         raise HTTPException(status_code=400, detail=f"Cannot generate animation. Current status: {info.get('status')}")
     
     update_status(ticket_id, "generate_processing", params.model_dump())
-    queue.enqueue(run_animation_job,
-        args=(ticket_id, params.model_dump()), 
-        on_failure=on_failure_generate,
-        on_success=on_success_generate)
+    set_outputs(ticket_id, params.output_format, {r.name: r.output_format for r in params.renditions})
+    stop_prefetch(ticket_id)
+
+    # Serve a finished identical render, or attach to one that is still in progress
+    key = result_cache.render_key(ticket_fit_sha256(ticket_id), params.model_dump())
+    renditions = params.model_dump()["renditions"]
+    if result_cache.link_cached_result(key, ticket_id, params.output_format, renditions):
+        result_cache.record("hits")
+        update_status(ticket_id, "generate_done", params.model_dump())
+        return {"ticket_id": ticket_id, "params": params, "cached": True}
+
+    job_id = f"render-{uuid4()}"
+    # GIF and WebP are encoded in one pass; segments would each get their own palette or encoder.
+    # Renditions are fanned out from a single render, so they are not segmented either.
+    segmented = params.segments > 1 and params.output_format == "mp4" and not params.renditions
+    # The jobs exist before the key is claimed, so an identical request never finds it naming a missing job
+    jobs = create_render_jobs(ticket_id, params, key, job_id, segmented)
+    holder = result_cache.claim_inflight(key, job_id)
+    if holder:
+        if attach_to_render(ticket_id, key, holder, params.output_format, renditions):
+            for job in jobs:
+                job.delete()
+            return {"ticket_id": ticket_id, "params": params, "attached_to": holder}
+        result_cache.replace_inflight(key, job_id)
+    result_cache.record("misses")
+
+    if segmented:
+        # The segment owning the thumbnail frame writes a new thumbnail; the old one must not stand in for it
+        init_segments(ticket_id, params.segments)
+        get_thumbnail_path(ticket_id).unlink(missing_ok=True)
+    for job in jobs:
+        queue.enqueue_job(job)
     
     return {"ticket_id": ticket_id, "params": params}
 
+def create_render_jobs(ticket_id, params: AnimationParams, key: str, job_id: str, segmented: bool) -> list:
+    """
+    Creates the jobs rendering params for a ticket without queueing them: one animation job,
+    or one segment job per frame window and a join job fanning them in. The last job has ID job_id.
+    Jobs are saved but not pushed to the queue yet, so identical requests can attach to them.
+    Queue them in order with queue.enqueue_job, or delete them.
+    """
+    # Lets the failure callbacks release the inflight key this render holds
+    render_meta = {"result_key": key, "render_job_id": job_id}
+    if not segmented:
+        jobs = [queue.create_job(run_animation_job,
+            args=(ticket_id, params.model_dump(), key),
+            job_id=job_id,
+            meta=render_meta,
+            on_failure=on_failure_generate,
+            on_success=on_success_generate)]
+    else:
+        # Fan out one sub-job per frame window, then fan in with a dependent join job
+        jobs = [queue.create_job(run_segment_job,
+                    args=(ticket_id, params.model_dump(), index, params.segments),
+                    meta=render_meta,
+                    on_failure=on_failure_generate)
+                for index in range(params.segments)]
+        jobs.append(queue.create_job(run_join_job,
+            args=(ticket_id, params.model_dump(), params.segments, key),
+            job_id=job_id,
+            meta=render_meta,
+            depends_on=jobs,
+            on_failure=on_failure_generate,
+            on_success=on_success_generate))
+    for job in jobs:
+        job.save()
+    return jobs
+
+def attach_to_render(ticket_id, key, job_id, output_format: str = "mp4", renditions=()) -> bool:
+    """
+    Makes the ticket wait for an identical render that is queued or running, then link its result.
+    Returns False when that render has already ended (or is unknown), so a new one is needed.
+    """
+    try:
+        job = Job.fetch(job_id, connection=queue.connection)
+    except NoSuchJobError:
+        return False
+    status = job.get_status()
+    if status not in (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED, JobStatus.STARTED):
+        return False
+    if status == JobStatus.DEFERRED and dependencies_failed(job):
+        return False
+    # allow_failure lets the link job run (and fail the ticket) when the render fails
+    queue.enqueue(run_link_job,
+        args=(ticket_id, key, output_format, renditions),
+        depends_on=Dependency(jobs=[job], allow_failure=True),
+        on_failure=on_failure_generate,
+        on_success=on_success_generate)
+    result_cache.record("attached")
+    logger.info(f"Attached {ticket_id} to identical render job {job_id}")
+    return True
+
+def dependencies_failed(job) -> bool:
+    """
+    Returns True when a deferred job can never run: one of its dependencies failed,
+    was cancelled or stopped, or has expired.
+    """
+    dependencies = job.fetch_dependencies()
+    if len(dependencies) < len(job.dependency_ids):
+        return True
+    return any(d.get_status() in (JobStatus.FAILED, JobStatus.CANCELED, JobStatus.STOPPED) for d in dependencies)
+
+@app.post("/preview", summary="Render a low-resolution preview", response_description="Returns a PNG strip of keyframes")
+def preview(params: AnimationParams, ticket_id: str = Header(...), frames: int = 3):
+    """
+    Renders the start, middle and end keyframes (or `frames` evenly spaced ones) at low DPI
+    synchronously and returns them side by side as a PNG. Nothing is queued or encoded.
+    At most MAX_CONCURRENT_PREVIEWS render at once; further requests get 429.
+    """
+    info = get_status(ticket_id)
+    if not info:
+        raise HTTPException(status_code=404, detail="Invalid ticket ID")
+    if info.get("status") in ("initial", "upload_error"):
+        raise HTTPException(status_code=400, detail=f"Cannot preview. Current status: {info.get('status')}")
+    if not 1 <= frames <= 8:
+        raise HTTPException(status_code=400, detail="frames must be between 1 and 8")
+
+    if not preview_slots.acquire(blocking=False):
+        logger.warning(f"Preview rejected for {ticket_id}: {MAX_CONCURRENT_PREVIEWS} previews in progress")
+        raise HTTPException(status_code=429, detail="Too many previews in progress, try again shortly",
+                            headers={"Retry-After": "1"})
+    try:
+        png = render_preview(ticket_id, params.model_dump(), frames)
+    except Exception as e:
+        logger.warning(f"Preview failed for {ticket_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Preview failed: {e}")
+    finally:
+        preview_slots.release()
+    return Response(content=png, media_type="image/png")
+
 @app.get("/status", summary="Check ticket status", response_description="Returns current status and parameters")
 def status(ticket_id: str = Header(...)):
     """
@@ -133,24 +360,107 @@ def status(ticket_id: str = Header(...)):
         raise HTTPException(status_code=404, detail="Invalid ticket ID")
     return info
 
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Checks an If-None-Match header against an ETag (weak comparison, as RFC 9110 specifies for it).
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def file_response(request: Request, path, media_type: str, download_name: Optional[str] = None):
+    """
+    Serves a finished file with a strong ETag from its content hash.
+    A matching If-None-Match gets 304 Not Modified. FileResponse streams the file in
+    chunks and answers Range requests with 206 Partial Content, honouring If-Range.
+    With download_name, the file is sent as an attachment under that name.
+    """
+    try:
+        etag = f'"{result_cache.content_sha256(path)}"'
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL, "Vary": "ticket-id"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers, filename=download_name,
+                        content_disposition_type="attachment")
+
 @app.get("/video", summary="Download generated video", response_description="Returns video file")
-def video(ticket_id: str = Header(...)):
+@app.head("/video", summary="Download generated video headers", response_description="Returns the headers only")
+def video(request: Request, ticket_id: str = Header(...),
+          output_format: Optional[Literal["mp4", "gif", "webp"]] = None, rendition: Optional[str] = None):
     """
-    Returns the generated ride animation video for a given ticket.
+    Returns the generated ride animation video for a given ticket, or one of its named renditions.
+    Without output_format, the format of the latest generation is returned; files of other
+    formats from earlier generations may still exist.
+    Supports HEAD, Range requests and conditional GETs (ETag / If-None-Match / If-Range).
     """
-    path = get_video_path(ticket_id)
-    if not path.exists():
+    return video_response(request, ticket_id, output_format, rendition)
+
+@app.get("/videos/{ticket_id}", summary="Play generated video", response_description="Returns video file")
+@app.head("/videos/{ticket_id}", summary="Play generated video headers", response_description="Returns the headers only")
+def video_by_url(request: Request, ticket_id: str,
+                 output_format: Optional[Literal["mp4", "gif", "webp"]] = None, rendition: Optional[str] = None,
+                 download: bool = False):
+    """
+    Same as /video with the ticket in the path, for browsers that play or download the video
+    straight from the API and cannot send a ticket-id header.
+    With download, the response asks the browser to save the file instead of showing it.
+    """
+    return video_response(request, ticket_id, output_format, rendition, download)
+
+def video_response(request: Request, ticket_id: str, output_format: Optional[str], rendition: Optional[str],
+                   download: bool = False):
+    """
+    Finds the video file for a ticket and serves it with file_response.
+    """
+    if not output_format:
+        outputs = get_outputs(ticket_id) or {}
+        output_format = outputs.get("renditions", {}).get(rendition) if rendition else outputs.get("output_format")
+    # Without a recorded format (e.g. it expired), fall back to the most recently written file
+    formats = [output_format] if output_format else list(VIDEO_FORMATS)
+    try:
+        candidates = [get_rendition_path(ticket_id, rendition, f) if rendition else get_video_path(ticket_id, f)
+                      for f in formats]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    paths = [p for p in candidates if p.exists()]
+    if not paths:
         logger.warning(f"Video not found: {ticket_id}")
         raise HTTPException(status_code=404, detail="Video not found")
-    return FileResponse(path, media_type="video/mp4")
+    path = max(paths, key=lambda p: p.stat().st_mtime)
+    return file_response(request, path, VIDEO_FORMATS[path.suffix[1:]],
+                         download_name=f"ride{path.suffix}" if download else None)
 
 @app.get("/thumbnail", summary="Download thumbnail image", response_description="Returns thumbnail file")
-def thumbnail(ticket_id: str = Header(...)):
+@app.head("/thumbnail", summary="Download thumbnail image headers", response_description="Returns the headers only")
+def thumbnail(request: Request, ticket_id: str = Header(...)):
     """
     Returns the generated thumbnail image for a given ticket.
+    Supports HEAD and conditional GETs like /video.
     """
     path = get_thumbnail_path(ticket_id)
     if not path.exists():
         logger.warning(f"Thumbnail not found: {ticket_id}")
         raise HTTPException(status_code=404, detail="Thumbnail not found")
-    return FileResponse(path, media_type="image/jpeg")
+    return file_response(request, path, "image/jpeg")
+
+@app.get("/tiles/stats", summary="Tile cache statistics", response_description="Returns tile cache counters")
+def tile_stats():
+    """
+    Returns the shared tile cache counters (hits, misses, evictions, tiles, bytes).
+    """
+    try:
+        return TileCache(TILE_CACHE_PATH, TILE_CACHE_MAX_MB * 1024 * 1024).stats()
+    except Exception as e:
+        logger.warning(f"Tile cache unavailable: {e}")
+        raise HTTPException(status_code=503, detail="Tile cache unavailable")
+
+@app.get("/results/stats", summary="Render cache statistics", response_description="Returns render cache counters")
+def result_stats():
+    """
+    Returns the render cache counters (hits, misses, attached, stored, evictions, entries, bytes).
+    """
+    return result_cache.stats()
@@ -0,0 +1,116 @@
+"""
+Streams the file part of a multipart/form-data request body as it arrives.
+
+An UploadFile endpoint parameter is parsed by Starlette before the endpoint runs,
+which spools the whole body to a temporary file first, whatever its size and
+whether or not it declares a Content-Length. Parsing request.stream() here lets
+the endpoint enforce its size limit and validate the file chunk by chunk, and
+writes the file to disk once.
+"""
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from backend.storage import UPLOAD_CHUNK_SIZE, UploadTooLarge
+
+MAX_FORM_OVERHEAD = 64 * 1024   # bytes of multipart framing and other fields allowed besides the file
+
+class MalformedUpload(ValueError):
+    """
+    Raised for a request body that is not a multipart form holding the expected file.
+    """
+
+class _FilePartParser:
+    """
+    Feeds the data of one named file part to the sink returned by open_file(filename, content_type).
+    Sinks provide write(data) and abort(). Other parts are skipped.
+    """
+
+    def __init__(self, boundary: bytes, field: str, open_file):
+        self.field = field
+        self.open_file = open_file
+        self.sink = None
+        self.complete = False
+        self.headers = {}
+        self.header_field = b""
+        self.header_value = b""
+        self.target = None      # Sink of the part being parsed, or None to skip it
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_end": self.on_end,
+        })
+
+    def on_part_begin(self):
+        self.headers = {}
+        self.target = None
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        if options.get(b"name", b"").decode("latin-1") != self.field:
+            return
+        if self.sink is not None:
+            raise MalformedUpload(f"More than one '{self.field}' part")
+        filename = options.get(b"filename", b"").decode("utf-8", "replace")
+        content_type = self.headers.get(b"content-type", b"").decode("latin-1").strip()
+        self.sink = self.target = self.open_file(filename, content_type)
+
+    def on_part_data(self, data, start, end):
+        if self.target is not None:
+            self.target.write(data[start:end])
+
+    def on_end(self):
+        self.complete = True
+
+async def receive_file_part(request: Request, field: str, open_file, max_bytes: int):
+    """
+    Parses the request body as it arrives and writes the data of the `field` part to
+    the sink returned by open_file(filename, content_type), which may raise to reject it.
+    Data is handed to the sink in batches of about UPLOAD_CHUNK_SIZE bytes on a worker thread.
+    Returns the sink; on failure the sink's abort() is called instead.
+    Raises UploadTooLarge once the body exceeds max_bytes plus MAX_FORM_OVERHEAD, and
+    MalformedUpload for a body that is not multipart, is cut short or lacks the part.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise MalformedUpload("Expected a multipart/form-data body")
+    parts = _FilePartParser(options[b"boundary"], field, open_file)
+    try:
+        limit = max_bytes + MAX_FORM_OVERHEAD
+        received = 0
+        pending = bytearray()
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit:
+                raise UploadTooLarge(f"Request body exceeds {limit} bytes")
+            pending += chunk
+            if len(pending) >= UPLOAD_CHUNK_SIZE:
+                await run_in_threadpool(parts.parser.write, bytes(pending))
+                pending.clear()
+        if pending:
+            await run_in_threadpool(parts.parser.write, bytes(pending))
+        parts.parser.finalize()
+        if not parts.complete:
+            raise MalformedUpload("Incomplete multipart body")
+        if parts.sink is None:
+            raise MalformedUpload(f"Missing '{field}' part")
+    except BaseException:
+        if parts.sink is not None:
+            parts.sink.abort()
+        raise
+    return parts.sink
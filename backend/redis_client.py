@@ -15,14 +15,15 @@ REDIS_PREFIX = "ticket:"
 REDIS_RETRY_LIMIT = 3
 REDIS_RETRY_DELAY = 1  # seconds
 
-def get_redis_client():
+def get_redis_client(decode_responses: bool = True):
     """
     Returns a Redis client instance with retry logic.
+    Use decode_responses=False for RQ queues, which store pickled job data.
     Raises RuntimeError if connection fails.
     """
     for attempt in range(REDIS_RETRY_LIMIT):
         try:
-            redis = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+            redis = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=decode_responses)
             redis.ping()
             return redis
         except ConnectionError as e:
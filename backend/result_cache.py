@@ -0,0 +1,236 @@
+"""
+Content-addressed cache of finished renders and deduplication of identical jobs.
+
+A render key hashes the FIT content together with the normalized animation
+parameters. Finished videos and thumbnails are hard-linked under that key, so a
+repeated request (even from a new ticket uploading the same file) is served by
+linking the cached files instead of rendering again. Named renditions are linked
+along with the video. While a render is queued or
+running, its RQ job ID is recorded under the key so identical requests can attach
+to it. Entries are evicted by age and by total size, least recently used first.
+Hit/miss counters and last-use times are kept in Redis, as are the content hashes of
+finished files, which the API serves as strong ETags. Cached files are never touched
+after they are stored, so their content hashes stay valid.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from uuid import uuid4
+
+from redis.exceptions import WatchError
+
+from backend.util import file_sha256
+from backend.logger import get_logger
+from backend.redis_client import get_redis_client
+from backend.storage import (get_video_path, get_thumbnail_path, get_rendition_dir, get_result_rendition_dir,
+                             get_result_video_path, get_result_thumbnail_path, VIDEO_FORMATS)
+from backend.config import RESULT_CACHE_MAX_MB, RESULT_CACHE_MAX_AGE_DAYS
+
+logger = get_logger(__name__)
+redis = get_redis_client()
+
+RENDER_CACHE_VERSION = 2        # Bump when rendering changes so old results are not reused
+EXECUTION_PARAMS = ("workers", "segments")  # Change how a render runs, not what it produces
+INFLIGHT_TTL = 24 * 3600        # seconds
+METRICS_KEY = "render_cache:metrics"
+LAST_USED_KEY = "render_cache:last_used"   # Sorted set: render key -> last use (Unix time)
+CONTENT_HASH_TTL = 7 * 86400    # seconds
+
+def render_key(fit_sha256: str, params: dict) -> str:
+    """
+    Returns the render key for a FIT content hash and animation parameters.
+    """
+    normalized = {k: v for k, v in params.items() if k not in EXECUTION_PARAMS}
+    payload = json.dumps({"version": RENDER_CACHE_VERSION, "fit": fit_sha256, "params": normalized},
+                         sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _link(src: Path, dst: Path):
+    """
+    Atomically places src at dst as a hard link, or as a copy across file systems.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f"{dst.name}.tmp-{uuid4()}")    # Unique per call: threads may link the same key
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # Renaming onto a hard link of the same file does nothing and leaves tmp behind
+        tmp.unlink(missing_ok=True)
+
+def rendition_files(renditions) -> list:
+    """
+    Returns the file names of rendition specs (dicts with name and output_format).
+    """
+    return [f"{r['name']}.{r.get('output_format', 'mp4')}" for r in renditions or ()]
+
+def link_cached_result(key: str, ticket_id, output_format: str = "mp4", renditions=()) -> bool:
+    """
+    Links a cached result into the ticket's video, thumbnail and rendition paths.
+    Returns False, leaving the ticket's files untouched, when no complete result is cached under the key.
+    """
+    rendition_dir = get_rendition_dir(ticket_id)
+    links = [(get_result_video_path(key, output_format), get_video_path(ticket_id, output_format)),
+             (get_result_thumbnail_path(key), get_thumbnail_path(ticket_id))]
+    links += [(get_result_rendition_dir(key) / name, rendition_dir / name) for name in rendition_files(renditions)]
+    if not all(src.exists() for src, _ in links):
+        return False
+    shutil.rmtree(rendition_dir, ignore_errors=True)    # Renditions of an earlier request
+    try:
+        for src, dst in links:
+            _link(src, dst)
+    except FileNotFoundError:
+        # Evicted while linking: leave no mix of old and cached files for the render that follows
+        for _, dst in links:
+            dst.unlink(missing_ok=True)
+        return False
+    touch(key)
+    logger.info(f"Render cache hit: {key} -> {ticket_id}")
+    return True
+
+def store_result(key: str, ticket_id, output_format: str = "mp4", renditions=()):
+    """
+    Adds the ticket's finished video, thumbnail and renditions to the cache, then applies eviction.
+    """
+    # The video goes last: an entry counts as present once its video exists
+    _link(get_thumbnail_path(ticket_id), get_result_thumbnail_path(key))
+    for name in rendition_files(renditions):
+        _link(get_rendition_dir(ticket_id) / name, get_result_rendition_dir(key) / name)
+    _link(get_video_path(ticket_id, output_format), get_result_video_path(key, output_format))
+    touch(key)
+    record("stored")
+    logger.info(f"Render cache stored: {ticket_id} -> {key}")
+    evict()
+
+def touch(key: str):
+    """
+    Records that the entry under key was used now.
+    """
+    redis.zadd(LAST_USED_KEY, {key: time.time()})
+
+def _result_videos():
+    """
+    Returns the cached result videos of every output format.
+    """
+    directory = get_result_video_path("_").parent
+    return [path for path in directory.glob("*.*") if path.suffix[1:] in VIDEO_FORMATS]
+
+def evict(max_bytes: int = RESULT_CACHE_MAX_MB * 1024 * 1024,
+          max_age: float = RESULT_CACHE_MAX_AGE_DAYS * 86400):
+    """
+    Removes entries unused for longer than max_age seconds, then the least recently
+    used entries until the cache fits in max_bytes.
+    """
+    last_used = dict(redis.zrange(LAST_USED_KEY, 0, -1, withscores=True))
+    entries = []
+    for video in _result_videos():
+        thumbnail = get_result_thumbnail_path(video.stem)
+        renditions = get_result_rendition_dir(video.stem)
+        try:
+            stat = video.stat()
+            size = stat.st_size + (thumbnail.stat().st_size if thumbnail.exists() else 0)
+            size += sum(p.stat().st_size for p in renditions.glob("*"))
+        except FileNotFoundError:
+            continue    # Evicted concurrently
+        # Entries stored before last-use tracking fall back to when they were stored
+        entries.append((last_used.get(video.stem, stat.st_mtime), size, video, thumbnail, renditions))
+    entries.sort(key=lambda e: e[0])
+
+    total = sum(e[1] for e in entries)
+    cutoff = time.time() - max_age
+    evicted = freed = 0
+    for used, size, video, thumbnail, renditions in entries:
+        if used >= cutoff and total <= max_bytes:
+            break
+        video.unlink(missing_ok=True)
+        thumbnail.unlink(missing_ok=True)
+        shutil.rmtree(renditions, ignore_errors=True)
+        redis.zrem(LAST_USED_KEY, video.stem)
+        total -= size
+        freed += size
+        evicted += 1
+    if evicted:
+        record("evicted", evicted)
+        record("evicted_bytes", freed)
+        logger.info(f"Render cache evicted {evicted} entries ({freed / 2**20:.1f} MiB)")
+
+def make_content_hash_key(stat: os.stat_result) -> str:
+    """
+    Generates the Redis key holding the content hash of one version of a file.
+    A rewritten file gets a new key; hard links share one.
+    """
+    return f"content_sha256:{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def content_sha256(path: Path) -> str:
+    """
+    Returns the hex SHA-256 of a finished file, hashing it only once per file version.
+    Raises FileNotFoundError when the file does not exist.
+    """
+    redis_key = make_content_hash_key(os.stat(path))
+    digest = redis.get(redis_key)
+    if digest is None:
+        digest = file_sha256(path)
+        redis.set(redis_key, digest, ex=CONTENT_HASH_TTL)
+    return digest
+
+def make_inflight_key(key: str) -> str:
+    """
+    Generates the Redis key holding the job ID rendering a render key.
+    """
+    return f"render_cache:inflight:{key}"
+
+def claim_inflight(key: str, job_id: str):
+    """
+    Records job_id as the render for key unless another job holds it.
+    Returns None when claimed, otherwise the job ID holding the key.
+    """
+    redis_key = make_inflight_key(key)
+    if redis.set(redis_key, job_id, nx=True, ex=INFLIGHT_TTL):
+        return None
+    return redis.get(redis_key)
+
+def replace_inflight(key: str, job_id: str):
+    """
+    Records job_id as the render for key, replacing a finished or failed job.
+    """
+    redis.set(make_inflight_key(key), job_id, ex=INFLIGHT_TTL)
+
+def release_inflight(key: str, job_id: str):
+    """
+    Forgets job_id as the render for key, unless another job has replaced it since.
+    """
+    redis_key = make_inflight_key(key)
+    with redis.pipeline() as pipe:
+        try:
+            pipe.watch(redis_key)
+            if pipe.get(redis_key) != job_id:
+                return
+            pipe.multi()
+            pipe.delete(redis_key)
+            pipe.execute()
+        except WatchError:
+            pass    # Replaced concurrently
+
+def record(metric: str, amount: int = 1):
+    """
+    Increments a render cache counter.
+    """
+    redis.hincrby(METRICS_KEY, metric, amount)
+
+def stats() -> dict:
+    """
+    Returns the render cache counters with the current number of entries and bytes.
+    """
+    counters = {name: 0 for name in ("hits", "misses", "attached", "stored", "evicted", "evicted_bytes")}
+    counters.update({k: int(v) for k, v in redis.hgetall(METRICS_KEY).items()})
+    videos = _result_videos()
+    counters["entries"] = len(videos)
+    counters["bytes"] = sum(p.stat().st_size for p in videos if p.exists())
+    return counters
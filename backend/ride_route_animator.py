@@ -1,19 +1,33 @@
 import argparse
 import os
 import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+import numpy as np
 from fitparse import FitFile
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from matplotlib.animation import PillowWriter
-from matplotlib.animation import FFMpegWriter
-from geopy.distance import geodesic
-from pyproj import Transformer
-import geopandas as gpd
-from shapely.geometry import LineString
-import contextily as ctx
-from scipy.signal import savgol_filter
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.animation import adjusted_figsize
 from pathlib import Path
 
+from backend.geometry import cumulative_distances, to_web_mercator, smooth_elevations, DISTANCE_MODES
+from backend.track import Track, SEMICIRCLES_TO_DEGREES
+from backend.fit_decoder import decode_fit_records, UnsupportedFitError
+from backend.stats import compute_stats, RideStats
+from backend.geometry_cache import geometry_key, load_geometry, save_geometry
+from backend.compositor import FrameCompositor
+from backend.schedule import (SCHEDULES, frame_budget, index_positions, time_positions,
+                              build_frame_table, collapse_stops)
+from backend.video_writer import (open_frame_writer, concat_segments, save_thumbnail, MAX_HELD_FRAMES,
+                                  IMAGE_SUFFIXES, ENCODING_PROFILES)
+from backend.tile_cache import TileCache, resolve_tile_provider, add_basemap, parse_zoom
+
+PREVIEW_GAP_PX = 4  # White gap between preview keyframes
+MAX_PLOT_POINTS = 50_000    # Longer tracks are thinned for the route line and profile plots
+
 class RideRouteAnimator:
     def __init__(self, input_path: Path, output_path: Path, *, logger=None, **kwargs):
         
@@ -22,8 +36,10 @@ class RideRouteAnimator:
 
         self.input_path = input_path    # Input FIT file
         self.output_path = output_path  # Output video file
+        self.renditions = kwargs.get("renditions") or []  # Further outputs as (path, height) pairs, encoded from the same frames (height None: rendered size)
         self.dpi = kwargs.get("dpi", 100)   # Output video DPI
-        self.zoom = kwargs.get("zoom", 13)  # Tile zoom level
+        self.zoom = kwargs.get("zoom", 13)  # Tile zoom level or "auto" (match the output resolution)
+        self.max_tiles = kwargs.get("max_tiles", 150)  # Tile budget; the zoom is lowered to stay within it (0: no limit)
         self.fps = kwargs.get("fps", 10)    # Animation frame rate
         self.tile = kwargs.get("tile", "OpenStreetMap.Mapnik")  # Tile provider
         self.no_elevation_smoothing = kwargs.get("no_elevation_smoothing", False)   # Disable elevation smoothing
@@ -31,29 +47,63 @@ class RideRouteAnimator:
         self.title = kwargs.get("title", "")    # Title text
         self.start_frame = kwargs.get("start_frame", 0) # Start frame index
         self.end_frame = kwargs.get("end_frame", 0) # End frame index
-        self.step_frame = kwargs.get("step_frame", 10)  # Frame step interval
+        self.step_frame = kwargs.get("step_frame", 10)  # Frame step: records (index schedule) or ride seconds (time schedule)
+        self.target_duration = kwargs.get("target_duration")  # Video length in seconds; overrides step_frame (None: use step_frame)
+        self.schedule = kwargs.get("schedule", "time")  # Frame schedule: uniform ride-time steps (time) or record steps (index)
+        self.max_frames = kwargs.get("max_frames")  # Frame cap bounding the render cost (None: no cap)
+        self.collapse_stops = kwargs.get("collapse_stops")  # Video seconds each stop is shortened to (None: keep stops)
+        self.reuse_frames = kwargs.get("reuse_frames", True)  # Render runs of identical frames once and hold them (variable frame rate)
+        self.distance_mode = kwargs.get("distance_mode", "geodesic")  # Distance accuracy mode
+        self.fit_decoder = kwargs.get("fit_decoder", "fast")  # FIT decoder (fast or fitparse)
+        self.check_crc = kwargs.get("check_crc", True)  # Verify the FIT file CRC (off when validated on upload)
+        self.encoder_queue = kwargs.get("encoder_queue", 8)  # Frames buffered for the encoder thread (0: synchronous)
+        self.encoding_profile = kwargs.get("encoding_profile", "standard")  # Encoder speed/size trade-off (draft, standard or archival)
+        self.encoder_threads = kwargs.get("encoder_threads", 0)  # ffmpeg encoder threads (0: default; shared by parallel workers)
+        self.workers = kwargs.get("workers", 1)  # Parallel render processes (1: render in-process)
+        self.tile_cache = kwargs.get("tile_cache")  # Tile cache database path (None: download every tile)
+        self.tile_cache_mb = kwargs.get("tile_cache_mb", 1024)  # Tile cache size cap in MiB
+        self.geometry_cache = kwargs.get("geometry_cache")  # Geometry cache file path (None: always parse the FIT file)
+        self.fit_sha256 = kwargs.get("fit_sha256")  # Known SHA-256 of the FIT file for the geometry cache key (None: hash the file)
+        self.thumbnail_path = kwargs.get("thumbnail_path")  # Thumbnail image (.jpg/.webp/.png) saved while rendering (None: no thumbnail)
+        self.thumbnail_time = kwargs.get("thumbnail_time")  # Thumbnail position in seconds into the video (None: middle frame)
+        self.thumbnail_width = kwargs.get("thumbnail_width", 512)  # Thumbnail width in pixels
         
-        self.track = []             # Parsed FIT records
-        self.points = []            # (lat, lon) tuples
-        self.times = []             # Timestamps
-        self.alts = []              # Altitudes
-        self.speeds = []            # Speeds in m/s
-        self.hr = []                # Heart rate values
-        self.cad = []               # Cadence values
-        self.distances = []         # Cumulative distances in meters
-        self.merc_x = []            # X coordinates in Web Mercator
-        self.merc_y = []            # Y coordinates in Web Mercator
-        self.elevations = []        # Smoothed elevation values
-        self.sampled_distances = [] # Distances used for elevation plot
+        self.track = None           # Parsed FIT records (columnar Track)
+        self.distances = None       # Cumulative distances in meters
+        self.merc_x = None          # X coordinates in Web Mercator
+        self.merc_y = None          # Y coordinates in Web Mercator
+        self.elevations = None      # Smoothed elevation values
+        self.sampled_distances = None # Distances in km used for elevation plot
+        self.basemap = None         # Zoom and tile counts of the last rendered basemap
+        self.frames = None          # Scheduled frames with their interpolated values (FrameTable)
+        self.thumbnail_at = None    # Frame captured as the thumbnail during rendering
+        self.thumbnail_saved = False  # Whether this run has saved the thumbnail
 
     def load_fit(self):
         """Load FIT file and extract relevant data fields"""
+        self.track = None
+        if self.fit_decoder == "fast":
+            try:
+                self.track = decode_fit_records(self.input_path, check_crc=self.check_crc)
+            except UnsupportedFitError as e:
+                self.logger.info(f"Fast FIT decoder cannot handle this file ({e}), falling back to fitparse")
+        if self.track is None:
+            self.track = self._load_fit_fitparse()
+
+        if len(self.track) == 0:
+            self.logger.error("No valid track points found in FIT file.")
+            raise RuntimeError("No valid track points found in FIT file.")
+        self.logger.debug(f"Loaded {len(self.track)} records ({self.track.nbytes / 1024:.0f} KiB)")
+
+    def _load_fit_fitparse(self):
+        """Load record messages with fitparse (reference decoder)"""
         try:
             fitfile = FitFile(str(self.input_path))
         except Exception as e:
             self.logger.error(f"Failed to read FIT file: {e}")
             raise RuntimeError(f"Failed to read FIT file: {e}")
 
+        times, lats, lons, alts, speeds, hrs, cads = [], [], [], [], [], [], []
         for record in fitfile.get_messages('record'):
             try:
                 lat_raw = record.get_value('position_lat')
@@ -65,174 +115,150 @@ class RideRouteAnimator:
                 cad     = record.get_value('cadence')     # rpm
 
                 if None not in (lat_raw, lon_raw, alt, time):
-                    '''
-                    In Garmin's FIT format, GPS coordinates are recorded in units called "semicircles."
-                    These are integer values ​​that represent the entire Earth on the following scale:
-                    2^31 semicircles = 180 degrees (a hemisphere)
-                    '''
-                    lat = lat_raw * (180 / 2**31)
-                    lon = lon_raw * (180 / 2**31)
-                    self.track.append({'lat': lat, 'lon': lon, 'alt': alt, 'time': time})
-                    self.speeds.append(speed)
-                    self.hr.append(hr)
-                    self.cad.append(cad)
+                    times.append(time)
+                    lats.append(lat_raw * SEMICIRCLES_TO_DEGREES)
+                    lons.append(lon_raw * SEMICIRCLES_TO_DEGREES)
+                    alts.append(alt)
+                    speeds.append(speed)
+                    hrs.append(hr)
+                    cads.append(cad)
             except Exception as e:
                 self.logger.warning(f"Skipping malformed record: {e}")
 
-        if not self.track:
-            self.logger.error("No valid track points found in FIT file.")
-            raise RuntimeError("No valid track points found in FIT file.")
+        return Track.from_columns(times, lats, lons, alts, speeds, hrs, cads)
     
-    def compute_moving_time(self):
-        """Calculate moving time using time delta and speed threshold"""
-        moving_time = 0
-        speed_threshold = 2.0  # m/s ≈ 7.2 km/h
-
-        for i in range(1, len(self.track)):
-            speed = self.speeds[i]
-            if speed and speed > speed_threshold:
-                t1 = self.track[i-1]['time']
-                t2 = self.track[i]['time']
-                delta = (t2 - t1).total_seconds()
-                moving_time += delta
-        return moving_time
-
-    def compute_elevation_gain(self):
-        """Calculate elevation gain with minimum segment length and gradient filtering"""
-        # Basic elevation gain calculation (commented out)
-        # self.elevation_gain = sum(
-        #     max(self.elevations[i] - self.elevations[i-1], 0)
-        #     for i in range(1, len(self.elevations))
-        #     if abs(self.elevations[i] - self.elevations[i-1]) > 3
-        # )
-        gain = 0
-        accum_elev = 0
-        accum_dist = 0
-        min_segment = 100 # meters
-        min_gradient = 0.005    # 0.5%
-
-        for i in range(1, len(self.elevations)):
-            delta_elev = self.elevations[i] - self.elevations[i-1]
-            delta_dist = self.distances[i] - self.distances[i-1]
-
-            accum_dist += delta_dist
-            accum_elev += delta_elev
-                
-            if accum_dist >= min_segment:
-                gradient = accum_elev / accum_dist
-                if gradient >= min_gradient:
-                    gain += accum_elev
-                accum_elev = 0
-                accum_dist = 0
-        return gain 
-
     def compute_geometry(self):
         """Compute distances, coordinate transformation, elevation smoothing, and summary statistics"""
-        self.points = [(d['lat'], d['lon']) for d in self.track]
-        self.times  = [d['time'] for d in self.track]
-        self.alts   = [d['alt']  for d in self.track]
-
-        # Calculate cumulative distance between each point
-        self.distances = [0.0]
-        for i in range(1, len(self.points)):
-            d = geodesic(self.points[i-1], self.points[i]).meters
-            self.distances.append(self.distances[-1] + d)
-
-        # Convert coordinates to Web Mercator (EPSG:3857)
-        transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-        self.merc_x, self.merc_y = zip(*[
-            transformer.transform(lon, lat) for lat, lon in self.points
-        ])
+        track = self.track
+
+        # Calculate cumulative distance between each point in one batched call
+        self.distances = cumulative_distances(track.lat, track.lon, mode=self.distance_mode)
+
+        # Convert coordinates to Web Mercator (EPSG:3857), shared by the marker and route line
+        self.merc_x, self.merc_y = to_web_mercator(track.lat, track.lon)
 
          # Apply elevation smoothing unless disabled
         if self.no_elevation_smoothing:
-            self.elevations = self.alts
+            self.elevations = track.alt
         else:
             try:
-                self.elevations = savgol_filter(self.alts, window_length=11, polyorder=2)
+                self.elevations = smooth_elevations(track.alt)
             except Exception as e:
                 self.logger.warning(f"Elevation smoothing failed: {e}")
-                self.elevations = self.alts
+                self.elevations = track.alt
 
         # Compute summary statistics
-        self.total_time = (self.times[-1] - self.times[0]).total_seconds()
-        self.moving_time = self.compute_moving_time()
-        
+        self.set_stats(compute_stats(track, self.distances, self.elevations))
+
+    def set_stats(self, stats):
+        """Store summary statistics and the values shown in the overlay"""
+        self.stats = stats
+        self.total_time = self.stats.total_time
+        self.moving_time = self.stats.moving_time
+
         self.logger.debug(f"Total time: {self.total_time/60:.1f} min")
         self.logger.debug(f"Moving time: {self.moving_time/60:.1f} min")
-        
-        self.elevation_gain = self.compute_elevation_gain()
-        self.avg_speed_kmh = (self.distances[-1] / self.moving_time) * 3.6
-        self.avg_hr = self._average_nonzero(self.hr)
-        self.avg_cad = self._average_nonzero(self.cad)
-
-    def _average_nonzero(self, values):
-        """Calculate average of non-zero values"""
-        valid = [v for v in values if v]
-        return sum(valid) / len(valid) if valid else 0
-    
-    def render_animation(self):
-        """Render map, elevation graph, animation frames, and save as video"""
-        # Create LineString geometry from GPS points
-        line = LineString([(lon, lat) for lat, lon in self.points])
-        gdf = gpd.GeoDataFrame(geometry=[line], crs="EPSG:4326").to_crs(epsg=3857)
-        bounds = gdf.total_bounds
 
-        # Create figure and subplots for map and elevation
-        figsize= (12, 9)
+        self.elevation_gain = self.stats.elevation_gain
+        self.avg_speed_kmh = self.stats.avg_speed_kmh
+        self.avg_hr = self.stats.avg_hr
+        self.avg_cad = self.stats.avg_cad
+
+    def prepare(self):
+        """Load the track, geometry and statistics from the geometry cache, or compute and cache them"""
+        key = None
+        if self.geometry_cache:
+            try:
+                key = geometry_key(self.input_path, self.no_elevation_smoothing, self.distance_mode,
+                                   self.fit_sha256)
+            except OSError as e:
+                self.logger.warning(f"Cannot hash {self.input_path} for the geometry cache: {e}")
+
+        cached = key and load_geometry(self.geometry_cache, key)
+        if cached:
+            arrays, meta = cached
+            self.track = Track(**{f.name: arrays[f.name] for f in fields(Track)})
+            self.distances = arrays["distances"]
+            self.merc_x = arrays["merc_x"]
+            self.merc_y = arrays["merc_y"]
+            self.elevations = arrays["elevations"]
+            self.set_stats(RideStats.from_dict(meta["stats"]))
+            self.logger.info(f"Loaded {len(self.track)} records from geometry cache {self.geometry_cache}")
+            return
+
+        self.load_fit()
+        self.compute_geometry()
+        if key:
+            arrays = {f.name: getattr(self.track, f.name) for f in fields(Track)}
+            arrays.update(distances=self.distances, merc_x=self.merc_x, merc_y=self.merc_y,
+                          elevations=self.elevations)
+            try:
+                save_geometry(self.geometry_cache, key, arrays, {"stats": self.stats.to_dict()})
+            except OSError as e:
+                self.logger.warning(f"Failed to save geometry cache {self.geometry_cache}: {e}")
+
+    def build_compositor(self, dpi=None):
+        """Render the static map and elevation layers once and return a FrameCompositor"""
+        dpi = dpi or self.dpi
+
+        # Create figure and subplots for map and elevation.
+        # A standalone Figure (not pyplot) keeps concurrent preview renders independent.
+        # yuv420p needs even frame sizes; trim to the nearest even pixel size like FFMpegWriter did
+        figsize = adjusted_figsize(12, 9, dpi, 2)
         height_ratios = (10, 2)
-        fig, (ax_map, ax_elev) = plt.subplots(2, 1, figsize=figsize,
-            gridspec_kw={'height_ratios': height_ratios})
-        fig.set_dpi(self.dpi)
-        plt.subplots_adjust(hspace=0)
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        ax_map, ax_elev = fig.subplots(2, 1, gridspec_kw={'height_ratios': height_ratios})
+        fig.subplots_adjust(hspace=0)
         fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.05)
 
         # Plot route line on map
-        gdf.plot(ax=ax_map, linewidth=2, color='blue')
-
-        # Add margin around route bounds
-        x_margin = (bounds[2] - bounds[0]) * 0.01
-        y_margin = (bounds[3] - bounds[1]) * 0.01
-        ax_map.set_xlim(bounds[0] - x_margin, bounds[2] + x_margin)
-        ax_map.set_ylim(bounds[1] - y_margin, bounds[3] + y_margin)
-                
+        plotted = self.plot_indices()
+        ax_map.plot(self.merc_x[plotted], self.merc_y[plotted], linewidth=2, color='blue')
+        ax_map.set_aspect('equal')
+
+        # Show the route bounds with a margin
+        xmin, ymin, xmax, ymax = self.map_bounds()
+        ax_map.set_xlim(xmin, xmax)
+        ax_map.set_ylim(ymin, ymax)
+
         # Hide axis ticks and labels
         ax_map.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
 
-        # Load background tile map
+        # Load background tile map, reusing tiles cached by earlier renders
         try:
-            provider = self.tile.split(".")
-            tile_source = getattr(ctx.providers[provider[0]], provider[1])
-            ctx.add_basemap(ax_map, source=tile_source,
-                            zoom=self.zoom, reset_extent=False)
+            provider = resolve_tile_provider(self.tile)
+            # Resolve the zoom against the final output size, also for low-DPI previews
+            self.basemap = add_basemap(ax_map, self.zoom, provider, self.open_tile_cache(), self.max_tiles,
+                                       output_scale=self.dpi / dpi)
+            self.logger.info(f"Basemap: {self.basemap['tiles']} tiles at zoom {self.basemap['zoom']} "
+                             f"(requested {self.zoom}; {self.basemap['hits']} cached, "
+                             f"{self.basemap['misses']} downloaded)")
         except Exception as e:
             self.logger.error(f"Failed to load tile provider '{self.tile}': {e}")
             raise RuntimeError(f"Failed to load tile provider '{self.tile}': {e}")
 
-        # Initialize route marker
-        marker, = ax_map.plot([], [], 'ro')
-
         # Plot elevation profile
-        self.sampled_distances = [d / 1000 for d in self.distances]
-        ax_elev.plot(self.sampled_distances, self.elevations, color='gray')
-        ax_elev.fill_between(self.sampled_distances, self.elevations, color='gray', alpha=0.3)
+        self.sampled_distances = self.distances / 1000
+        profile_km = self.sampled_distances[plotted]
+        ax_elev.plot(profile_km, self.elevations[plotted], color='gray')
+        ax_elev.fill_between(profile_km, self.elevations[plotted], color='gray', alpha=0.3)
         ax_elev.set_ylabel("Elevation (m)", fontsize=10)
         ax_elev.set_xlabel("Distance (km)")
         ax_elev.tick_params(axis='both', labelsize=8)
         ax_elev.grid(True, linestyle='--', alpha=0.5)
-        ax_elev.set_xlim(min(self.sampled_distances), max(self.sampled_distances))
-        
+        ax_elev.set_xlim(self.sampled_distances[0], self.sampled_distances[-1])
+
         # Plot speed profile
         ax_speed = ax_elev.twinx()
-        speeds_kmh = [s * 3.6 if s else 0 for s in self.speeds]
-        ax_speed.plot(self.sampled_distances, speeds_kmh, color='blue', alpha=0.5)
+        speeds_kmh = self.track.speed[plotted] * 3.6
+        ax_speed.plot(profile_km, speeds_kmh, color='blue', alpha=0.5)
         ax_speed.set_ylabel("Speed (km/h)", fontsize=10)
         ax_speed.tick_params(axis='y', labelsize=8, labelcolor='blue')
-        
-        elev_cursor = ax_elev.axvline(x=0, color='red')
+
         ax_map.set_title(self.title, fontsize=14, pad=5)
-        
-        # Determine overlay text position
+
+        # Determine overlay text position; the text itself is drawn per frame by the compositor
         positions = {
             "top-left":     (0.01, 0.90),
             "top-right":    (0.75, 0.90),
@@ -240,78 +266,242 @@ class RideRouteAnimator:
             "bottom-right": (0.75, 0.05),
         }
         x, y = positions[self.overlay_style]
-        info_text = ax_map.text(x, y, "", transform=ax_map.transAxes,
+        if self.frames is None:
+            self.schedule_frames()
+        info_text = ax_map.text(x, y, self.frame_text(0), transform=ax_map.transAxes,
                                 fontsize=10, color="white",
                                 bbox=dict(facecolor="black", alpha=0.5))
 
-        def update(frame):
-            # Update route marker and elevation cursor
-            marker.set_data([self.merc_x[frame]], [self.merc_y[frame]])
-            d = self.sampled_distances[frame]
-            elev_cursor.set_xdata([d, d])
-
-            # Extract current metrics
-            speed_kmh = self.speeds[frame] * 3.6 if self.speeds[frame] else 0
-            elevation = self.elevations[frame]
-            hr        = self.hr[frame] if self.hr[frame] else "-"
-            cad       = self.cad[frame] if self.cad[frame] else "-"
-
-            # Update overlay text
-            info_text.set_text(
-                f"Speed: {speed_kmh:.1f} km/h\n"
-                f"Elevation: {elevation:.1f} m\n"
-                f"HR: {hr} bpm\n"
-                f"Cadence: {cad} rpm\n"
-                f"Distance: {d:.2f} km\n"
-                f"Elevation Gain: {self.elevation_gain:.1f} m\n"
-                f"Avg Speed: {self.avg_speed_kmh:.1f} km/h\n"
-                f"Avg HR: {self.avg_hr:.0f} bpm\n"
-                f"Avg Cadence: {self.avg_cad:.0f} rpm"
-            )
-            return marker, elev_cursor, info_text
-        
-        # Determine frame range and step
+        # The compositor is indexed by frame number, with marker and cursor at the interpolated positions
+        return FrameCompositor.from_figure(fig, ax_map, ax_elev, info_text,
+                                           self.frames.merc_x, self.frames.merc_y, self.frames.distance / 1000, dpi)
+
+    def plot_indices(self):
+        """Track points drawn by the route line and profile plots: all of them, or an
+        evenly thinned subset (always keeping the last point) for very long tracks"""
+        n = len(self.track)
+        if n <= MAX_PLOT_POINTS:
+            return slice(None)
+        step = -(-n // MAX_PLOT_POINTS)
+        return np.r_[0:n - 1:step, n - 1]
+
+    def map_bounds(self):
+        """Return the Web Mercator map view (xmin, ymin, xmax, ymax): route bounds plus a 1% margin"""
+        xmin, xmax = self.merc_x.min(), self.merc_x.max()
+        ymin, ymax = self.merc_y.min(), self.merc_y.max()
+        x_margin = (xmax - xmin) * 0.01
+        y_margin = (ymax - ymin) * 0.01
+        return (xmin - x_margin, ymin - y_margin, xmax + x_margin, ymax + y_margin)
+
+    def open_tile_cache(self):
+        """Open the shared tile cache, or return None when caching is disabled or unavailable"""
+        if not self.tile_cache:
+            return None
+        try:
+            return TileCache(self.tile_cache, self.tile_cache_mb * 1024 * 1024)
+        except Exception as e:
+            self.logger.warning(f"Tile cache {self.tile_cache} unavailable, downloading tiles: {e}")
+            return None
+
+    def frame_text(self, frame):
+        """Build the overlay text for a scheduled frame"""
+        # Extract current metrics
+        speed_kmh = self.frames.speed[frame] * 3.6
+        elevation = self.frames.elevation[frame]
+        hr        = self.frames.hr[frame] or "-"
+        cad       = self.frames.cad[frame] or "-"
+        d         = self.frames.distance[frame] / 1000
+        paused    = self.frames.paused[frame]
+
+        # A collapsed stop is labelled with its length on the speed line, keeping the line count fixed
+        stop = ""
+        if paused > 0:
+            minutes, seconds = divmod(int(round(paused)), 60)
+            stop = f" (stop {minutes}:{seconds:02d})"
+
+        return (
+            f"Speed: {speed_kmh:.1f} km/h{stop}\n"
+            f"Elevation: {elevation:.1f} m\n"
+            f"HR: {hr} bpm\n"
+            f"Cadence: {cad} rpm\n"
+            f"Distance: {d:.2f} km\n"
+            f"Elevation Gain: {self.elevation_gain:.1f} m\n"
+            f"Avg Speed: {self.avg_speed_kmh:.1f} km/h\n"
+            f"Avg HR: {self.avg_hr:.0f} bpm\n"
+            f"Avg Cadence: {self.avg_cad:.0f} rpm"
+        )
+
+    def frame_state(self, frame):
+        """Return what distinguishes a frame's overlay for holding unchanged frames:
+        the displayed speed and stop label. Heart rate, cadence and elevation that
+        drift while the marker stands still do not start a new frame."""
+        speed_kmh = round(float(self.frames.speed[frame]) * 3.6, 1)
+        return speed_kmh, int(round(self.frames.paused[frame]))
+
+    def frame_positions(self):
+        """Determine the fractional track positions rendered as frames.
+        step_frame counts records (index schedule) or ride seconds (time schedule) per frame;
+        target_duration and max_frames set and cap the frame count."""
         start = max(0, self.start_frame)
-        end = self.end_frame if self.end_frame > 0 else len(self.points)
-        end = min(end, len(self.points))
+        end = self.end_frame if self.end_frame > 0 else len(self.track)
+        end = min(end, len(self.track))
         step = max(1, self.step_frame)
+        target, cap = frame_budget(self.fps, self.target_duration, self.max_frames)
 
         if start >= end:
             self.logger.error(f"Invalid frame range: start={start}, end={end}")
             raise RuntimeError(f"Invalid frame range: start={start}, end={end}")
 
-        frames = range(start, end, step)
+        if self.schedule == "time":
+            return time_positions(self.track.time, start, end, step, target, cap)
+        if self.schedule == "index":
+            return index_positions(start, end, step, target, cap)
+        raise ValueError(f"Unknown schedule '{self.schedule}'. Expected one of {SCHEDULES}")
+
+    def schedule_frames(self):
+        """Schedule the frames and interpolate the values each one shows into self.frames"""
+        self.frames = build_frame_table(self.frame_positions(), self.track, self.distances,
+                                        self.merc_x, self.merc_y, self.elevations)
+        if self.collapse_stops:
+            count = len(self.frames)
+            self.frames = collapse_stops(self.frames, round(self.collapse_stops * self.fps))
+            self.logger.info(f"Collapsed stops: dropped {count - len(self.frames)} of {count} frames")
+        self.logger.info(f"Scheduled {len(self.frames)} frames ({self.schedule} schedule)")
+        return self.frames
+
+    def thumbnail_index(self):
+        """Frame shown in the thumbnail: the frame at thumbnail_time seconds into the video, or the middle frame"""
+        count = len(self.frames)
+        if self.thumbnail_time is None:
+            position = count // 2
+        else:
+            position = int(round(self.thumbnail_time * self.fps))
+        return min(max(position, 0), count - 1)
+
+    def frame_chunks(self, count):
+        """Split the frame numbers into `count` contiguous chunks (trailing chunks may be empty)"""
+        return np.array_split(np.arange(len(self.frames)), count)
+
+    def render_preview(self, count=3, dpi=40):
+        """Render `count` evenly spaced keyframes (start to end) at low DPI side by side.
+        Returns an RGB image; nothing is encoded or written."""
+        frames = np.arange(len(self.schedule_frames()))
+        keyframes = frames[np.linspace(0, len(frames) - 1, max(1, count)).round().astype(int)]
+        compositor = self.build_compositor(dpi=dpi)
+
+        gap = np.full((compositor.height, PREVIEW_GAP_PX, 3), 255, dtype=np.uint8)
+        images = []
+        for frame in keyframes:
+            images += [compositor.render(frame, self.frame_text(frame)), gap]
+        return np.hstack(images[:-1])
 
-        # Create and save animation
+    def render_animation(self):
+        """Render map, elevation graph, animation frames, and save as video"""
+        frames = np.arange(len(self.schedule_frames()))
+        self.thumbnail_at = self.thumbnail_index() if self.thumbnail_path else None
+        compositor = self.build_compositor()
+
+        # Composite each frame onto the static background and stream it to the writer
         try:
-            ani = animation.FuncAnimation(
-                fig, update,
-                frames=frames,
-                interval=int(1000 / self.fps),
-                blit=True
-            )          
-            
-            if self.output_path.suffix.lower() == ".gif":
-                writer = PillowWriter(fps=self.fps)
+            # Renditions are fanned out from one pass; segments would have to be joined per rendition
+            if self.workers > 1 and self.output_path.suffix.lower() not in IMAGE_SUFFIXES and not self.renditions:
+                self._render_parallel(compositor, frames)
             else:
-                writer = FFMpegWriter(fps=self.fps, codec="h264", bitrate=3000)
-            ani.save(self.output_path, writer=writer, dpi=self.dpi)
+                self._render_frames(compositor, frames, self.output_path)
             self.logger.info(f"Animation saved to: {self.output_path}")
+            for path, _ in self.renditions:
+                self.logger.info(f"Rendition saved to: {path}")
         except Exception as e:
             self.logger.error(f"Failed to save animation: {e}")
             raise RuntimeError(f"Failed to save animation: {e}")
 
+    def _render_frames(self, compositor, frames, output_path, segment=False, threads=None):
+        """Render the given frames into one output file.
+        Runs of frames that draw the marker and cursor at the same pixels with the same
+        displayed speed (frame_state) are composited once from their first frame and
+        written with the run's duration (reuse_frames).
+        Segments for concat_segments repeat held frames instead of timestamping them.
+        Outside segments, every rendition is encoded from the same rendered frames.
+        `threads` overrides encoder_threads."""
+        texts = [self.frame_text(frame) for frame in frames]
+        starts = np.arange(len(frames))
+        if self.reuse_frames and len(frames):
+            states = [(compositor.placement(frame), self.frame_state(frame)) for frame in frames]
+            starts = np.flatnonzero([i == 0 or states[i] != states[i - 1] for i in range(len(states))])
+        durations = np.diff(np.append(starts, len(frames)))
+
+        writer = open_frame_writer(output_path, compositor.width, compositor.height, self.fps,
+                                   profile=self.encoding_profile,
+                                   threads=self.encoder_threads if threads is None else threads,
+                                   queue_size=self.encoder_queue,
+                                   durations=durations if self.reuse_frames else None,
+                                   max_held=0 if segment else MAX_HELD_FRAMES,
+                                   renditions=() if segment else self.renditions)
+        try:
+            for start, duration in zip(starts, durations):
+                image = compositor.render(frames[start], texts[start])
+                if self.thumbnail_at in frames[start:start + duration]:
+                    # Capture the thumbnail from the buffer instead of decoding the video again
+                    save_thumbnail(image, self.thumbnail_path, self.thumbnail_width)
+                    self.thumbnail_saved = True
+                    self.logger.info(f"Thumbnail saved to: {self.thumbnail_path}")
+                writer.write(image)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        self.logger.info(f"Rendered {len(starts)} of {len(frames)} frames "
+                         f"({len(frames) - len(starts)} unchanged frames held)")
+
+    def _render_parallel(self, compositor, frames):
+        """Render contiguous frame chunks as separate segments in a process pool and join them"""
+        chunks = [chunk for chunk in self.frame_chunks(self.workers) if chunk.size]
+        # Each worker's encoder gets its share of the cores instead of one thread per core each
+        threads = self.encoder_threads or max(1, (os.cpu_count() or 1) // self.workers)
+        self.logger.info(f"Rendering {len(frames)} frames in {len(chunks)} segments with {self.workers} workers "
+                         f"({threads} encoder threads each)")
+
+        with tempfile.TemporaryDirectory(dir=self.output_path.parent) as tmp:
+            segment_paths = [Path(tmp) / f"segment_{i:04d}{self.output_path.suffix}" for i in range(len(chunks))]
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(_render_segment, self, compositor, chunk, path, threads)
+                           for chunk, path in zip(chunks, segment_paths)]
+                for future in futures:
+                    future.result()
+            concat_segments(segment_paths, self.output_path)
+
     def run(self):
         """Execute the full animation workflow"""
-        self.logger.info(f"Loading FIT file {self.input_path}...")
-        self.load_fit()
-        self.logger.info("Computing geometry and statistics...")
-        self.compute_geometry()
+        self.logger.info(f"Loading FIT file {self.input_path} and computing geometry and statistics...")
+        self.prepare()
         self.logger.info("Rendering and saving animation...")
         self.render_animation()
         
         return str(self.output_path)
 
+    def run_segment(self, index, count):
+        """Execute the workflow for one of `count` contiguous frame windows.
+        Returns the output path, or None when the window holds no frames."""
+        self.prepare()
+        self.schedule_frames()
+        self.thumbnail_at = self.thumbnail_index() if self.thumbnail_path else None
+        frames = self.frame_chunks(count)[index]
+        if not frames.size:
+            self.logger.info(f"Segment {index} of {count} has no frames")
+            return None
+        compositor = self.build_compositor()
+        try:
+            self._render_frames(compositor, frames, self.output_path, segment=True)
+        except Exception as e:
+            self.logger.error(f"Failed to save segment: {e}")
+            raise RuntimeError(f"Failed to save segment: {e}")
+        return str(self.output_path)
+
+def _render_segment(animator, compositor, frames, segment_path, threads=None):
+    """Process pool entry point: render one contiguous chunk of frames to a segment file"""
+    animator._render_frames(compositor, frames, segment_path, segment=True, threads=threads)
+    return segment_path
+
 def list_tile_providers():
     """Recursively list available tile providers from contextily.providers"""
     import contextily as ctx
@@ -337,6 +527,20 @@ def list_tile_providers():
     for t in sorted(tiles):
         print(f"  {t}")
 
+def parse_rendition(value):
+    """Parse a --rendition argument PATH[:HEIGHT] into a (path, height or None) pair"""
+    path, _, height = value.rpartition(":")
+    if path and height.isdigit():
+        return Path(path), int(height)
+    return Path(value), None
+
+def positive_int(value):
+    """Parse an integer argument that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def main():
     
     # Set logging level based on environment variable LOG_LEVEL (default: INFO)
@@ -347,11 +551,29 @@ def main():
     parser = argparse.ArgumentParser(description="Generate route animation from FIT file")
     parser.add_argument("-i", "--input", default="input.fit", help="Input FIT file")
     parser.add_argument("-o", "--output", default="output.mp4", help="Output MP4 file")
+    parser.add_argument("--rendition", dest="renditions", type=parse_rendition, action="append", default=[],
+                        metavar="PATH[:HEIGHT]",
+                        help="Also encode the frames into this file, scaled to HEIGHT pixels (repeatable; "
+                             "the suffix selects MP4, GIF or WebP)")
     parser.add_argument("--dpi", type=int, default=100, help="Output video DPI")
-    parser.add_argument("--zoom", type=int, default=13, help="Tile zoom level")
+    parser.add_argument("--zoom", type=parse_zoom, default=13,
+                        help="Tile zoom level, or 'auto' to match the output resolution")
+    parser.add_argument("--max-tiles", type=int, default=150,
+                        help="Tile budget; the zoom is lowered until the map needs at most this many tiles (0: no limit)")
     parser.add_argument("--fps", type=int, default=10, help="Animation frame rate")
     parser.add_argument("--tile", default="OpenStreetMap.Mapnik",
-                        help="Tile provider name for background map (e.g. OpenStreetMap.Mapnik)")
+                        help="Tile provider name (e.g. OpenStreetMap.Mapnik) or URL template with {z}/{x}/{y}")
+    parser.add_argument("--tile-cache", default=None,
+                        help="Tile cache database shared between runs (default: no cache)")
+    parser.add_argument("--geometry-cache", default=None,
+                        help="File caching the parsed track and geometry between runs (default: no cache)")
+    parser.add_argument("--thumbnail", dest="thumbnail_path", default=None,
+                        help="Also save a thumbnail image (.jpg, .webp or .png) captured while rendering")
+    parser.add_argument("--thumbnail-time", type=float, default=None,
+                        help="Thumbnail position in seconds into the video (default: middle frame)")
+    parser.add_argument("--thumbnail-width", type=int, default=512, help="Thumbnail width in pixels (default: 512)")
+    parser.add_argument("--tile-cache-mb", type=int, default=1024,
+                        help="Tile cache size cap in MiB; least recently used tiles are evicted")
     parser.add_argument("--no-elevation-smoothing", action="store_true",
                         help="Disable elevation smoothing")
     parser.add_argument("--overlay-style", default="bottom-right",
@@ -361,7 +583,28 @@ def main():
     parser.add_argument("--title", default="your ride route", help="Title to embed in the video")
     parser.add_argument("--start-frame", type=int, default=0,help="Start frame index (default: 0)")
     parser.add_argument("--end-frame", type=int, default=0, help="End frame index (default: 0 means full length)")
-    parser.add_argument("--step-frame", type=int, default=1,help="Frame step interval (default: 10 means every frame)")
+    parser.add_argument("--step-frame", type=int, default=1,help="Frame step: records (index schedule) or ride seconds (time schedule) per frame")
+    parser.add_argument("--schedule", choices=SCHEDULES, default="time",
+                        help="Frame schedule: uniform ride-time steps (time, default) or record steps (index)")
+    parser.add_argument("--max-frames", type=int, default=None, help="Cap on the number of frames rendered")
+    parser.add_argument("--collapse-stops", type=float, default=None,
+                        help="Shorten every stop to this many seconds of video, labelled with its length (default: keep stops)")
+    parser.add_argument("--no-frame-reuse", dest="reuse_frames", action="store_false",
+                        help="Composite and encode every frame, even when it is identical to the previous one")
+    parser.add_argument("--target-duration", type=float, default=None,
+                        help="Target video length in seconds; the frame step is derived from it (overrides --step-frame)")
+    parser.add_argument("--fit-decoder", default="fast", choices=["fast", "fitparse"],
+                        help="FIT decoder: fast (bulk record decoder, falls back to fitparse) or fitparse")
+    parser.add_argument("--encoder-queue", type=int, default=8,
+                        help="Frames buffered between the renderer and the ffmpeg encoder thread (0: encode synchronously)")
+    parser.add_argument("--profile", dest="encoding_profile", choices=ENCODING_PROFILES, default="standard",
+                        help="Encoding profile: draft (fastest), standard or archival (best quality)")
+    parser.add_argument("--encoder-threads", type=int, default=0,
+                        help="ffmpeg encoder threads (default: 0, ffmpeg's choice; split among --workers)")
+    parser.add_argument("--workers", type=positive_int, default=1,
+                        help="Render processes; frames are split into segments joined with ffmpeg concat (default: 1)")
+    parser.add_argument("--distance-mode", default="geodesic", choices=DISTANCE_MODES,
+                        help="Distance accuracy mode: geodesic (WGS84 ellipsoid) or haversine (faster, spherical)")
 
     args = parser.parse_args()
     
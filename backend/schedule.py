@@ -0,0 +1,140 @@
+"""
+Frame scheduling for ride animations.
+
+A schedule is an array of fractional track positions, one per video frame.
+"index" schedules step through records; "time" schedules step through ride time
+at a uniform interval, so playback speed does not depend on the logging rate.
+The values a frame shows (marker coordinates, overlay metrics) are interpolated
+between the neighbouring records for all frames at once.
+
+Long stops can be collapsed: runs of frames in which the rider barely moves are
+cut down to a few frames that are labelled with the length of the stop.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+
+SCHEDULES = ("time", "index")
+STOP_SPEED = 0.5    # m/s; frames advancing slower than this count as stopped
+
+@dataclass
+class FrameTable:
+    """
+    Per-frame values interpolated from the track. All arrays have one entry per frame.
+    """
+    position: np.ndarray    # float64, fractional track index
+    time: np.ndarray        # float64, ride seconds
+    merc_x: np.ndarray      # float64, Web Mercator meters
+    merc_y: np.ndarray      # float64, Web Mercator meters
+    distance: np.ndarray    # float64, meters from the start
+    elevation: np.ndarray   # float64, meters
+    speed: np.ndarray       # float64, m/s
+    hr: np.ndarray          # uint8, bpm of the nearest record (0: missing)
+    cad: np.ndarray         # uint16, rpm of the nearest record (0: missing)
+    paused: np.ndarray      # float64, seconds of the collapsed stop a frame stands for (0: none)
+
+    def __len__(self):
+        return len(self.position)
+
+def frame_budget(fps: int, target_duration=None, max_frames=None):
+    """
+    Returns (frames requested by target_duration or None, frame cap from max_frames or None).
+    """
+    target = max(1, round(target_duration * fps)) if target_duration else None
+    return target, (max(1, int(max_frames)) if max_frames else None)
+
+def index_positions(start: int, end: int, step: int, target=None, cap=None) -> np.ndarray:
+    """
+    Returns every step-th record in [start, end).
+    target replaces the step with one giving about that many frames; cap bounds the count.
+    """
+    count = end - start
+    if target:
+        step = -(-count // target)
+    if cap:
+        step = max(step, -(-count // cap))
+    return np.arange(start, end, max(1, step), dtype=np.float64)
+
+def time_positions(times, start: int, end: int, interval: float, target=None, cap=None) -> np.ndarray:
+    """
+    Returns the fractional positions of uniform ride-time ticks over records [start, end).
+    - interval: ride seconds between frames
+    - target: replace the interval with one giving exactly that many frames
+    - cap: widen the interval so there are at most that many frames
+    """
+    # Clocks can step back on some devices; keep the time axis non-decreasing
+    t = np.maximum.accumulate(np.asarray(times[start:end], dtype=np.float64))
+    span = t[-1] - t[0]
+    if target:
+        interval = span / max(1, target - 1)
+    if cap:
+        interval = max(interval, span / max(1, cap - 1))
+    count = int(span / interval + 1e-9) + 1 if span > 0 and interval > 0 else 1
+    ticks = t[0] + np.arange(count) * interval
+    return np.interp(ticks, t, np.arange(start, end, dtype=np.float64))
+
+def interpolate(values, positions) -> np.ndarray:
+    """
+    Linearly interpolates values at fractional indices (exact at whole indices).
+    """
+    values = np.asarray(values)
+    lo = np.floor(positions).astype(np.int64)
+    hi = np.minimum(lo + 1, len(values) - 1)
+    frac = positions - lo
+    base = values[lo].astype(np.float64)
+    return base + (values[hi] - base) * frac
+
+def nearest(values, positions) -> np.ndarray:
+    """
+    Returns the values of the records nearest to fractional indices.
+    """
+    return np.asarray(values)[np.rint(positions).astype(np.int64)]
+
+def build_frame_table(positions, track, distances, merc_x, merc_y, elevations) -> FrameTable:
+    """
+    Interpolates the values shown by each frame at the given track positions.
+    Heart rate and cadence come from the nearest record so gaps are not averaged with zeros.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    return FrameTable(
+        position=positions,
+        time=interpolate(track.time, positions),
+        merc_x=interpolate(merc_x, positions),
+        merc_y=interpolate(merc_y, positions),
+        distance=interpolate(distances, positions),
+        elevation=interpolate(elevations, positions),
+        speed=interpolate(track.speed, positions),
+        hr=nearest(track.hr, positions),
+        cad=nearest(track.cad, positions),
+        paused=np.zeros(len(positions)),
+    )
+
+def stopped_frames(table: FrameTable, stop_speed: float = STOP_SPEED) -> np.ndarray:
+    """
+    Returns a boolean mask of frames reached from the previous frame slower than stop_speed.
+    Ground speed is taken from distance over time, so recording gaps (auto-pause) count
+    as stops and devices without a speed field are handled too.
+    """
+    if len(table) < 2:
+        return np.zeros(len(table), dtype=bool)
+    slow = np.diff(table.distance) <= stop_speed * np.diff(table.time)
+    return np.r_[slow[:1], slow]
+
+def collapse_stops(table: FrameTable, keep: int, stop_speed: float = STOP_SPEED) -> FrameTable:
+    """
+    Shortens every run of stopped frames longer than `keep` frames to its first `keep` frames.
+    The kept frames record the ride-time length of the whole stop in `paused`.
+    """
+    keep = max(1, int(keep))
+    stopped = stopped_frames(table, stop_speed)
+    edges = np.flatnonzero(np.diff(np.r_[0, stopped.astype(np.int8), 0]))
+    selected = np.ones(len(table), dtype=bool)
+    paused = table.paused.copy()
+    for start, end in zip(edges[::2], edges[1::2]):
+        if end - start <= keep:
+            continue
+        selected[start + keep:end] = False
+        paused[start:start + keep] = table.time[min(end, len(table) - 1)] - table.time[start]
+    return FrameTable(**{name: (paused if name == "paused" else value)[selected]
+                         for name, value in vars(table).items()})
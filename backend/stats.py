@@ -0,0 +1,140 @@
+"""
+Vectorized ride statistics computed from track arrays.
+Does not depend on matplotlib, so the API can use it without rendering.
+"""
+
+from dataclasses import dataclass, field, asdict
+
+import numpy as np
+
+MOVING_SPEED_THRESHOLD = 2.0    # m/s ≈ 7.2 km/h
+GAIN_MIN_SEGMENT = 100          # meters
+GAIN_MIN_GRADIENT = 0.005       # 0.5%
+CLIMB_MIN_GRADIENT = 0.03       # 3%
+CLIMB_MIN_GAIN = 30             # meters
+DEFAULT_MAX_HR = 190            # bpm
+HR_ZONE_BOUNDS = (0.6, 0.7, 0.8, 0.9)  # Zone 2..5 lower bounds as fractions of max HR
+
+@dataclass
+class Climb:
+    """A contiguous climb along the route."""
+    start_km: float
+    end_km: float
+    gain_m: float
+    avg_gradient: float
+
+@dataclass
+class RideStats:
+    """Summary statistics for a ride."""
+    total_time: float               # seconds
+    moving_time: float              # seconds
+    distance_km: float
+    elevation_gain: float           # meters
+    avg_speed_kmh: float
+    max_speed_kmh: float
+    avg_hr: float
+    avg_cad: float
+    hr_zone_time: list = field(default_factory=list)    # seconds spent in zones 1..5
+    climbs: list = field(default_factory=list)          # Climb entries
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RideStats":
+        """Rebuilds RideStats from to_dict() output."""
+        return cls(**{**data, "climbs": [Climb(**c) for c in data.get("climbs", [])]})
+
+def moving_time(times, speeds, threshold: float = MOVING_SPEED_THRESHOLD) -> float:
+    """
+    Returns the time in seconds spent above the speed threshold.
+    Each interval counts when the speed at its end point exceeds the threshold.
+    """
+    dt = np.diff(times)
+    return float(dt[speeds[1:] > threshold].sum())
+
+def gain_segments(distances, min_segment: float = GAIN_MIN_SEGMENT) -> np.ndarray:
+    """
+    Returns the point indices splitting the route into segments of at least min_segment meters.
+    The first index is 0; a trailing remainder shorter than min_segment is not closed.
+    """
+    bounds = [0]
+    i = 0
+    while True:
+        j = int(np.searchsorted(distances, distances[i] + min_segment, side="left"))
+        if j >= len(distances):
+            return np.asarray(bounds)
+        bounds.append(j)
+        i = j
+
+def elevation_gain(elevations, distances, min_segment: float = GAIN_MIN_SEGMENT,
+                   min_gradient: float = GAIN_MIN_GRADIENT) -> float:
+    """
+    Calculates elevation gain with minimum segment length and gradient filtering.
+    Only segments climbing at min_gradient or steeper contribute.
+    """
+    elevations = np.asarray(elevations, dtype=np.float64)
+    bounds = gain_segments(distances, min_segment)
+    seg_elev = np.diff(elevations[bounds])
+    seg_dist = np.diff(distances[bounds])
+    return float(seg_elev[seg_elev / seg_dist >= min_gradient].sum())
+
+def average_nonzero(values, mask) -> float:
+    """
+    Returns the average of valid non-zero values (0 if there are none).
+    """
+    valid = values[mask & (values > 0)]
+    return float(valid.mean()) if valid.size else 0
+
+def hr_zone_time(times, hr, hr_valid, max_hr: int = DEFAULT_MAX_HR,
+                 bounds=HR_ZONE_BOUNDS) -> list:
+    """
+    Returns the seconds spent in each heart rate zone (zones 1..5).
+    Each interval counts toward the zone of the HR at its end point; intervals without HR are ignored.
+    """
+    dt = np.diff(times).astype(np.float64)
+    valid = hr_valid[1:] & (hr[1:] > 0)
+    zones = np.digitize(hr[1:][valid], np.asarray(bounds) * max_hr)
+    return np.bincount(zones, weights=dt[valid], minlength=len(bounds) + 1).tolist()
+
+def climb_segments(elevations, distances, min_gradient: float = CLIMB_MIN_GRADIENT,
+                   min_gain: float = CLIMB_MIN_GAIN) -> list:
+    """
+    Detects climbs as runs of consecutive 100 m segments at min_gradient or steeper.
+    Returns Climb entries gaining at least min_gain meters.
+    """
+    elevations = np.asarray(elevations, dtype=np.float64)
+    bounds = gain_segments(distances)
+    if bounds.size < 2:
+        return []
+    seg_grad = np.diff(elevations[bounds]) / np.diff(distances[bounds])
+    climbing = np.concatenate(([False], seg_grad >= min_gradient, [False]))
+    edges = np.flatnonzero(np.diff(climbing.astype(np.int8)))
+    starts, ends = bounds[edges[0::2]], bounds[edges[1::2]]
+
+    gains = elevations[ends] - elevations[starts]
+    lengths = distances[ends] - distances[starts]
+    return [
+        Climb(start_km=float(distances[s] / 1000), end_km=float(distances[e] / 1000),
+              gain_m=float(g), avg_gradient=float(g / l))
+        for s, e, g, l in zip(starts, ends, gains, lengths) if g >= min_gain
+    ]
+
+def compute_stats(track, distances, elevations, max_hr: int = DEFAULT_MAX_HR) -> RideStats:
+    """
+    Computes summary statistics for a Track with its cumulative distances and smoothed elevations.
+    """
+    moving = moving_time(track.time, track.speed)
+    distance = float(distances[-1])
+    return RideStats(
+        total_time=float(track.time[-1] - track.time[0]),
+        moving_time=moving,
+        distance_km=distance / 1000,
+        elevation_gain=elevation_gain(elevations, distances),
+        avg_speed_kmh=(distance / moving) * 3.6 if moving else 0,
+        max_speed_kmh=float(track.speed.max()) * 3.6,
+        avg_hr=average_nonzero(track.hr, track.hr_valid),
+        avg_cad=average_nonzero(track.cad, track.cad_valid),
+        hr_zone_time=hr_zone_time(track.time, track.hr, track.hr_valid, max_hr),
+        climbs=climb_segments(elevations, distances),
+    )
@@ -2,33 +2,159 @@
 Handles file storage for FIT files, video output, and thumbnails.
 """
 
+import os
+import re
 from pathlib import Path
+from uuid import uuid4
 from backend.logger import get_logger
 from backend.config import VIDEO_FILES_DIR, FIT_FILES_DIR, THUMBNAIL_FILES_DIR
-from backend.util import ensure_parent_dir
+from backend.util import ensure_parent_dir, FitStreamValidator
 
 logger = get_logger(__name__)
 
+UPLOAD_CHUNK_SIZE = 256 * 1024   # bytes read per step while receiving an upload
+VIDEO_FORMATS = {"mp4": "video/mp4", "gif": "image/gif", "webp": "image/webp"}  # output format -> media type
+RENDITION_NAME = re.compile(r"^[A-Za-z0-9_-]{1,32}$")   # Rendition names are used as file names
+
 def get_fit_path(ticket_id):
     """
     Returns the expected path for the FIT file.
     """
     return Path(f"{FIT_FILES_DIR}/{ticket_id}.fit")
 
-def save_fit_file(ticket_id, content: bytes):
+class UploadTooLarge(ValueError):
+    """
+    Raised when an upload exceeds its size limit.
+    """
+
+class FitUpload:
+    """
+    Receives an uploaded FIT file chunk by chunk into a temporary file,
+    hashing and validating it on the way.
+    Call finish() once the last chunk is written, or abort() to discard it.
     """
-    Saves the uploaded FIT file to disk.
+
+    def __init__(self, max_bytes: int, directory=FIT_FILES_DIR):
+        self.max_bytes = max_bytes
+        self.tmp_path = Path(f"{directory}/.upload-{uuid4()}.tmp")
+        ensure_parent_dir(self.tmp_path)
+        self.validator = FitStreamValidator()
+        self.file = open(self.tmp_path, "wb")
+
+    def write(self, chunk: bytes):
+        """
+        Validates and stores the next chunk.
+        Raises UploadTooLarge past max_bytes and ValueError for invalid FIT data.
+        """
+        if self.validator.size + len(chunk) > self.max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+        self.validator.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self) -> str:
+        """
+        Completes the upload and returns the SHA-256 hex digest. Pass tmp_path to commit_fit_file.
+        Raises ValueError for an invalid FIT file, which is discarded.
+        """
+        self.file.close()
+        try:
+            digest = self.validator.finish()
+        except ValueError:
+            self.abort()
+            raise
+        logger.info(f"Received FIT upload: {self.validator.size} bytes sha256={digest}")
+        return digest
+
+    def abort(self):
+        """
+        Discards the upload and its temporary file.
+        """
+        self.file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+def receive_fit_upload(stream, max_bytes: int, chunk_size: int = UPLOAD_CHUNK_SIZE, directory=FIT_FILES_DIR):
+    """
+    Copies an uploaded FIT file from a binary stream to a temporary file in chunks,
+    hashing and validating it on the way.
+    Returns (temporary path, SHA-256 hex digest). Pass the path to commit_fit_file.
+    Raises UploadTooLarge past max_bytes and ValueError for an invalid FIT file;
+    the temporary file is removed in both cases.
+    """
+    upload = FitUpload(max_bytes, directory)
+    try:
+        while chunk := stream.read(chunk_size):
+            upload.write(chunk)
+        digest = upload.finish()
+    except BaseException:
+        upload.abort()
+        raise
+    return upload.tmp_path, digest
+
+def commit_fit_file(tmp_path: Path, ticket_id):
+    """
+    Atomically moves a received upload into place as the ticket's FIT file.
     """
     path = Path(get_fit_path(ticket_id))
-    ensure_parent_dir(path)
-    path.write_bytes(content)
+    os.replace(tmp_path, path)
     logger.info(f"Saved FIT file: {path}")
 
-def get_video_path(ticket_id):
+def get_geometry_path(ticket_id):
+    """
+    Returns the path of the ticket's geometry cache, stored next to its FIT file.
+    """
+    return Path(f"{FIT_FILES_DIR}/{ticket_id}.geometry")
+
+def get_video_path(ticket_id, output_format: str = "mp4"):
+    """
+    Returns the expected path for the generated video file in an output format.
+    """
+    return Path(f"{VIDEO_FILES_DIR}/{ticket_id}.{output_format}")
+
+def get_rendition_dir(ticket_id):
+    """
+    Returns the directory holding the ticket's named renditions.
+    """
+    return Path(f"{VIDEO_FILES_DIR}/renditions/{ticket_id}")
+
+def get_rendition_path(ticket_id, name: str, output_format: str = "mp4"):
+    """
+    Returns the expected path for a named rendition of the generated video.
+    Raises ValueError for a name that is not a plain file name.
+    """
+    if not RENDITION_NAME.match(name):
+        raise ValueError(f"Invalid rendition name: {name!r}")
+    return get_rendition_dir(ticket_id) / f"{name}.{output_format}"
+
+def get_segment_dir(ticket_id):
+    """
+    Returns the directory holding the video segments of a distributed render.
+    Must be on storage shared by every worker node.
+    """
+    return Path(f"{VIDEO_FILES_DIR}/segments/{ticket_id}")
+
+def get_segment_path(ticket_id, index: int):
+    """
+    Returns the expected path for one video segment of a distributed render.
+    """
+    return get_segment_dir(ticket_id) / f"{index:04d}.mp4"
+
+def get_result_video_path(key: str, output_format: str = "mp4"):
+    """
+    Returns the path of a cached render result video, addressed by its render key.
+    """
+    return Path(f"{VIDEO_FILES_DIR}/results/{key}.{output_format}")
+
+def get_result_rendition_dir(key: str):
+    """
+    Returns the directory holding the renditions of a cached render result.
+    """
+    return Path(f"{VIDEO_FILES_DIR}/results/renditions/{key}")
+
+def get_result_thumbnail_path(key: str):
     """
-    Returns the expected path for the generated video file.
+    Returns the path of a cached render result thumbnail, addressed by its render key.
     """
-    return Path(f"{VIDEO_FILES_DIR}/{ticket_id}.mp4")
+    return Path(f"{THUMBNAIL_FILES_DIR}/results/{key}.jpg")
 
 def get_thumbnail_path(ticket_id):
     """
@@ -1,42 +1,71 @@
 """
 RQ job handler for ride animation generation.
 """
-from pathlib import Path
+import io
+import shutil
 import time
-import ffmpeg
+from PIL import Image
 
 from backend.ride_route_animator import RideRouteAnimator
-from backend.ticket import update_status
-from backend.storage import get_video_path, get_fit_path, get_thumbnail_path
+from backend.ticket import (update_status, mark_segment_done, segment_thumbnail_saved, is_prefetch_cancelled,
+                            get_fit_sha256)
+from backend.storage import (get_video_path, get_fit_path, get_thumbnail_path, get_rendition_dir, get_rendition_path,
+                             get_segment_path, get_segment_dir, get_geometry_path)
 from backend.logger import get_logger
 from backend.util import ensure_parent_dir
+from backend.video_writer import concat_segments
+from backend.result_cache import store_result, link_cached_result, content_sha256
+from backend.config import TILE_CACHE_PATH, TILE_CACHE_MAX_MB, TILE_PREFETCH_ZOOMS, TILE_PREFETCH_SLOTS
+from backend.tile_cache import TileCache, resolve_tile_provider, prefetch_tiles
 
 logger = get_logger(__name__)
 
-def run_animation_job(ticket_id, params: dict):
+# Every job on a host shares one tile cache
+TILE_CACHE_OPTIONS = {"tile_cache": TILE_CACHE_PATH, "tile_cache_mb": TILE_CACHE_MAX_MB}
+UPLOAD_OPTIONS = {"check_crc": False}    # FIT files were validated while uploading
+PREVIEW_DPI = 40
+THUMBNAIL_WIDTH = 512
+
+def run_animation_job(ticket_id, params: dict, result_key: str = None):
     """
     Executes the ride animation generation job.
     Updates ticket status upon success or failure.
+    Every rendition in params["renditions"] is encoded from the same rendered frames.
+    - result_key: render cache key the finished video and thumbnail are stored under
     """
     try:
         
         logger.info(f"Starting job: {ticket_id} with params: {params}")
         start_time = time.time()
-        video_path = get_video_path(ticket_id)
+        output_format = params.get("output_format", "mp4")
+        video_path = get_video_path(ticket_id, output_format)
         ensure_parent_dir(video_path)
         video_path.unlink(missing_ok=True)  # Remove existing video if any
+        thumbnail_path = get_thumbnail_path(ticket_id)
+        ensure_parent_dir(thumbnail_path)
+        thumbnail_path.unlink(missing_ok=True)  # Remove existing thumbnail if any
+        renditions = params.get("renditions") or []
+        rendition_dir = get_rendition_dir(ticket_id)
+        shutil.rmtree(rendition_dir, ignore_errors=True)  # Remove existing renditions if any
+        if renditions:
+            rendition_dir.mkdir(parents=True, exist_ok=True)
+        rendition_paths = [(get_rendition_path(ticket_id, r["name"], r.get("output_format", "mp4")), r.get("height"))
+                           for r in renditions]
         animator = RideRouteAnimator(
             input_path=get_fit_path(ticket_id),
             output_path=video_path,
             logger=logger,
-            **params
+            geometry_cache=get_geometry_path(ticket_id),
+            fit_sha256=ticket_fit_sha256(ticket_id),
+            thumbnail_path=thumbnail_path,
+            thumbnail_width=THUMBNAIL_WIDTH,
+            **TILE_CACHE_OPTIONS,
+            **UPLOAD_OPTIONS,
+            **{**params, "renditions": rendition_paths}
         )
         animator.run()
-        
-        thumbnail_path = get_thumbnail_path(ticket_id)
-        ensure_parent_dir(thumbnail_path)
-        thumbnail_path.unlink(missing_ok=True)  # Remove existing thumbnail if any
-        extract_thumbnail_from_video(video_path, thumbnail_path, width=512)
+        record_content_hashes(video_path, thumbnail_path, *(path for path, _ in rendition_paths))
+        cache_result(result_key, ticket_id, output_format, renditions)
 
         start_time = time.time()
         logger.info(f"Job completed: {ticket_id}")
@@ -49,32 +78,196 @@ def run_animation_job(ticket_id, params: dict):
         "ticket_id": ticket_id, 
         "video_path": str(video_path),
         "thumbnail_path": str(thumbnail_path),
+        "rendition_paths": [str(path) for path, _ in rendition_paths],
+        "zoom": animator.basemap["zoom"],
+        "tiles": animator.basemap["tiles"],
+        "elapsed": time.time() - start_time}
+
+def run_prefetch_job(ticket_id, tile: str = "OpenStreetMap.Mapnik", zooms=None):
+    """
+    Warms the tile cache for an uploaded ticket at the likely zoom levels.
+    Runs on the low-priority prefetch queue and holds one of TILE_PREFETCH_SLOTS host-wide
+    slots, so it never occupies more workers than that. Stops when /generate cancels it.
+    """
+    zooms = zooms or TILE_PREFETCH_ZOOMS
+    start_time = time.time()
+    stored = {}
+    try:
+        cache = TileCache(TILE_CACHE_PATH, TILE_CACHE_MAX_MB * 1024 * 1024)
+        with cache.host_slot("prefetch", TILE_PREFETCH_SLOTS) as acquired:
+            if not acquired:
+                logger.info(f"Prefetch skipped, all prefetch slots busy: {ticket_id}")
+                return {"ticket_id": ticket_id, "skipped": "busy"}
+
+            logger.info(f"Starting prefetch: {ticket_id} tile={tile} zooms={zooms}")
+            animator = RideRouteAnimator(get_fit_path(ticket_id), None, logger=logger, tile=tile,
+                                         geometry_cache=get_geometry_path(ticket_id),
+                                         fit_sha256=ticket_fit_sha256(ticket_id), **UPLOAD_OPTIONS)
+            animator.prepare()
+            bounds = animator.map_bounds()
+            provider = resolve_tile_provider(tile)
+            cancelled = lambda: is_prefetch_cancelled(ticket_id)
+            for zoom in zooms:
+                if cancelled():
+                    logger.info(f"Prefetch cancelled: {ticket_id}")
+                    break
+                stored[zoom] = prefetch_tiles(bounds, zoom, provider, cache, should_stop=cancelled)
+            logger.info(f"Prefetch completed: {ticket_id} stored={stored}")
+
+    except Exception as e:
+        logger.error(f"Prefetch failed: {ticket_id}  {e}")
+        raise
+
+    return {
+        "ticket_id": ticket_id,
+        "stored": stored,
         "elapsed": time.time() - start_time}
 
-def extract_thumbnail_from_video(video_path: Path, thumbnail_path: Path, time: float = None, width: int = 512):
+def run_segment_job(ticket_id, params: dict, index: int, count: int):
     """
-    Extracts a frame from the video and saves it as a thumbnail image.
-    - time: timestamp in seconds (default: middle of video)
-    - width: desired width of thumbnail (height is auto-scaled)
+    Renders frame window `index` of `count` for a ticket into a segment file.
+    Segments are joined by run_join_job once every segment job has finished.
+    The segment holding the thumbnail frame writes the ticket's thumbnail.
     """
     try:
-        # Get video duration
-        logger.info(f"Extracting thumbnail from {video_path} to {thumbnail_path} at width={width}")
-        probe = ffmpeg.probe(str(video_path))
-        duration = float(probe['format']['duration'])
-        timestamp = time if time is not None else duration / 2
-
-        # Build ffmpeg command with scale filter
-        logger.info(f"Video duration: {duration:.2f}s, extracting at {timestamp:.2f}s")
-        (
-            ffmpeg
-            .input(str(video_path), ss=timestamp)
-            .filter('scale', width, -1)  # -1 keeps aspect ratio
-            .output(str(thumbnail_path), vframes=1)
-            .run(capture_stdout=True, capture_stderr=True)
+        logger.info(f"Starting segment {index + 1}/{count}: {ticket_id}")
+        start_time = time.time()
+        segment_path = get_segment_path(ticket_id, index)
+        ensure_parent_dir(segment_path)
+        segment_path.unlink(missing_ok=True)  # Remove stale segment if any
+        thumbnail_path = get_thumbnail_path(ticket_id)
+        ensure_parent_dir(thumbnail_path)
+        animator = RideRouteAnimator(
+            input_path=get_fit_path(ticket_id),
+            output_path=segment_path,
+            logger=logger,
+            geometry_cache=get_geometry_path(ticket_id),
+            fit_sha256=ticket_fit_sha256(ticket_id),
+            thumbnail_path=thumbnail_path,
+            thumbnail_width=THUMBNAIL_WIDTH,
+            **TILE_CACHE_OPTIONS,
+            **UPLOAD_OPTIONS,
+            **params
         )
-        logger.info(f"Thumbnail extracted at {timestamp:.2f}s to {thumbnail_path} (width={width})")
-    
+        animator.run_segment(index, count)
+        done = mark_segment_done(ticket_id, thumbnail=animator.thumbnail_saved)
+        logger.info(f"Segment completed: {ticket_id} {index + 1}/{count} ({done} done)")
+
+    except Exception as e:
+        logger.error(f"Segment failed: {ticket_id} {index + 1}/{count}  {e}")
+        raise
+
+    return {
+        "ticket_id": ticket_id,
+        "segment": index,
+        "segment_path": str(segment_path),
+        "zoom": animator.basemap and animator.basemap["zoom"],
+        "tiles": animator.basemap and animator.basemap["tiles"],
+        "elapsed": time.time() - start_time}
+
+def run_join_job(ticket_id, params: dict, count: int, result_key: str = None):
+    """
+    Joins the rendered segments of a ticket into the final video.
+    The thumbnail was already written by the segment that rendered its frame;
+    the join fails when that segment did not report writing it.
+    - result_key: render cache key the finished video and thumbnail are stored under
+    """
+    try:
+        logger.info(f"Joining {count} segments: {ticket_id}")
+        start_time = time.time()
+        video_path = get_video_path(ticket_id)
+        ensure_parent_dir(video_path)
+        video_path.unlink(missing_ok=True)  # Remove existing video if any
+
+        # Windows past the last frame produce no segment file
+        segment_paths = [p for p in (get_segment_path(ticket_id, i) for i in range(count)) if p.exists()]
+        if not segment_paths:
+            raise RuntimeError(f"No segments found for ticket {ticket_id}")
+        concat_segments(segment_paths, video_path)
+        shutil.rmtree(get_segment_dir(ticket_id), ignore_errors=True)
+
+        # /generate removed the previous thumbnail, so an existing one must come from this render
+        thumbnail_path = get_thumbnail_path(ticket_id)
+        if not segment_thumbnail_saved(ticket_id) or not thumbnail_path.exists():
+            raise RuntimeError(f"No segment wrote the thumbnail for ticket {ticket_id}")
+        record_content_hashes(video_path, thumbnail_path)
+        cache_result(result_key, ticket_id)
+        logger.info(f"Join completed: {ticket_id}")
+
+    except Exception as e:
+        logger.error(f"Join failed: {ticket_id}  {e}")
+        raise
+
+    return {
+        "ticket_id": ticket_id,
+        "video_path": str(video_path),
+        "thumbnail_path": str(thumbnail_path),
+        "elapsed": time.time() - start_time}
+
+def render_preview(ticket_id, params: dict, count: int = 3) -> bytes:
+    """
+    Renders `count` keyframes of a ticket's animation at PREVIEW_DPI as a PNG strip.
+    Runs synchronously in the API process: uses the geometry and tile caches,
+    but neither ffmpeg nor the job queue.
+    """
+    start_time = time.time()
+    animator = RideRouteAnimator(
+        input_path=get_fit_path(ticket_id),
+        output_path=None,
+        logger=logger,
+        geometry_cache=get_geometry_path(ticket_id),
+        fit_sha256=ticket_fit_sha256(ticket_id),
+        **TILE_CACHE_OPTIONS,
+        **UPLOAD_OPTIONS,
+        **params
+    )
+    animator.prepare()
+    strip = animator.render_preview(count, dpi=PREVIEW_DPI)
+    buf = io.BytesIO()
+    Image.fromarray(strip).save(buf, format="PNG", compress_level=1)
+    logger.info(f"Preview rendered: {ticket_id} {strip.shape[1]}x{strip.shape[0]} in {time.time() - start_time:.2f}s")
+    return buf.getvalue()
+
+def run_link_job(ticket_id, result_key: str, output_format: str = "mp4", renditions=()):
+    """
+    Links the result of an identical render this ticket attached to.
+    Runs once that render's job has ended; fails if it did not produce a cached result.
+    """
+    if not link_cached_result(result_key, ticket_id, output_format, renditions):
+        logger.error(f"Attached render produced no result: {ticket_id} {result_key}")
+        raise RuntimeError(f"Attached render {result_key} produced no result")
+    logger.info(f"Linked attached render result: {ticket_id}")
+    return {
+        "ticket_id": ticket_id,
+        "video_path": str(get_video_path(ticket_id, output_format)),
+        "thumbnail_path": str(get_thumbnail_path(ticket_id)),
+        "result_key": result_key}
+
+def ticket_fit_sha256(ticket_id) -> str:
+    """
+    Returns the SHA-256 of the ticket's FIT file: the one recorded at upload, or else
+    one hashed once per file version, so jobs and previews do not read the whole file again.
+    """
+    return get_fit_sha256(ticket_id) or content_sha256(get_fit_path(ticket_id))
+
+def record_content_hashes(*paths):
+    """
+    Hashes finished files for the ETags /video and /thumbnail serve, so the first
+    download does not wait for it; a failure never fails the job.
+    """
+    for path in paths:
+        try:
+            content_sha256(path)
+        except Exception as e:
+            logger.warning(f"Failed to hash {path}: {e}")
+
+def cache_result(result_key, ticket_id, output_format: str = "mp4", renditions=()):
+    """
+    Stores a finished render in the render cache; a cache failure never fails the job.
+    """
+    if not result_key:
+        return
+    try:
+        store_result(result_key, ticket_id, output_format, renditions)
     except Exception as e:
-        logger.error(f"Thumbnail extraction failed: {e}")
-        raise
\ No newline at end of file
+        logger.warning(f"Failed to cache render result {result_key}: {e}")
@@ -34,9 +34,104 @@ def update_status(ticket_id, status, params=None):
 def get_status(ticket_id):
     """
     Retrieves the current status and parameters for a ticket.
+    Includes segment progress while a segmented render is tracked.
     """
     key = make_redis_key(ticket_id)
     info = get_redis_value(redis, key)
     if not info:
         logger.warning(f"Ticket not found: {ticket_id}")
+        return info
+    segments = redis.hgetall(make_segments_key(ticket_id))
+    if segments:
+        info["segments"] = {"done": int(segments["done"]), "total": int(segments["total"])}
     return info
+
+def make_fit_sha256_key(ticket_id: str) -> str:
+    """
+    Generates the Redis key holding the SHA-256 of a ticket's FIT file.
+    """
+    return f"{make_redis_key(ticket_id)}:fit_sha256"
+
+def set_fit_sha256(ticket_id, digest: str, ttl: int = 3600):
+    """
+    Records the SHA-256 of the ticket's FIT file, computed while it was uploaded.
+    """
+    redis.setex(make_fit_sha256_key(ticket_id), ttl, digest)
+
+def get_fit_sha256(ticket_id):
+    """
+    Returns the recorded SHA-256 of the ticket's FIT file, or None.
+    """
+    return redis.get(make_fit_sha256_key(ticket_id))
+
+def make_outputs_key(ticket_id: str) -> str:
+    """
+    Generates the Redis key holding the output formats of a ticket's latest generation.
+    """
+    return f"{make_redis_key(ticket_id)}:outputs"
+
+def set_outputs(ticket_id, output_format: str, renditions: dict, ttl: int = 3600):
+    """
+    Records the output format of the ticket's latest generation and of each named rendition.
+    """
+    set_redis_value(redis, make_outputs_key(ticket_id), {"output_format": output_format, "renditions": renditions}, ttl)
+
+def get_outputs(ticket_id):
+    """
+    Returns {"output_format": ..., "renditions": {name: format}} of the ticket's latest generation, or None.
+    """
+    return get_redis_value(redis, make_outputs_key(ticket_id))
+
+def make_prefetch_cancel_key(ticket_id: str) -> str:
+    """
+    Generates the Redis key flagging a ticket's tile prefetch for cancellation.
+    """
+    return f"{make_redis_key(ticket_id)}:prefetch_cancel"
+
+def cancel_prefetch(ticket_id, ttl: int = 3600):
+    """
+    Asks a running tile prefetch for the ticket to stop.
+    """
+    redis.setex(make_prefetch_cancel_key(ticket_id), ttl, 1)
+    logger.info(f"Prefetch cancel requested: {ticket_id}")
+
+def is_prefetch_cancelled(ticket_id) -> bool:
+    """
+    Returns True when the ticket's tile prefetch should stop.
+    """
+    return bool(redis.exists(make_prefetch_cancel_key(ticket_id)))
+
+def make_segments_key(ticket_id: str) -> str:
+    """
+    Generates the Redis key holding segment progress for a ticket.
+    """
+    return f"{make_redis_key(ticket_id)}:segments"
+
+def init_segments(ticket_id, total, ttl: int = 3600):
+    """
+    Starts tracking a render split into `total` segments.
+    """
+    key = make_segments_key(ticket_id)
+    redis.delete(key)
+    redis.hset(key, mapping={"done": 0, "total": total})
+    redis.expire(key, ttl)
+    logger.info(f"Tracking {total} segments: {ticket_id}")
+
+def mark_segment_done(ticket_id, thumbnail: bool = False, ttl: int = 3600) -> int:
+    """
+    Atomically counts a finished segment and returns the number done so far.
+    Set thumbnail when the segment has written the ticket's thumbnail.
+    """
+    key = make_segments_key(ticket_id)
+    if thumbnail:
+        redis.hset(key, "thumbnail", 1)
+    done = redis.hincrby(key, "done", 1)
+    redis.expire(key, ttl)
+    logger.info(f"Segment done: {ticket_id} ({done})")
+    return done
+
+def segment_thumbnail_saved(ticket_id) -> bool:
+    """
+    Returns True when a segment of the tracked render has written the ticket's thumbnail.
+    """
+    return redis.hget(make_segments_key(ticket_id), "thumbnail") == "1"
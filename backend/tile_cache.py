@@ -0,0 +1,366 @@
+"""
+Persistent on-disk map tile cache and the basemap mosaic built on top of it.
+
+Tiles are stored as blobs in a single SQLite database keyed by (provider, z, x, y).
+The database runs in WAL mode with a busy timeout, so every worker process on a
+host can share one cache file. The cache is capped in bytes and evicts the least
+recently used tiles once it grows past the cap. Hit, miss and eviction counters
+live in the same database and therefore cover all processes.
+"""
+
+import fcntl
+import io
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+import numpy as np
+import requests
+import contextily as ctx
+from PIL import Image
+from xyzservices import TileProvider
+
+from backend.logger import get_logger
+
+logger = get_logger(__name__)
+
+WEB_MERCATOR_HALF_WORLD = 20037508.342789244   # meters from the origin to the map edge
+TILE_SIZE = 256                 # Tile edge in pixels
+DEFAULT_MAX_ZOOM = 19           # Used when the provider does not declare max_zoom
+TILE_USER_AGENT = "ride_animator_service"
+TILE_FETCH_CONNECTIONS = 2      # Parallel downloads (OpenStreetMap allows at most 2)
+TILE_PREFETCH_CONNECTIONS = 1   # Background prefetch stays below render downloads
+TILE_PREFETCH_BATCH = 16        # Tiles fetched between cancellation checks
+TILE_PREFETCH_MAX_TILES = 256   # Zoom levels needing more tiles than this are not prefetched
+TILE_FETCH_RETRIES = 2          # Retries after a failed download (404 is not retried)
+TILE_FETCH_WAIT = 1.0           # Seconds to wait before the first retry; doubles per retry
+TILE_FETCH_TIMEOUT = 10         # Seconds per request
+EVICT_TO_FRACTION = 0.9         # Eviction frees space down to this fraction of the cap
+SQLITE_TIMEOUT = 30             # Seconds to wait for another process holding the write lock
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    provider TEXT NOT NULL,
+    z INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (provider, z, x, y)
+);
+CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value)
+    VALUES ('hits', 0), ('misses', 0), ('evictions', 0), ('bytes', 0), ('prefetched', 0);
+"""
+
+class TileCache:
+    """
+    Size-capped LRU cache of encoded tile images shared across processes.
+    Instances only hold the database path, so they are cheap to create and picklable.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        # Autocommit mode; transactions are opened explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get_many(self, provider: str, tiles) -> dict:
+        """
+        Looks up (z, x, y) tiles for a provider.
+        Returns {(z, x, y): bytes} for the cached ones and refreshes their access time.
+        """
+        found = {}
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for z, x, y in tiles:
+                row = conn.execute(
+                    "SELECT data FROM tiles WHERE provider=? AND z=? AND x=? AND y=?",
+                    (provider, z, x, y)).fetchone()
+                if row:
+                    found[(z, x, y)] = row[0]
+                    conn.execute(
+                        "UPDATE tiles SET accessed=? WHERE provider=? AND z=? AND x=? AND y=?",
+                        (now, provider, z, x, y))
+            _increment(conn, "hits", len(found))
+            _increment(conn, "misses", len(tiles) - len(found))
+            conn.execute("COMMIT")
+        return found
+
+    def missing(self, provider: str, tiles) -> list:
+        """
+        Returns the (z, x, y) tiles not cached for a provider, without touching counters
+        or access times.
+        """
+        with closing(self._connect()) as conn:
+            return [(z, x, y) for z, x, y in tiles if not conn.execute(
+                "SELECT 1 FROM tiles WHERE provider=? AND z=? AND x=? AND y=?",
+                (provider, z, x, y)).fetchone()]
+
+    def put_many(self, provider: str, tiles: dict, counter: str = None):
+        """
+        Stores {(z, x, y): bytes} tiles for a provider, evicting least recently used
+        tiles when the cache grows past its cap.
+        - counter: counter incremented by the number of tiles stored (e.g. "prefetched")
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            added = 0
+            for (z, x, y), data in tiles.items():
+                row = conn.execute(
+                    "SELECT size FROM tiles WHERE provider=? AND z=? AND x=? AND y=?",
+                    (provider, z, x, y)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO tiles (provider, z, x, y, data, size, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (provider, z, x, y, data, len(data), now))
+                added += len(data) - (row[0] if row else 0)
+            _increment(conn, "bytes", added)
+            if counter:
+                _increment(conn, counter, len(tiles))
+            self._evict(conn)
+            conn.execute("COMMIT")
+
+    def _evict(self, conn):
+        total = _counter(conn, "bytes")
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * EVICT_TO_FRACTION
+        freed, victims = 0, []
+        for rowid, size in conn.execute("SELECT rowid, size FROM tiles ORDER BY accessed"):
+            if total - freed <= target:
+                break
+            victims.append((rowid,))
+            freed += size
+        conn.executemany("DELETE FROM tiles WHERE rowid=?", victims)
+        _increment(conn, "bytes", -freed)
+        _increment(conn, "evictions", len(victims))
+        logger.info(f"Tile cache evicted {len(victims)} tiles ({freed / 2**20:.1f} MiB)")
+
+    def stats(self) -> dict:
+        """
+        Returns the shared counters: hits, misses, evictions, prefetched, tiles and bytes.
+        """
+        with closing(self._connect()) as conn:
+            stats = dict(conn.execute("SELECT name, value FROM counters"))
+            stats["tiles"] = conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        return stats
+
+    @contextmanager
+    def host_slot(self, name: str, slots: int = 1):
+        """
+        Holds one of `slots` host-wide slots for the duration of the block.
+        Yields True when a slot was acquired, False when all are busy (never blocks).
+        Slots are lock files next to the cache, so they are shared by every process on the host.
+        """
+        for slot in range(slots):
+            lock = open(self.path.with_name(f"{self.path.name}.{name}.{slot}.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            try:
+                yield True
+            finally:
+                lock.close()    # Closing releases the lock
+            return
+        yield False
+
+def _increment(conn, name: str, amount: int):
+    if amount:
+        conn.execute("UPDATE counters SET value = value + ? WHERE name=?", (amount, name))
+
+def _counter(conn, name: str) -> int:
+    return conn.execute("SELECT value FROM counters WHERE name=?", (name,)).fetchone()[0]
+
+def resolve_tile_provider(tile: str) -> TileProvider:
+    """
+    Returns the tile provider for a contextily provider name (e.g. OpenStreetMap.Mapnik)
+    or a raw URL template containing {z}, {x} and {y}.
+    """
+    if "{z}" in tile:
+        return TileProvider(name=tile, url=tile, attribution="")
+    return ctx.providers.query_name(tile)
+
+def tile_range(bounds, zoom: int):
+    """
+    Returns the inclusive tile index range (x0, y0, x1, y1) covering
+    Web Mercator bounds (xmin, ymin, xmax, ymax) at a zoom level.
+    """
+    n = 2 ** zoom
+    size = 2 * WEB_MERCATOR_HALF_WORLD / n
+    xmin, ymin, xmax, ymax = bounds
+    x0, x1 = ((np.array([xmin, xmax]) + WEB_MERCATOR_HALF_WORLD) // size).astype(int).clip(0, n - 1)
+    y0, y1 = ((WEB_MERCATOR_HALF_WORLD - np.array([ymax, ymin])) // size).astype(int).clip(0, n - 1)
+    return int(x0), int(y0), int(x1), int(y1)
+
+def tile_count(bounds, zoom: int) -> int:
+    """
+    Returns the number of tiles covering Web Mercator bounds at a zoom level.
+    """
+    x0, y0, x1, y1 = tile_range(bounds, zoom)
+    return (x1 - x0 + 1) * (y1 - y0 + 1)
+
+def parse_zoom(value: str):
+    """
+    argparse type for zoom options: an integer level or "auto".
+    """
+    return value if value == "auto" else int(value)
+
+def choose_zoom(bounds, size_px, zoom="auto", max_tiles: int = None,
+                max_zoom: int = DEFAULT_MAX_ZOOM) -> int:
+    """
+    Returns the zoom level to fetch for a map view.
+    - size_px: (width, height) of the map in output pixels
+    - zoom: "auto" picks the lowest zoom whose tiles are at least as detailed as the
+      output; an integer is used as given
+    - max_tiles: lowers the zoom until the view needs at most this many tiles (None/0: no limit)
+    """
+    if zoom == "auto":
+        xmin, ymin, xmax, ymax = bounds
+        meters_per_px = max((xmax - xmin) / size_px[0], (ymax - ymin) / size_px[1])
+        zoom = int(np.ceil(np.log2(2 * WEB_MERCATOR_HALF_WORLD / (TILE_SIZE * meters_per_px))))
+    zoom = int(np.clip(zoom, 0, max_zoom))
+    while max_tiles and zoom > 0 and tile_count(bounds, zoom) > max_tiles:
+        zoom -= 1
+    return zoom
+
+def fetch_tile(url: str, retries: int = TILE_FETCH_RETRIES) -> bytes:
+    """
+    Downloads one tile, retrying transient failures with exponential backoff.
+    """
+    wait = TILE_FETCH_WAIT
+    for attempt in range(retries + 1):
+        try:
+            response = requests.get(url, headers={"User-Agent": TILE_USER_AGENT}, timeout=TILE_FETCH_TIMEOUT)
+            if response.status_code == 404:
+                raise RuntimeError(f"Tile not found (404): {url}")
+            response.raise_for_status()
+            return response.content
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise RuntimeError(f"Tile download failed after {retries + 1} attempts: {url}: {e}") from e
+            logger.debug(f"Tile download failed ({e}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+            wait *= 2
+
+def prefetch_tiles(bounds, zoom: int, provider: TileProvider, cache: TileCache,
+                   connections: int = TILE_PREFETCH_CONNECTIONS, should_stop=None,
+                   max_tiles: int = TILE_PREFETCH_MAX_TILES) -> int:
+    """
+    Downloads the tiles covering Web Mercator bounds that are not cached yet and stores them.
+    should_stop() is checked between batches; prefetching ends early when it returns True.
+    Returns the number of tiles stored.
+    """
+    x0, y0, x1, y1 = tile_range(bounds, zoom)
+    keys = [(zoom, x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+    if len(keys) > max_tiles:
+        logger.info(f"Skipping prefetch at zoom {zoom}: {len(keys)} tiles exceed {max_tiles}")
+        return 0
+    missing = cache.missing(provider.name, keys)
+    stored = 0
+    with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+        for start in range(0, len(missing), TILE_PREFETCH_BATCH):
+            if should_stop and should_stop():
+                logger.info(f"Tile prefetch stopped at zoom {zoom} after {stored} tiles")
+                break
+            batch = missing[start:start + TILE_PREFETCH_BATCH]
+            urls = [provider.build_url(x=x, y=y, z=z) for z, x, y in batch]
+            downloaded = dict(zip(batch, pool.map(fetch_tile, urls)))
+            for data in downloaded.values():
+                _decode_tile(data)      # Never cache a corrupt download
+            cache.put_many(provider.name, downloaded, counter="prefetched")
+            stored += len(downloaded)
+    return stored
+
+def _decode_tile(data: bytes) -> np.ndarray:
+    with Image.open(io.BytesIO(data)) as image:
+        return np.asarray(image.convert("RGBA"))
+
+def basemap_image(bounds, zoom: int, provider: TileProvider, cache: TileCache = None,
+                  connections: int = TILE_FETCH_CONNECTIONS):
+    """
+    Builds the tile mosaic covering Web Mercator bounds (xmin, ymin, xmax, ymax).
+    Cached tiles are read from `cache`; missing ones are downloaded and stored.
+    Returns (RGBA image, extent (left, right, bottom, top), {"zoom", "tiles", "hits", "misses"}).
+    """
+    x0, y0, x1, y1 = tile_range(bounds, zoom)
+    keys = [(zoom, x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    encoded = {}
+    if cache:
+        try:
+            encoded = cache.get_many(provider.name, keys)
+        except sqlite3.Error as e:
+            logger.warning(f"Tile cache unavailable ({e}), downloading all tiles")
+            cache = None
+
+    missing = [key for key in keys if key not in encoded]
+    if missing:
+        urls = [provider.build_url(x=x, y=y, z=z) for z, x, y in missing]
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+            downloaded = dict(zip(missing, pool.map(fetch_tile, urls)))
+    else:
+        downloaded = {}
+
+    # Decode before caching so a corrupt download is never stored
+    arrays = {key: _decode_tile(data) for key, data in {**encoded, **downloaded}.items()}
+    if cache and downloaded:
+        try:
+            cache.put_many(provider.name, downloaded)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to store tiles in cache: {e}")
+
+    h, w, d = arrays[keys[0]].shape
+    mosaic = np.zeros(((y1 - y0 + 1) * h, (x1 - x0 + 1) * w, d), dtype=np.uint8)
+    for (_, x, y), array in arrays.items():
+        if array.shape != (h, w, d):
+            raise ValueError(f"Tile {zoom}/{x}/{y} has shape {array.shape}, expected {(h, w, d)}")
+        mosaic[(y - y0) * h:(y - y0 + 1) * h, (x - x0) * w:(x - x0 + 1) * w] = array
+
+    size = 2 * WEB_MERCATOR_HALF_WORLD / 2 ** zoom
+    extent = (x0 * size - WEB_MERCATOR_HALF_WORLD, (x1 + 1) * size - WEB_MERCATOR_HALF_WORLD,
+              WEB_MERCATOR_HALF_WORLD - (y1 + 1) * size, WEB_MERCATOR_HALF_WORLD - y0 * size)
+    return mosaic, extent, {"zoom": zoom, "tiles": len(keys), "hits": len(encoded), "misses": len(missing)}
+
+def add_basemap(ax, zoom, provider: TileProvider, cache: TileCache = None, max_tiles: int = None,
+                output_scale: float = 1.0) -> dict:
+    """
+    Draws the tile mosaic behind the current view of a Web Mercator axis,
+    matching contextily.add_basemap(..., reset_extent=False).
+    zoom and max_tiles are resolved with choose_zoom against the axis size in pixels
+    multiplied by output_scale (e.g. final DPI / preview DPI, so previews fetch the final zoom).
+    Returns the zoom and tile counts of basemap_image.
+    """
+    xmin, xmax = ax.get_xlim()
+    ymin, ymax = ax.get_ylim()
+    bounds = (xmin, ymin, xmax, ymax)
+    ax.apply_aspect()   # Settle the axis box before measuring it
+    box = ax.get_window_extent()
+    zoom = choose_zoom(bounds, (box.width * output_scale, box.height * output_scale), zoom, max_tiles,
+                       provider.get("max_zoom", DEFAULT_MAX_ZOOM))
+    image, extent, counts = basemap_image(bounds, zoom, provider, cache)
+    ax.imshow(image, extent=extent, interpolation="bilinear", aspect=ax.get_aspect())
+    ax.axis((min(xmin, extent[0]), max(xmax, extent[1]), min(ymin, extent[2]), max(ymax, extent[3])))
+    attribution = provider.get("attribution")
+    if attribution:
+        ctx.add_attribution(ax, attribution)
+    return counts
@@ -0,0 +1,72 @@
+"""
+Columnar track model for parsed FIT records.
+Holds one typed NumPy array per field instead of a list of per-record dicts.
+"""
+
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+
+import numpy as np
+
+# In Garmin's FIT format, GPS coordinates are recorded in units called "semicircles":
+# 2^31 semicircles = 180 degrees (a hemisphere)
+SEMICIRCLES_TO_DEGREES = 180 / 2**31
+
+@dataclass
+class Track:
+    """
+    Parsed ride track. All arrays have the same length (one entry per record).
+    Missing speed/HR/cadence values are stored as 0 and flagged False in their mask.
+    """
+    time: np.ndarray        # int64, seconds since Unix epoch (UTC)
+    lat: np.ndarray         # float64, degrees
+    lon: np.ndarray         # float64, degrees
+    alt: np.ndarray         # float32, meters
+    speed: np.ndarray       # float32, m/s
+    hr: np.ndarray          # uint8, bpm
+    cad: np.ndarray         # uint16, rpm
+    speed_valid: np.ndarray # bool
+    hr_valid: np.ndarray    # bool
+    cad_valid: np.ndarray   # bool
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the total memory used by the track arrays."""
+        return sum(getattr(self, f.name).nbytes for f in fields(self))
+
+    @classmethod
+    def from_columns(cls, time, lat, lon, alt, speed, hr, cad):
+        """
+        Builds a Track from per-field sequences.
+        - time: datetime objects (naive values are treated as UTC) or epoch seconds
+        - speed, hr, cad: may contain None for missing values
+        """
+        speed_valid = np.array([v is not None for v in speed], dtype=bool)
+        hr_valid = np.array([v is not None for v in hr], dtype=bool)
+        cad_valid = np.array([v is not None for v in cad], dtype=bool)
+        return cls(
+            time=np.array([_epoch_seconds(t) for t in time], dtype=np.int64),
+            lat=np.asarray(lat, dtype=np.float64),
+            lon=np.asarray(lon, dtype=np.float64),
+            alt=np.asarray(alt, dtype=np.float32),
+            speed=np.array([v or 0 for v in speed], dtype=np.float32),
+            hr=np.array([v or 0 for v in hr], dtype=np.uint8),
+            cad=np.array([v or 0 for v in cad], dtype=np.uint16),
+            speed_valid=speed_valid,
+            hr_valid=hr_valid,
+            cad_valid=cad_valid,
+        )
+
+def _epoch_seconds(t) -> int:
+    """
+    Converts a FIT timestamp to seconds since Unix epoch.
+    fitparse returns naive datetimes in UTC.
+    """
+    if isinstance(t, datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        return int(t.timestamp())
+    return int(t)
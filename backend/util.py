@@ -1,26 +1,31 @@
 """
 utility functions used by both frontend and backend.
 """
+import hashlib
+import struct
 from pathlib import Path
+import numpy as np
 from backend.logger import get_logger
 
 logger = get_logger(__name__)
 
+FIT_HEADER_SIZES = (12, 14)    # Header without and with the header CRC
+
 def validate_fit_header(content: bytes) -> bool:
     """
     Validates the FIT file header structure.
     Returns True if valid, False otherwise.
     
-    0 Header size (typically 14)
+    0 Header size (12, or 14 with a header CRC)
     1–7 Protocol version, profile version, data size, etc.
     8–11 Data size (4 bytes)
     12–13 Identifier “.FIT” (ASCII: 0x2E 0x46 0x49 0x54)
     14 CRC (optional)
     """
     try:
-        if len(content) < 14:
+        if len(content) < 12:
             return False
-        if content[0] != 14:
+        if content[0] not in FIT_HEADER_SIZES:
             return False
         if content[8:12] != b'.FIT':
             return False
@@ -28,6 +33,130 @@ def validate_fit_header(content: bytes) -> bool:
     except Exception:
         return False
 
+def _make_crc_table():
+    """
+    Builds the byte-wise lookup table for the FIT CRC (CRC-16, polynomial 0xA001).
+    """
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _make_crc_table()
+_CRC_TABLE_NP = np.array(_CRC_TABLE, dtype=np.uint16)
+CRC_BLOCK = 64      # Bytes per block when checksumming blocks side by side
+
+def _crc_rows(rows: np.ndarray, crc: np.ndarray) -> np.ndarray:
+    """
+    Runs the CRC over every row of a 2-D uint8 array at once, starting from crc per row.
+    """
+    for column in rows.T:
+        crc = (crc >> 8) ^ _CRC_TABLE_NP[(crc ^ column) & 0xFF]
+    return crc
+
+# The CRC is linear with a zero initial value, so crc(c, block) == _CRC_SHIFT[c] ^ crc(0, block)
+_CRC_SHIFT = _crc_rows(np.broadcast_to(np.uint8(0), (65536, CRC_BLOCK)),
+                       np.arange(65536, dtype=np.uint16)).tolist()
+
+def fit_crc(content: bytes, crc: int = 0) -> int:
+    """
+    Computes the FIT CRC of the given bytes.
+    Pass the previous result as crc to continue a running checksum over chunks.
+    Whole CRC_BLOCK-byte blocks are checksummed side by side with NumPy and then combined.
+    """
+    table = _CRC_TABLE
+    head = len(content) % CRC_BLOCK
+    for byte in content[:head]:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    if len(content) == head:
+        return crc
+    rows = np.frombuffer(content, dtype=np.uint8, offset=head).reshape(-1, CRC_BLOCK)
+    shift = _CRC_SHIFT
+    for block_crc in _crc_rows(rows, np.zeros(len(rows), dtype=np.uint16)).tolist():
+        crc = shift[crc] ^ block_crc
+    return crc
+
+class FitStreamValidator:
+    """
+    Validates a FIT file fed in chunks and hashes it in the same pass.
+    Chained FIT files (several FIT files back to back) are validated one after another.
+    For each, checks the header, the header CRC (when present), the declared size and the file CRC.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.files = 0          # Files completely validated so far
+        self.header = b""       # Header of the current file, while it is read
+        self.remaining = 0      # Data and CRC bytes left in the current file
+        self.crc = 0
+        self.sha256 = hashlib.sha256()
+
+    def update(self, chunk: bytes):
+        """
+        Feeds the next chunk of the file.
+        Raises ValueError as soon as a header or file CRC is invalid.
+        """
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+        view = memoryview(chunk)
+        pos = 0
+        while pos < len(view):
+            if not self.remaining:
+                pos = self._read_header(view, pos)
+                continue
+            part = view[pos:pos + self.remaining]
+            self.crc = fit_crc(part, self.crc)
+            self.remaining -= len(part)
+            pos += len(part)
+            if not self.remaining:
+                if self.crc != 0:   # The running CRC over a file plus its trailing CRC is zero
+                    raise ValueError("FIT file CRC mismatch")
+                self.files += 1
+                self.header = b""
+
+    def _read_header(self, view: memoryview, pos: int) -> int:
+        """
+        Collects header bytes of the next file from view[pos:], checking the header once complete.
+        Returns the position after the bytes consumed.
+        """
+        header_size = self.header[0] if self.header else view[pos]
+        if header_size not in FIT_HEADER_SIZES:
+            raise ValueError("Invalid FIT header")
+        part = bytes(view[pos:pos + header_size - len(self.header)])
+        self.header += part
+        if len(self.header) == header_size:
+            if not validate_fit_header(self.header):
+                raise ValueError("Invalid FIT header")
+            if header_size == 14:
+                header_crc, = struct.unpack_from("<H", self.header, 12)
+                if header_crc and header_crc != fit_crc(self.header[:12]):
+                    raise ValueError("FIT header CRC mismatch")
+            data_size, = struct.unpack_from("<I", self.header, 4)
+            self.crc = fit_crc(self.header)
+            self.remaining = data_size + 2
+        return pos + len(part)
+
+    def finish(self) -> str:
+        """
+        Returns the hex SHA-256 digest of a valid file.
+        Raises ValueError describing the first check that failed.
+        """
+        if self.header or self.remaining:
+            raise ValueError(f"FIT size mismatch: file {self.files + 1} is truncated at {self.size} bytes")
+        if not self.files:
+            raise ValueError("Invalid FIT header")
+        return self.sha256.hexdigest()
+
+def file_sha256(path: Path) -> str:
+    """
+    Returns the hex SHA-256 digest of a file's content.
+    """
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
 def ensure_parent_dir(filepath: Path) -> None:
     """
     Ensures that the parent directory of the given filepath exists.
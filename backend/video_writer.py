@@ -0,0 +1,331 @@
+"""
+Frame writers for rendered RGB frames.
+Frames are streamed as rawvideo into ffmpeg from an encoder thread, so memory does
+not grow with the frame count: MP4/WebM are encoded as video, GIFs through
+paletteuse with a palette generated from the first frame, and animated WebP with
+libwebp. Thumbnails are saved straight from a rendered frame.
+Writers accept per-frame durations, so a frame held for several periods is written once.
+Video and WebP encoder settings come from named encoding profiles.
+A FanOutWriter passes each frame to several writers, so one render produces every
+rendition (size and format) of an animation.
+"""
+
+import os
+from pathlib import Path
+from queue import Queue, Full
+from threading import Thread
+
+import ffmpeg
+import numpy as np
+from PIL import Image
+
+MAX_HELD_FRAMES = 512   # Holds encoded as one timestamped frame; each adds a term to the setpts expression
+IMAGE_SUFFIXES = (".gif", ".webp")  # Animated image outputs; encoded in one pass, never segmented
+
+# Encoding profiles trading encode speed against file size and quality.
+# - preset: x264 speed preset; crf: x264 constant rate factor (lower: better, larger)
+# - gop_seconds: keyframe interval; map animations are mostly static, so keyframes dominate
+#   the file size (2 s GOPs are about 3x larger than 10 s ones)
+# - webp_quality: libwebp quality (0-100)
+# tune=animation suits the flat colors and small moving marker of every profile.
+# Chosen with `python -m backend.benchmark encoding`; see the README for measurements.
+ENCODING_PROFILES = {
+    "draft":    {"preset": "ultrafast", "crf": 30, "gop_seconds": 20, "webp_quality": 50},
+    "standard": {"preset": "veryfast", "crf": 23, "gop_seconds": 10, "webp_quality": 75},
+    "archival": {"preset": "slow", "crf": 18, "gop_seconds": 10, "webp_quality": 90},
+}
+
+class FFmpegFrameWriter:
+    """
+    Streams (H, W, 3) RGB or (H, W, 4) RGBA uint8 frames into an ffmpeg rawvideo pipe.
+    The output format follows the file suffix: video (MP4, WebM, ...), GIF or animated WebP.
+
+    Frames are handed to a separate encoder thread through a bounded queue and written
+    to ffmpeg's stdin straight from their buffer, so rendering and encoding overlap on
+    different cores. Callers must not modify a frame after passing it to write().
+    With queue_size=0 frames are written synchronously.
+
+    `durations` gives the number of frame periods each written frame is shown for.
+    Held frames are encoded once and delayed with timestamps (variable frame rate
+    output), so x264 does not encode the same picture again; only the MAX_HELD_FRAMES
+    longest holds are timestamped and shorter ones are repeated in the pipe. Segments
+    joined with concat_segments need max_held=0: the concat demuxer mis-times B-frames
+    of variable frame rate segments, so their held frames are repeated instead.
+
+    Video and animated WebP encoder settings come from ENCODING_PROFILES[profile]; `threads`
+    limits the encoder threads (0: ffmpeg's default, about one per core).
+    `scale_height` scales the output to that many pixels high (rounded down to even),
+    keeping the aspect ratio.
+
+    GIF colors come from a palette generated from the first frame: the map, profile and
+    overlay box are static, so it covers nearly every color of the animation. ffmpeg
+    is therefore started by the first write(). Animated WebP holds frames by repeating
+    them, which libwebp merges into one longer frame.
+    """
+
+    def __init__(self, output_path: Path, width: int, height: int, fps: int,
+                 codec: str = "libx264", profile: str = "standard", threads: int = 0, channels: int = 3,
+                 queue_size: int = 8, durations=None, max_held: int = MAX_HELD_FRAMES, scale_height: int = None):
+        if profile not in ENCODING_PROFILES:
+            raise ValueError(f"Unknown encoding profile '{profile}'. Expected one of {tuple(ENCODING_PROFILES)}")
+        self.output_path = Path(output_path)
+        self.frame_shape = (height, width, channels)
+        self.fps = fps
+        self.codec = codec
+        self.profile = ENCODING_PROFILES[profile]
+        self.threads = threads
+        self.scale_height = scale_height
+        if self.output_path.suffix.lower() == ".webp":
+            max_held = 0    # libwebp merges repeated frames into one longer frame itself
+        self.setpts, self.repeats = hold_timestamps(durations, max_held) if durations is not None else (None, None)
+        self.palette_path = None
+        self.process = None if self.output_path.suffix.lower() == ".gif" else self._start()
+        self.written = 0
+        self.last_frame = None
+        self.error = None
+        self.queue = None
+        self.thread = None
+        if queue_size > 0:
+            self.queue = Queue(maxsize=queue_size)
+            self.thread = Thread(target=self._encode_loop, name="ffmpeg-encoder", daemon=True)
+            self.thread.start()
+
+    def write(self, frame: np.ndarray):
+        """
+        Queues a frame for encoding. Blocks while the queue is full.
+        """
+        if frame.shape != self.frame_shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match writer shape {self.frame_shape}")
+        if self.error:
+            raise RuntimeError(f"ffmpeg encoder failed: {self.error}")
+        if self.process is None:
+            self.process = self._start(palette_frame=frame)
+        repeats = 1 if self.repeats is None else int(self.repeats[self.written])
+        self.written += 1
+        self.last_frame = frame
+        if self.queue is None:
+            self._write_frame(frame, repeats)
+        else:
+            self.queue.put((frame, repeats))
+
+    def close(self):
+        """
+        Flushes queued frames and waits for ffmpeg to finish the file.
+        """
+        if self.process is None:
+            return      # Nothing was written
+        if self.setpts and self.last_frame is not None:
+            # A variable-rate frame lasts until the next timestamp and ffmpeg drops the final
+            # frame for lack of one; sending the last frame again marks where the video ends
+            if self.queue is None:
+                self._write_frame(self.last_frame)
+            else:
+                self.queue.put((self.last_frame, 1))
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass    # ffmpeg already exited; its return code tells why
+        self.process.wait()
+        self._remove_palette()
+        if self.process.returncode != 0 or self.error:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode} writing {self.output_path}: {self.error}")
+
+    def abort(self):
+        """
+        Stops ffmpeg without finishing the file.
+        """
+        if self.process is None:
+            return
+        self.process.kill()
+        if self.thread:
+            # Unblock the encoder thread, which exits on the broken pipe or the sentinel
+            while self.thread.is_alive():
+                try:
+                    self.queue.put(None, timeout=0.1)
+                except Full:
+                    pass
+                self.thread.join(timeout=0.1)
+        self.process.wait()
+        self._remove_palette()
+
+    def _start(self, palette_frame=None):
+        """
+        Starts ffmpeg reading rawvideo frames from stdin and encoding them by output suffix.
+        """
+        height, width, channels = self.frame_shape
+        pix_fmt = {3: "rgb24", 4: "rgba"}[channels]
+        stream = ffmpeg.input("pipe:", format="rawvideo", pix_fmt=pix_fmt, s=f"{width}x{height}", framerate=self.fps)
+        options = {"loglevel": "error"}
+        if self.threads:
+            options["threads"] = self.threads
+        if self.setpts:
+            stream = stream.filter("setpts", self.setpts)
+            options["fps_mode"] = "vfr"
+        if self.scale_height:
+            stream = self._scale(stream)
+
+        suffix = self.output_path.suffix.lower()
+        if suffix == ".gif":
+            self.palette_path = self.output_path.with_name(f"{self.output_path.name}.palette-{os.getpid()}.png")
+            Image.fromarray(palette_frame[:, :, :3]).save(self.palette_path, compress_level=1)
+            palette = ffmpeg.input(str(self.palette_path))
+            if self.scale_height:
+                palette = self._scale(palette)
+            palette = palette.filter("palettegen", stats_mode="full")
+            # diff_mode re-dithers only the changed rectangle, so static areas stay identical between frames
+            stream = ffmpeg.filter([stream, palette], "paletteuse", dither="bayer", bayer_scale=3,
+                                   diff_mode="rectangle")
+            options["loop"] = 0
+        elif suffix == ".webp":
+            options.update(vcodec="libwebp_anim", quality=self.profile["webp_quality"], loop=0)
+        else:
+            options.update(vcodec=self.codec, pix_fmt="yuv420p", preset=self.profile["preset"],
+                           crf=self.profile["crf"], tune="animation", g=self.profile["gop_seconds"] * self.fps)
+        return (
+            stream
+            .output(str(self.output_path), **options)
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+        )
+
+    def _scale(self, stream):
+        # yuv420p needs even sizes: -2 keeps the width even and the height is rounded down.
+        # Area averaging suits downscaling and is cheap.
+        return stream.filter("scale", -2, self.scale_height - self.scale_height % 2, flags="area")
+
+    def _remove_palette(self):
+        if self.palette_path:
+            self.palette_path.unlink(missing_ok=True)
+
+    def _write_frame(self, frame: np.ndarray, repeats: int = 1):
+        # memoryview over a C-contiguous frame avoids copying it into a bytes object
+        data = memoryview(np.ascontiguousarray(frame)).cast("B")
+        for _ in range(repeats):
+            self.process.stdin.write(data)
+
+    def _encode_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue    # Drain so the producer never blocks on a dead encoder
+            try:
+                self._write_frame(*item)
+            except Exception as e:
+                self.error = e
+
+THUMBNAIL_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".webp": "WEBP", ".png": "PNG"}
+
+def save_thumbnail(frame: np.ndarray, path: Path, width: int = 512):
+    """
+    Scales an RGB frame to `width` pixels (keeping its aspect ratio) and saves it
+    as JPEG, WebP or PNG by file suffix. The file is replaced atomically.
+    """
+    path = Path(path)
+    image_format = THUMBNAIL_FORMATS.get(path.suffix.lower())
+    if image_format is None:
+        raise ValueError(f"Unsupported thumbnail format: {path.suffix}")
+    image = Image.fromarray(frame)
+    height = max(1, round(image.height * width / image.width))
+    image = image.resize((width, height), Image.Resampling.LANCZOS)
+    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    image.save(tmp_path, format=image_format, quality=90)
+    os.replace(tmp_path, path)
+
+def hold_timestamps(durations, max_held: int = MAX_HELD_FRAMES):
+    """
+    Splits per-frame durations (in frame periods) into the max_held longest holds, expressed
+    with timestamps, and holds repeated in the pipe.
+    Returns (setpts expression delaying the frames after each timestamped hold or None,
+    number of times each frame is written to the pipe).
+    """
+    durations = np.asarray(durations, dtype=np.int64)
+    # Only the start of the next frame gives a timestamped frame its length, so the last hold is repeated
+    held = np.flatnonzero(durations[:-1] > 1)
+    if len(held) > max_held:
+        held = np.sort(held[np.argsort(durations[held], kind="stable")[len(held) - max_held:]])
+    repeats = durations.copy()
+    repeats[held] = 1
+    if not len(held):
+        return None, repeats
+    delays = "+".join(f"gt(N,{i})*{durations[i] - 1}" for i in held)
+    return f"PTS+round(({delays})/FRAME_RATE/TB)", repeats
+
+class FanOutWriter:
+    """
+    Writes every frame to several frame writers, each with its own ffmpeg process and
+    encoder thread, so the encoders run in parallel on frames that are rendered once.
+    Frames are shared by reference, not copied.
+    """
+
+    def __init__(self, writers):
+        self.writers = list(writers)
+
+    def write(self, frame: np.ndarray):
+        for writer in self.writers:
+            writer.write(frame)
+
+    def close(self):
+        """
+        Finishes every output; raises the first failure after all writers are closed.
+        """
+        errors = []
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+def open_frame_writer(output_path: Path, width: int, height: int, fps: int, *,
+                      profile: str = "standard", threads: int = 0, channels: int = 3, queue_size: int = 8,
+                      durations=None, max_held: int = MAX_HELD_FRAMES, renditions=()):
+    """
+    Returns the frame writer for the output file; its suffix selects the format.
+    - renditions: (path, height) pairs of further outputs encoded from the same frames,
+      scaled to that height (None: frame size). Returns a FanOutWriter when given.
+    """
+    def writer(path, output_height=None):
+        return FFmpegFrameWriter(path, width, height, fps, profile=profile, threads=threads, channels=channels,
+                                 queue_size=queue_size, durations=durations, max_held=max_held,
+                                 scale_height=output_height)
+
+    if not renditions:
+        return writer(output_path)
+    writers = []
+    try:
+        writers.append(writer(output_path))
+        for path, output_height in renditions:
+            writers.append(writer(path, output_height))
+    except BaseException:
+        for started in writers:
+            started.abort()
+        raise
+    return FanOutWriter(writers)
+
+def concat_segments(segment_paths, output_path: Path):
+    """
+    Joins video segments encoded with identical settings into one file
+    using the ffmpeg concat demuxer, without re-encoding.
+    """
+    list_path = Path(output_path).with_suffix(".segments.txt")
+    list_path.write_text("".join(f"file '{Path(p).resolve()}'\n" for p in segment_paths))
+    try:
+        (
+            ffmpeg
+            .input(str(list_path), format="concat", safe=0)
+            .output(str(output_path), c="copy", loglevel="error")
+            .overwrite_output()
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+    finally:
+        list_path.unlink(missing_ok=True)
@@ -1,7 +1,10 @@
 import os
+import json
 import time
 import logging
 import requests
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -10,6 +13,16 @@ load_dotenv()
 API_BASE_HOST = os.environ.get("API_BASE_HOST", "http://localhost")
 API_BASE_PORT = os.environ.get("API_BASE_PORT", "8000")
 API_BASE = f"{API_BASE_HOST}:{API_BASE_PORT}"
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "2"))
+# The browser plays and downloads videos straight from the API (/videos/{ticket_id}), which
+# streams them with ETag and Range support; set this when the browser reaches the API elsewhere
+API_PUBLIC_URL = os.environ.get("API_PUBLIC_URL", API_BASE).rstrip("/")
+POLL_TICK_SECONDS = 1       # How often the status poller wakes up
+POLL_MIN_SECONDS = 1        # First /status poll after starting a generation
+POLL_MAX_SECONDS = 15       # Backoff cap between /status polls
+API_TIMEOUT = 30            # seconds
+PREVIEW_DEBOUNCE_SECONDS = 1.5  # Parameters must stay unchanged this long before a live preview is requested
+PREVIEW_TICK_SECONDS = 0.5      # How often the live preview checks whether its parameters have settled
 
 def setup_logger(name=__name__):
     logger = logging.getLogger(name)
@@ -27,39 +40,151 @@ def setup_logger(name=__name__):
 
 logger = setup_logger("RideAnimationGenerator")
 
-# Initialize session state
-if "status" not in st.session_state:
-    st.session_state.status = None
-    st.session_state.ticket_id = ""
-    st.session_state.error_message = ""
-    st.session_state.thumbnail = None
-    st.session_state.video = None
+@st.cache_resource
+def api_session():
+    """
+    Returns the HTTP session shared by every browser session.
+    Its connection pool keeps connections to the API open across reruns.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-# Fetch status if ticket_id is set
-if st.session_state.ticket_id:
+def api_request(method, path, ticket_id, **kwargs):
+    """
+    Sends a request for a ticket to the API through the shared session.
+    """
+    headers = {"ticket-id": ticket_id, **kwargs.pop("headers", {})}
+    return api_session().request(method, f"{API_BASE}{path}", headers=headers, timeout=API_TIMEOUT, **kwargs)
+
+def error_detail(res, default):
+    """
+    Returns the error detail of an API response, or default when it has none.
+    """
+    try:
+        return res.json().get("detail", default)
+    except ValueError:
+        return default
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def fetch_preview(ticket_id, params_json):
+    """
+    Fetches the keyframe preview PNG for a ticket and parameter set.
+    Cached so reruns that do not change parameters skip the request.
+    """
+    res = api_request("POST", "/preview", ticket_id, json=json.loads(params_json))
+    if res.status_code != 200:
+        raise RuntimeError(error_detail(res, "Preview failed"))
+    return res.content
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def fetch_thumbnail(ticket_id, etag):
+    """
+    Fetches a ticket's thumbnail. Keyed by its ETag, so every session showing the same
+    thumbnail shares one copy and a regenerated one is fetched again.
+    """
+    res = api_request("GET", "/thumbnail", ticket_id)
+    if res.status_code != 200:
+        raise RuntimeError(error_detail(res, "Thumbnail fetch failed"))
+    return res.content
+
+def video_url(ticket_id):
+    """
+    Returns (URL, media type) of the ticket's video for the browser to load from the API.
+    The ETag in the query string changes the URL whenever the video is regenerated, so the
+    browser never plays a stale copy; the video itself never passes through Streamlit.
+    """
+    head = api_request("HEAD", "/video", ticket_id)
+    if head.status_code != 200:
+        raise RuntimeError(f"Video not available ({head.status_code})")
+    media_type = head.headers.get("content-type", "video/mp4")
+    etag = head.headers["etag"].strip('"')
+    return f"{API_PUBLIC_URL}/videos/{quote(ticket_id, safe='')}?v={etag}", media_type
+
+def fetch_status():
+    """
+    Fetches the ticket's status into session state.
+    """
+    ticket_id = st.session_state.ticket_id
     try:
-        logger.debug(f"Fetching status for ticket_id={st.session_state.ticket_id}")
-        res = requests.get(f"{API_BASE}/status", headers={"ticket-id": st.session_state.ticket_id})
+        logger.debug(f"Fetching status for ticket_id={ticket_id}")
+        res = api_request("GET", "/status", ticket_id)
         if res.status_code == 200:
             info = res.json()
             st.session_state.error_message = ""
             new_status = info.get("status")
             if st.session_state.status != new_status:
-                logger.info(f"{st.session_state.ticket_id} Status changed:{st.session_state.status} to {new_status}")
+                logger.info(f"{ticket_id} Status changed:{st.session_state.status} to {new_status}")
             st.session_state.status = new_status
         else:
             logger.warning(f"Status fetch error: {res.status_code}, {res.text}")
-            st.session_state.error_message = res.json().get("detail", "Unknown error")
+            st.session_state.error_message = error_detail(res, "Unknown error")
     except Exception as e:
         logger.error(f"Failed to fetch status: {e}")
         st.session_state.error_message = f"Failed to fetch status: {e}"
         st.session_state.status = None
 
-    # Auto-refresh if processing
-    if st.session_state.status == "generate_processing":
-        with st.spinner("Generating animation... Please wait."):
-            time.sleep(5)
-            st.rerun()
+def reset_polling():
+    """
+    Restarts the status polling backoff, e.g. after starting a generation.
+    """
+    st.session_state.poll_delay = POLL_MIN_SECONDS
+    st.session_state.next_poll = time.monotonic() + POLL_MIN_SECONDS
+
+@st.fragment(run_every=POLL_TICK_SECONDS)
+def status_poller():
+    """
+    Polls /status while an animation is generating, doubling the interval after every
+    unchanged answer up to POLL_MAX_SECONDS. Only this fragment reruns on each tick;
+    the whole page reruns once the status changes.
+    """
+    if time.monotonic() < st.session_state.next_poll:
+        return
+    fetch_status()
+    if st.session_state.status != "generate_processing":
+        st.rerun()
+    st.session_state.poll_delay = min(st.session_state.poll_delay * 2, POLL_MAX_SECONDS)
+    st.session_state.next_poll = time.monotonic() + st.session_state.poll_delay
+
+def live_preview(ticket_id, params):
+    """
+    Shows the keyframe preview of params once they have stayed unchanged for
+    PREVIEW_DEBOUNCE_SECONDS, so a burst of edits sends one /preview request.
+    """
+    params_json = json.dumps(params, sort_keys=True)
+    if params_json != st.session_state.preview_params:
+        st.session_state.preview_params = params_json
+        st.session_state.preview_due = time.monotonic() + PREVIEW_DEBOUNCE_SECONDS
+    preview_panel(ticket_id)
+
+@st.fragment(run_every=PREVIEW_TICK_SECONDS)
+def preview_panel(ticket_id):
+    """
+    Renders the live preview once its parameters have settled. Only this fragment
+    reruns on each tick; settled previews are served from fetch_preview's cache.
+    """
+    if time.monotonic() < st.session_state.preview_due:
+        st.caption("Preview updates when the parameters stop changing...")
+        return
+    try:
+        with st.spinner("Rendering preview..."):
+            preview = fetch_preview(ticket_id, st.session_state.preview_params)
+        st.image(preview, caption="Preview (start, middle, end)")
+    except Exception as e:
+        logger.warning(f"Preview failed: {e}")
+        st.warning(f"Preview unavailable: {e}")
+
+# Initialize session state
+for key, default in (("status", None), ("ticket_id", ""), ("error_message", ""),
+                     ("poll_delay", POLL_MIN_SECONDS), ("next_poll", 0.0),
+                     ("preview_params", ""), ("preview_due", 0.0)):
+    st.session_state.setdefault(key, default)
+
+# Fetch status if ticket_id is set
+if st.session_state.ticket_id:
+    fetch_status()
 
 # UI
 st.title("🚴 Ride Animation Generator")
@@ -80,7 +205,10 @@ st.text(f"Ticket ID: {ticket_id}")
 if error_message:
     st.error(error_message)
 
-if status == "upload_done":
+if status == "generate_processing":
+    st.info("Generating animation... The page updates when it is done.")
+    status_poller()
+elif status == "upload_done":
     st.success("Upload completed.")
 elif status == "upload_error":
     st.error("Upload failed.")
@@ -98,7 +226,7 @@ else:
 # -------------------------------
 st.header("Upload FIT File")
 
-st.markdown("**Note:** Maximum file size is **2MB**. Only `.fit` files are accepted.")
+st.markdown(f"**Note:** Maximum file size is **{MAX_UPLOAD_MB}MB**. Only `.fit` files are accepted.")
 uploaded_file = st.file_uploader("Select a FIT file", type=["fit"])
 if st.button("📤 Upload") and uploaded_file:
     try:
@@ -106,20 +234,17 @@ if st.button("📤 Upload") and uploaded_file:
         files = {
             "file": ("filename.fit", uploaded_file.getvalue(), "application/octet-stream")
         }
-        res = requests.post(f"{API_BASE}/upload", files=files)
-        # res = requests.post(f"{API_BASE}/upload", files={"file": uploaded_file})
+        res = api_session().post(f"{API_BASE}/upload", files=files, timeout=API_TIMEOUT)
         if res.status_code == 200:
             data = res.json()
-            logger.info(f"Upload successful, ticket_id={st.session_state.ticket_id}")
             st.session_state.ticket_id = data["ticket_id"]
-            st.session_state.thumbnail = None
-            st.session_state.video = None
+            logger.info(f"Upload successful, ticket_id={st.session_state.ticket_id}")
             st.session_state.error_message = ""
             st.rerun()
         else:
-            st.session_state.error_message = res.json().get("detail", "Upload failed")
+            st.session_state.error_message = error_detail(res, "Upload failed")
     except Exception as e:
-        logger.errror(f"Upload request failed: {e}")
+        logger.error(f"Upload request failed: {e}")
         st.session_state.error_message = f"Upload request failed: {e}"
 
 # -------------------------------
@@ -131,12 +256,18 @@ if status in ["upload_done", "generate_error", "generate_done"]:
     col1, col2, col3 = st.columns(3)
     with col1:
         title = st.text_input("Title", value="My Ride")
-        zoom = st.selectbox("Zoom", [12, 13, 14], index=1)
+        zoom = st.selectbox("Zoom", ["auto", 12, 13, 14], index=2)
     with col2:
         fps = st.selectbox("FPS", [10, 30, 60], index=1)
         step_frame = st.selectbox("Step Frame", [30, 60, 120], index=1)
+        target_duration = st.selectbox("Video Length (s)", [None, 30, 60, 120], index=0,
+                                       format_func=lambda v: "Use Step Frame" if v is None else str(v))
     with col3:
         dpi = st.selectbox("DPI", [50, 100, 150], index=1)
+        output_format = st.selectbox("Format", ["mp4", "gif", "webp"], index=0,
+                                     format_func=lambda v: {"mp4": "MP4", "gif": "GIF", "webp": "Animated WebP"}[v])
+        encoding_profile = st.selectbox("Quality", ["draft", "standard", "archival"], index=1,
+                                        format_func=str.capitalize)
         no_smoothing = st.checkbox("Disable Elevation Smoothing", value=False)
 
     tile = st.selectbox("Map Tile", [
@@ -148,29 +279,34 @@ if status in ["upload_done", "generate_error", "generate_done"]:
         "CartoDB.Voyager"
     ], index=0)
 
+    params = {
+        "title": title,
+        "fps": fps,
+        "dpi": dpi,
+        "zoom": zoom,
+        "step_frame": step_frame,
+        "target_duration": target_duration,
+        "no_elevation_smoothing": no_smoothing,
+        "tile": tile,
+        "output_format": output_format,
+        "encoding_profile": encoding_profile
+    }
+
+    # Live preview (opt-in): keyframes rendered at low resolution by the API once the parameters settle
+    if st.checkbox("Live preview", value=False):
+        live_preview(ticket_id, params)
+
     if st.button("🎬 Generate"):
         try:
             logger.info(f"Requesting generation for ticket_id={ticket_id} with title={title}, fps={fps}, dpi={dpi}, zoom={zoom}, step_frame={step_frame}, no_smoothing={no_smoothing}, tile={tile}")
-            res = requests.post(f"{API_BASE}/generate",
-                headers={"ticket-id": ticket_id},
-                json={
-                    "title": title,
-                    "fps": fps,
-                    "dpi": dpi,
-                    "zoom": zoom,
-                    "step_frame": step_frame,
-                    "no_elevation_smoothing": no_smoothing,
-                    "tile": tile
-                }
-            )
+            res = api_request("POST", "/generate", ticket_id, json=params)
             if res.status_code != 200:
                 logger.warning(f"Generation request failed: {res.status_code}, {res.text}")
-                st.session_state.error_message = res.json().get("detail", "Generation failed")
+                st.session_state.error_message = error_detail(res, "Generation failed")
             else:
                 logger.info("Generation request accepted")
                 st.session_state.error_message = ""
-                st.session_state.thumbnail = None
-                st.session_state.video = None
+                reset_polling()
                 st.rerun()
         except Exception as e:
             logger.error(f"Generation request failed: {e}")
@@ -182,40 +318,26 @@ if status in ["upload_done", "generate_error", "generate_done"]:
 if status == "generate_done":
     st.header("Animation Result")
 
-    # Fetch thumbnail once
-    if st.session_state.thumbnail is None:
-        try:
-            logger.info(f"Fetching thumbnail for ticket_id={ticket_id}")
-            thumb_res = requests.get(f"{API_BASE}/thumbnail", headers={"ticket-id": ticket_id})
-            if thumb_res.status_code == 200:
-                st.session_state.thumbnail = thumb_res.content
-                logger.info("Thumbnail fetched successfully")
-            else:
-                logger.warning(f"Thumbnail fetch failed: {thumb_res.status_code}, {thumb_res.text}")
-                st.session_state.error_message = thumb_res.json().get("detail", "Thumbnail fetch failed")
-        except Exception as e:
-            logger.exception("Thumbnail fetch error")
-            st.session_state.error_message = f"Thumbnail fetch error: {e}"
-            
-    # Display thumbnail if available
-    if st.session_state.thumbnail:
-        st.image(st.session_state.thumbnail, caption="Thumbnail")
-
-    # Fetch video once
-    if st.session_state.video is None:
-        try:
-            logger.info(f"Fetching video for ticket_id={ticket_id}")
-            video_res = requests.get(f"{API_BASE}/video", headers={"ticket-id": ticket_id})
-            if video_res.status_code == 200:
-                st.session_state.video = video_res.content
-                logger.info("Video fetched successfully")
-            else:
-                logger.warning(f"Video fetch failed: {video_res.status_code}, {video_res.text}")
-                st.session_state.error_message = video_res.json().get("detail", "Video fetch failed")
-                
-        except Exception as e:
-            logger.exception("Video fetch error")
-            st.session_state.error_message = f"Video fetch error: {e}"
-            
-    if st.session_state.video:
-        st.download_button("📥 Download Video", st.session_state.video, file_name="ride.mp4")
+    # The thumbnail is fetched only when its ETag changes; reruns and other sessions reuse it
+    try:
+        head = api_request("HEAD", "/thumbnail", ticket_id)
+        if head.status_code == 200:
+            st.image(fetch_thumbnail(ticket_id, head.headers.get("etag")), caption="Thumbnail")
+        else:
+            logger.warning(f"Thumbnail fetch failed: {head.status_code}")
+            st.session_state.error_message = "Thumbnail fetch failed"
+    except Exception as e:
+        logger.exception("Thumbnail fetch error")
+        st.session_state.error_message = f"Thumbnail fetch error: {e}"
+
+    # The browser plays and downloads the video from the API, not session memory
+    try:
+        url, video_type = video_url(ticket_id)
+        if video_type.startswith("image/"):
+            st.image(url, caption="Animation")
+        else:
+            st.video(url)
+        st.markdown(f'<a href="{url}&download=true">📥 Download Video</a>', unsafe_allow_html=True)
+    except Exception as e:
+        logger.exception("Video fetch error")
+        st.session_state.error_message = f"Video fetch error: {e}"
@@ -0,0 +1,64 @@
+"""
+Shared test setup. Storage directories point into a temporary directory and an in-process
+fakeredis server stands in for Redis; both are set up before any backend module is imported,
+since backend modules read their configuration and connect to Redis at import time.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+from functools import partial
+from pathlib import Path
+
+import fakeredis
+import pytest
+
+STORAGE = Path(tempfile.mkdtemp(prefix="ride-animator-tests-"))
+atexit.register(shutil.rmtree, STORAGE, ignore_errors=True)
+for name in ("VIDEO_FILES_DIR", "THUMBNAIL_FILES_DIR", "FIT_FILES_DIR"):
+    os.environ[name] = str(STORAGE / name.lower())
+    (STORAGE / name.lower()).mkdir()
+os.environ["TILE_CACHE_PATH"] = str(STORAGE / "tiles" / "tiles.sqlite3")
+
+from backend import redis_client   # noqa: E402  (after the environment is set)
+
+REDIS_SERVER = fakeredis.FakeServer()
+redis_client.Redis = partial(fakeredis.FakeRedis, server=REDIS_SERVER)
+
+@pytest.fixture(autouse=True)
+def flush_redis():
+    """
+    Gives every test an empty Redis.
+    """
+    yield
+    fakeredis.FakeRedis(server=REDIS_SERVER).flushall()
+
+@pytest.fixture(scope="session")
+def tile_server():
+    """
+    A local tile server, so rendering needs no network.
+    """
+    from backend.benchmark import LocalTileServer
+
+    with LocalTileServer() as server:
+        yield server
+
+@pytest.fixture
+def upload_ride(tmp_path):
+    """
+    Returns a function that uploads a generated ride through /upload and returns its ticket ID.
+    """
+    from fastapi.testclient import TestClient
+    from backend.benchmark import write_fit
+    from backend.main import app
+
+    def upload(points: int = 600) -> str:
+        path = tmp_path / "ride.fit"
+        write_fit(path, points)
+        with open(path, "rb") as f:
+            response = TestClient(app).post("/upload", files={"file": ("ride.fit", f, "application/octet-stream")})
+        assert response.status_code == 200, response.text
+        return response.json()["ticket_id"]
+
+    return upload
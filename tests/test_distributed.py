@@ -0,0 +1,87 @@
+"""
+Fan-out/fan-in rendering of one ride across RQ workers: /generate with `segments`,
+run to completion by a synchronous RQ worker on fakeredis.
+"""
+
+from fastapi.testclient import TestClient
+from rq import SimpleWorker
+
+from backend.benchmark import played_frames
+from backend.main import app, queue, redis
+from backend.ride_route_animator import RideRouteAnimator
+from backend.storage import get_fit_path, get_video_path, get_thumbnail_path, get_segment_dir
+
+client = TestClient(app)
+
+def segmented_params(tile_server, title: str, segments: int = 3) -> dict:
+    """
+    Small, fast render parameters; the title keeps each test's render key apart.
+    """
+    return {"title": title, "tile": tile_server.url, "zoom": 12, "dpi": 40, "step_frame": 20,
+            "segments": segments}
+
+def request_generate(ticket_id, params: dict):
+    response = client.post("/generate", json=params, headers={"ticket-id": ticket_id})
+    assert response.status_code == 200, response.text
+
+def run_worker():
+    """
+    Runs every queued render job, and the jobs they release, in this process.
+    """
+    SimpleWorker([queue], connection=queue.connection).work(burst=True)
+
+def expected_frames(ticket_id, params: dict) -> int:
+    animator = RideRouteAnimator(get_fit_path(ticket_id), None, **params)
+    animator.prepare()
+    return len(animator.schedule_frames())
+
+def test_segments_join_into_one_video(upload_ride, tile_server):
+    ticket_id = upload_ride()
+    params = segmented_params(tile_server, "segments join")
+    request_generate(ticket_id, params)
+    assert client.get("/status", headers={"ticket-id": ticket_id}).json()["segments"] == {"done": 0, "total": 3}
+
+    run_worker()
+    info = client.get("/status", headers={"ticket-id": ticket_id}).json()
+    assert info["status"] == "generate_done"
+    assert info["segments"] == {"done": 3, "total": 3}
+    assert played_frames(get_video_path(ticket_id), 10) == expected_frames(ticket_id, params)
+    assert get_thumbnail_path(ticket_id).exists()
+    assert not get_segment_dir(ticket_id).exists()
+
+def test_failed_segment_fails_the_ticket(upload_ride, tile_server, monkeypatch):
+    run_segment = RideRouteAnimator.run_segment
+
+    def fail_second_segment(self, index, count):
+        if index == 1:
+            raise RuntimeError("segment failed part-way")
+        return run_segment(self, index, count)
+
+    monkeypatch.setattr(RideRouteAnimator, "run_segment", fail_second_segment)
+    ticket_id = upload_ride()
+    request_generate(ticket_id, segmented_params(tile_server, "failed segment"))
+
+    run_worker()
+    info = client.get("/status", headers={"ticket-id": ticket_id}).json()
+    assert info["status"] == "generate_error"
+    assert info["segments"] == {"done": 2, "total": 3}
+    assert not get_video_path(ticket_id).exists()
+    # The join never runs, and identical requests may render again
+    assert not redis.keys("render_cache:inflight:*")
+
+def test_join_requires_a_thumbnail_from_this_render(upload_ride, tile_server, monkeypatch):
+    ticket_id = upload_ride()
+    request_generate(ticket_id, segmented_params(tile_server, "stale thumbnail"))
+    # A thumbnail left over from an earlier render, while no segment captures a new one
+    get_thumbnail_path(ticket_id).write_bytes(b"stale")
+    monkeypatch.setattr(RideRouteAnimator, "thumbnail_index", lambda self: -1)
+
+    run_worker()
+    assert client.get("/status", headers={"ticket-id": ticket_id}).json()["status"] == "generate_error"
+
+def test_segment_count_is_bounded(upload_ride, tile_server):
+    ticket_id = upload_ride()
+    for segments in (0, 10_000):
+        response = client.post("/generate", json=segmented_params(tile_server, "bounds", segments),
+                               headers={"ticket-id": ticket_id})
+        assert response.status_code == 422
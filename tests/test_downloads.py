@@ -0,0 +1,99 @@
+"""
+Serving finished videos and thumbnails: strong ETags from the content hash, 304s, byte
+ranges with If-Range, HEAD, and /videos/{ticket_id} for browsers loading straight from the API.
+"""
+
+import hashlib
+
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.storage import get_video_path, get_thumbnail_path
+
+client = TestClient(app)
+
+def write_video(ticket_id, data: bytes = bytes(range(256)) * 64) -> bytes:
+    path = get_video_path(ticket_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return data
+
+def test_video_url_matches_header_route(upload_ride):
+    ticket_id = upload_ride()
+    data = write_video(ticket_id)
+    by_url = client.get(f"/videos/{ticket_id}")
+    by_header = client.get("/video", headers={"ticket-id": ticket_id})
+    assert by_url.status_code == 200 and by_url.content == data
+    assert by_url.headers["etag"] == by_header.headers["etag"]
+    assert by_url.headers["content-type"] == "video/mp4"
+    assert "content-disposition" not in by_url.headers
+
+def test_video_url_seeks_and_revalidates(upload_ride):
+    ticket_id = upload_ride()
+    data = write_video(ticket_id)
+    etag = client.head(f"/videos/{ticket_id}").headers["etag"]
+    partial = client.get(f"/videos/{ticket_id}", headers={"range": "bytes=100-199"})
+    assert partial.status_code == 206 and partial.content == data[100:200]
+    assert client.get(f"/videos/{ticket_id}", headers={"if-none-match": etag}).status_code == 304
+
+def test_video_url_download(upload_ride):
+    ticket_id = upload_ride()
+    write_video(ticket_id)
+    response = client.get(f"/videos/{ticket_id}?download=true")
+    assert response.headers["content-disposition"] == 'attachment; filename="ride.mp4"'
+
+def test_video_url_missing(upload_ride):
+    assert client.get(f"/videos/{upload_ride()}").status_code == 404
+
+def test_strong_etag_from_content_hash(upload_ride):
+    ticket_id = upload_ride()
+    data = write_video(ticket_id)
+    response = client.get("/video", headers={"ticket-id": ticket_id})
+    assert response.content == data
+    assert response.headers["etag"] == f'"{hashlib.sha256(data).hexdigest()}"'
+    assert response.headers["cache-control"] == "private, no-cache"
+
+def test_conditional_requests(upload_ride):
+    ticket_id = upload_ride()
+    data = write_video(ticket_id)
+    headers = {"ticket-id": ticket_id}
+    etag = client.head("/video", headers=headers).headers["etag"]
+    for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        response = client.get("/video", headers={**headers, "if-none-match": if_none_match})
+        assert response.status_code == 304 and response.content == b""
+        assert response.headers["etag"] == etag
+    assert client.get("/video", headers={**headers, "if-none-match": '"other"'}).status_code == 200
+
+    fresh = client.get("/video", headers={**headers, "range": "bytes=0-1023", "if-range": etag})
+    assert fresh.status_code == 206 and fresh.content == data[:1024]
+    stale = client.get("/video", headers={**headers, "range": "bytes=0-1023", "if-range": '"stale"'})
+    assert stale.status_code == 200 and stale.content == data
+
+def test_byte_ranges(upload_ride):
+    ticket_id = upload_ride()
+    data = write_video(ticket_id)
+    headers = {"ticket-id": ticket_id}
+    for spec, expected in (("0-0", data[:1]), ("1000-", data[1000:]), ("-10", data[-10:])):
+        response = client.get("/video", headers={**headers, "range": f"bytes={spec}"})
+        assert response.status_code == 206 and response.content == expected
+    assert client.get("/video", headers={**headers, "range": f"bytes={len(data)}-"}).status_code == 416
+
+def test_head_returns_headers_only(upload_ride):
+    ticket_id = upload_ride()
+    data = write_video(ticket_id)
+    response = client.head("/video", headers={"ticket-id": ticket_id})
+    assert response.status_code == 200 and response.content == b""
+    assert response.headers["content-length"] == str(len(data))
+    assert response.headers["accept-ranges"] == "bytes"
+
+def test_thumbnail_revalidates(upload_ride):
+    ticket_id = upload_ride()
+    path = get_thumbnail_path(ticket_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"jpeg")
+    headers = {"ticket-id": ticket_id}
+    etag = client.head("/thumbnail", headers=headers).headers["etag"]
+    assert client.get("/thumbnail", headers={**headers, "if-none-match": etag}).status_code == 304
+    # A regenerated thumbnail gets a new ETag
+    path.write_bytes(b"new jpeg")
+    assert client.get("/thumbnail", headers={**headers, "if-none-match": etag}).status_code == 200
@@ -0,0 +1,24 @@
+"""
+The fast FIT decoder against fitparse, field for field, on generated files covering the
+layouts it handles (big-endian, missing values, mixed layouts, interleaved events, ...).
+"""
+
+import numpy as np
+import pytest
+
+from backend.benchmark import fit_corpus
+from backend.fit_decoder import decode_fit_records
+from backend.ride_route_animator import RideRouteAnimator
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    return dict(fit_corpus(tmp_path_factory.mktemp("fit"), 2_000))
+
+@pytest.mark.parametrize("name", ["basic", "enhanced_altitude", "both_altitudes", "big_endian",
+                                  "missing_values", "mixed_layouts_events"])
+def test_matches_fitparse(corpus, name):
+    fast = decode_fit_records(corpus[name])
+    reference = RideRouteAnimator(corpus[name], None)._load_fit_fitparse()
+    assert len(fast) == len(reference)
+    for field in vars(reference):
+        assert np.array_equal(getattr(fast, field), getattr(reference, field)), field
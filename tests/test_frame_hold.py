@@ -0,0 +1,31 @@
+"""
+Holding unchanged frames: a stop is composited once even though heart rate keeps
+changing on the overlay while the marker stands still.
+"""
+
+from backend.benchmark import write_fit, stop_mask
+from backend.compositor import FrameCompositor
+from backend.ride_route_animator import RideRouteAnimator
+
+def test_stop_composited_once(tmp_path, tile_server, monkeypatch):
+    points, stop_seconds = 300, 60
+    fit_path = tmp_path / "stop.fit"
+    write_fit(fit_path, points, stops=1, stop_seconds=stop_seconds)
+    stopped = stop_mask(points, 1, stop_seconds)
+
+    rendered = []
+    render = FrameCompositor.render
+
+    def record(self, index, text):
+        rendered.append(index)
+        return render(self, index, text)
+
+    monkeypatch.setattr(FrameCompositor, "render", record)
+    animator = RideRouteAnimator(fit_path, tmp_path / "stop.mp4", tile=tile_server.url, zoom=12, dpi=40,
+                                 step_frame=1, schedule="index")
+    animator.run()
+
+    frames = animator.frames
+    assert len({frames.hr[i] for i in range(points) if stopped[i]}) > 1
+    # The frame entering the stop may still differ from the one before it; the rest are held
+    assert sum(stopped[i] for i in rendered) <= 2
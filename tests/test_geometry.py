@@ -0,0 +1,30 @@
+"""
+Vectorized distance modes against the per-pair geopy loop they replace.
+"""
+
+import pytest
+from geopy.distance import geodesic
+
+from backend.benchmark import synthetic_track
+from backend.geometry import segment_distances, DISTANCE_MODES
+
+# Largest relative error of a ride's total distance against geopy
+TOLERANCES = {"geodesic": 1e-6, "haversine": 5e-3}
+
+@pytest.fixture(scope="module")
+def track():
+    lat, lon = synthetic_track(5_000)
+    reference = [geodesic((lat[i - 1], lon[i - 1]), (lat[i], lon[i])).meters for i in range(1, len(lat))]
+    return lat, lon, reference
+
+@pytest.mark.parametrize("mode", DISTANCE_MODES)
+def test_total_within_tolerance(track, mode):
+    lat, lon, reference = track
+    total = segment_distances(lat, lon, mode).sum()
+    assert total == pytest.approx(sum(reference), rel=TOLERANCES[mode])
+
+def test_geodesic_segments_match(track):
+    lat, lon, reference = track
+    distances = segment_distances(lat, lon, "geodesic")
+    assert len(distances) == len(reference)
+    assert distances == pytest.approx(reference, rel=1e-6, abs=1e-6)
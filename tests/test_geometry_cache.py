@@ -0,0 +1,49 @@
+"""
+Per-ticket geometry cache: keyed on the FIT content hash without reading the file again.
+"""
+
+from fastapi.testclient import TestClient
+
+from backend import geometry_cache, result_cache
+from backend.main import app
+from backend.storage import get_geometry_path
+from backend.ticket import make_fit_sha256_key
+from backend.redis_client import get_redis_client
+
+client = TestClient(app)
+
+def count_hashing(monkeypatch) -> list:
+    """
+    Records every file the geometry and render caches hash.
+    """
+    hashed = []
+
+    def file_sha256(path):
+        hashed.append(path)
+        return original(path)
+
+    original = geometry_cache.file_sha256
+    monkeypatch.setattr(geometry_cache, "file_sha256", file_sha256)
+    monkeypatch.setattr(result_cache, "file_sha256", file_sha256)
+    return hashed
+
+def preview(ticket_id, tile_server):
+    response = client.post("/preview?frames=1", json={"title": "geometry", "tile": tile_server.url, "zoom": 12},
+                           headers={"ticket-id": ticket_id})
+    assert response.status_code == 200, response.text
+
+def test_upload_hash_keys_the_cache(upload_ride, tile_server, monkeypatch):
+    ticket_id = upload_ride()
+    hashed = count_hashing(monkeypatch)
+    preview(ticket_id, tile_server)
+    assert get_geometry_path(ticket_id).exists()
+    preview(ticket_id, tile_server)
+    assert hashed == []
+
+def test_file_hashed_once_without_upload_hash(upload_ride, tile_server, monkeypatch):
+    ticket_id = upload_ride()
+    get_redis_client().delete(make_fit_sha256_key(ticket_id))   # e.g. expired
+    hashed = count_hashing(monkeypatch)
+    preview(ticket_id, tile_server)
+    preview(ticket_id, tile_server)
+    assert len(hashed) == 1
@@ -0,0 +1,32 @@
+"""
+Server-side bounds on /generate and /preview parameters.
+"""
+
+import pytest
+from pydantic import ValidationError
+
+from backend.main import AnimationParams
+from backend.config import MAX_RENDER_WORKERS, MAX_TILE_BUDGET, MAX_RENDER_FRAMES
+
+@pytest.mark.parametrize("field, value", [
+    ("workers", 0),
+    ("workers", MAX_RENDER_WORKERS + 1),
+    ("max_tiles", 0),
+    ("max_tiles", MAX_TILE_BUDGET + 1),
+    ("max_frames", None),
+    ("max_frames", 0),
+    ("max_frames", MAX_RENDER_FRAMES + 1),
+])
+def test_out_of_bounds_rejected(field, value):
+    with pytest.raises(ValidationError):
+        AnimationParams(title="ride", **{field: value})
+
+def test_defaults_within_bounds():
+    params = AnimationParams(title="ride")
+    assert params.workers == 1
+    assert params.max_tiles == 150
+    assert params.max_frames == 3600
+
+def test_step_frame_counts_records_by_default():
+    # Clients written before time schedules still get one frame every step_frame records
+    assert AnimationParams(title="ride", step_frame=60).schedule == "index"
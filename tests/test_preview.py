@@ -0,0 +1,32 @@
+"""
+/preview renders synchronously in the API process, a bounded number at a time.
+"""
+
+from fastapi.testclient import TestClient
+
+from backend import main
+from backend.config import MAX_CONCURRENT_PREVIEWS
+
+client = TestClient(main.app)
+
+def preview(ticket_id, tile_server):
+    return client.post("/preview?frames=1", json={"title": "preview", "tile": tile_server.url, "zoom": 12},
+                       headers={"ticket-id": ticket_id})
+
+def test_preview_returns_png(upload_ride, tile_server):
+    response = preview(upload_ride(), tile_server)
+    assert response.status_code == 200
+    assert response.content.startswith(b"\x89PNG")
+
+def test_previews_beyond_the_limit_rejected(upload_ride, tile_server):
+    ticket_id = upload_ride()
+    for _ in range(MAX_CONCURRENT_PREVIEWS):
+        main.preview_slots.acquire()    # Previews in progress
+    try:
+        response = preview(ticket_id, tile_server)
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "1"
+    finally:
+        for _ in range(MAX_CONCURRENT_PREVIEWS):
+            main.preview_slots.release()
+    assert preview(ticket_id, tile_server).status_code == 200
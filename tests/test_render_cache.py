@@ -0,0 +1,68 @@
+"""
+Render cache and deduplication of identical renders.
+"""
+
+import pytest
+from fastapi.testclient import TestClient
+from rq import SimpleWorker
+
+from backend import result_cache
+from backend.main import app, queue, AnimationParams
+from backend.ride_route_animator import RideRouteAnimator
+from backend.storage import get_video_path, get_rendition_path, get_result_thumbnail_path
+from backend.ticket import get_fit_sha256
+
+client = TestClient(app)
+
+def status(ticket_id) -> str:
+    return client.get("/status", headers={"ticket-id": ticket_id}).json()["status"]
+
+def generate(ticket_id, params: dict) -> dict:
+    response = client.post("/generate", json=params, headers={"ticket-id": ticket_id})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+@pytest.mark.parametrize("segments", [1, 3])
+def test_identical_request_while_claiming_attaches(upload_ride, tile_server, monkeypatch, segments):
+    first, second = upload_ride(), upload_ride()
+    params = {"title": f"claim race {segments}", "tile": tile_server.url, "zoom": 12, "dpi": 40,
+              "step_frame": 20, "segments": segments}
+    claim_inflight = result_cache.claim_inflight
+    responses = []
+
+    def claim_then_race(key, job_id):
+        holder = claim_inflight(key, job_id)
+        monkeypatch.setattr(result_cache, "claim_inflight", claim_inflight)
+        # The identical request arrives right after the key is claimed
+        responses.append(generate(second, params))
+        return holder
+
+    renders = []
+    prepare = RideRouteAnimator.prepare
+    monkeypatch.setattr(RideRouteAnimator, "prepare", lambda self: (renders.append(self), prepare(self))[1])
+    monkeypatch.setattr(result_cache, "claim_inflight", claim_then_race)
+    generate(first, params)
+    assert "attached_to" in responses[0]
+
+    SimpleWorker([queue], connection=queue.connection).work(burst=True)
+    assert status(first) == status(second) == "generate_done"
+    assert len(renders) == segments   # One render, not two
+
+def test_incomplete_cached_result_not_linked(upload_ride, tile_server):
+    ticket_id = upload_ride()
+    params = {"title": "incomplete result", "tile": tile_server.url, "zoom": 12, "dpi": 40, "step_frame": 20,
+              "renditions": [{"name": "small", "height": 120}]}
+    generate(ticket_id, params)
+    SimpleWorker([queue], connection=queue.connection).work(burst=True)
+    assert status(ticket_id) == "generate_done"
+
+    # The cached thumbnail is lost; the ticket's current files must stay as they are
+    key = result_cache.render_key(get_fit_sha256(ticket_id), AnimationParams(**params).model_dump())
+    get_result_thumbnail_path(key).unlink()
+    video, rendition = get_video_path(ticket_id), get_rendition_path(ticket_id, "small")
+    video.unlink()
+    video.write_bytes(b"current")
+    rendition_inode = rendition.stat().st_ino
+    assert not result_cache.link_cached_result(key, ticket_id, "mp4", params["renditions"])
+    assert video.read_bytes() == b"current"
+    assert rendition.stat().st_ino == rendition_inode
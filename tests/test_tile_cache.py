@@ -0,0 +1,71 @@
+"""
+The shared on-disk tile cache against a local tile server: cold and warm fetches,
+processes sharing one cache, LRU eviction and rendering with the server gone.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+from backend.benchmark import LocalTileServer, synthetic_track, _cached_mosaic
+from backend.geometry import to_web_mercator
+from backend.tile_cache import TileCache, basemap_image, resolve_tile_provider
+
+ZOOM = 13
+MAX_BYTES = 64 * 2**20
+
+@pytest.fixture(scope="module")
+def bounds():
+    merc_x, merc_y = to_web_mercator(*synthetic_track(3_600))
+    return merc_x.min(), merc_y.min(), merc_x.max(), merc_y.max()
+
+@pytest.fixture
+def server():
+    with LocalTileServer() as server:
+        yield server
+
+def test_warm_fetch_served_from_cache(tmp_path, server, bounds):
+    cache = TileCache(tmp_path / "tiles.sqlite3", MAX_BYTES)
+    provider = resolve_tile_provider(server.url)
+    cold_image, _, cold = basemap_image(bounds, ZOOM, provider, cache)
+    assert cold["misses"] == cold["tiles"] == server.requests
+    warm_image, _, warm = basemap_image(bounds, ZOOM, provider, cache)
+    assert warm["hits"] == warm["tiles"]
+    assert server.requests == cold["tiles"]
+    assert np.array_equal(cold_image, warm_image)
+
+def test_processes_share_one_cache(tmp_path, server, bounds):
+    cache_path = tmp_path / "tiles.sqlite3"
+    cache = TileCache(cache_path, MAX_BYTES)
+    # Overlapping views, so processes race to store the same tiles
+    views = [(bounds[0] + i * (bounds[2] - bounds[0]) / 8, bounds[1], bounds[2], bounds[3]) for i in range(3)]
+    with ProcessPoolExecutor(max_workers=len(views)) as pool:
+        results = list(pool.map(_cached_mosaic, [cache_path] * len(views), [MAX_BYTES] * len(views),
+                                views, [ZOOM] * len(views), [server.url] * len(views)))
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == sum(r["tiles"] for r in results)
+    assert stats["bytes"] <= MAX_BYTES
+
+def test_lru_eviction_keeps_recent_tiles(tmp_path, server, bounds):
+    provider = resolve_tile_provider(server.url)
+    full = TileCache(tmp_path / "full.sqlite3", MAX_BYTES)
+    basemap_image(bounds, ZOOM + 1, provider, full)
+    # A cap below the working set forces the least recently used tiles out
+    small = TileCache(tmp_path / "small.sqlite3", full.stats()["bytes"] // 2)
+    basemap_image(bounds, ZOOM + 1, provider, small)
+    basemap_image(bounds, ZOOM, provider, small)
+    stats = small.stats()
+    assert stats["evictions"] > 0
+    assert stats["bytes"] <= small.max_bytes
+    _, _, recent = basemap_image(bounds, ZOOM, provider, small)
+    assert recent["hits"] == recent["tiles"]
+
+def test_offline_from_cache(tmp_path, bounds):
+    cache = TileCache(tmp_path / "tiles.sqlite3", MAX_BYTES)
+    with LocalTileServer() as server:
+        provider = resolve_tile_provider(server.url)
+        basemap_image(bounds, ZOOM, provider, cache)
+    # The server is gone; everything cached must still render
+    _, _, offline = basemap_image(bounds, ZOOM, provider, cache)
+    assert offline["hits"] == offline["tiles"]
@@ -0,0 +1,123 @@
+"""
+Streaming FIT uploads: validation in receive_fit_upload, the /upload endpoint with and
+without Content-Length, and memory that stays flat for uploads far above one chunk.
+"""
+
+import hashlib
+import io
+import struct
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from backend.benchmark import write_fit, ChainedFitStream
+from backend.config import MAX_UPLOAD_MB, FIT_FILES_DIR
+from backend.main import app
+from backend.storage import receive_fit_upload, UploadTooLarge, UPLOAD_CHUNK_SIZE
+from backend.util import fit_crc
+
+client = TestClient(app)
+
+@pytest.fixture(scope="module")
+def content(tmp_path_factory) -> bytes:
+    path = tmp_path_factory.mktemp("fit") / "ride.fit"
+    write_fit(path, 5_000)
+    return path.read_bytes()
+
+@pytest.fixture(scope="module")
+def short_header(content) -> bytes:
+    """
+    The same file with a 12-byte header, which has no header CRC.
+    """
+    data = bytes([12]) + content[1:12] + content[14:-2]
+    return data + struct.pack("<H", fit_crc(data))
+
+def outcome(directory, content: bytes, max_bytes: int, chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+    """
+    Returns the digest of an accepted upload, "too large" or the validation error.
+    """
+    try:
+        path, digest = receive_fit_upload(io.BytesIO(content), max_bytes, chunk_size, directory=directory)
+    except UploadTooLarge:
+        return "too large"
+    except ValueError as e:
+        return str(e)
+    assert path.read_bytes() == content
+    path.unlink()
+    return digest
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def test_valid_files_accepted(tmp_path, content, short_header):
+    chained = content + short_header
+    assert outcome(tmp_path, content, len(content)) == sha256(content)
+    assert outcome(tmp_path, short_header, len(content)) == sha256(short_header)
+    assert outcome(tmp_path, chained, len(chained)) == sha256(chained)
+    assert outcome(tmp_path, chained, len(chained), chunk_size=4093) == sha256(chained)
+
+def test_invalid_files_rejected(tmp_path, content, short_header):
+    corrupt = bytearray(content)
+    corrupt[len(content) // 2] ^= 0xFF
+    chained = content + short_header
+    assert outcome(tmp_path, bytes(corrupt), len(content)) == "FIT file CRC mismatch"
+    assert outcome(tmp_path, content[:-100], len(content)).startswith("FIT size mismatch")
+    assert outcome(tmp_path, b"\0" * len(content), len(content)) == "Invalid FIT header"
+    assert outcome(tmp_path, content, len(content) - 1) == "too large"
+    assert outcome(tmp_path, chained[:-1], len(chained)).startswith("FIT size mismatch")
+    assert outcome(tmp_path, chained + b"\0", len(chained) + 1) == "Invalid FIT header"
+    assert not list(tmp_path.glob(".upload-*"))
+
+def test_memory_flat_for_large_uploads(tmp_path, content):
+    # Each upload is 32 chunks; together they need far more than the memory allowed
+    concurrency, copies = 4, 32 * UPLOAD_CHUNK_SIZE // len(content) + 1
+    streams = [ChainedFitStream(content, copies) for _ in range(concurrency)]
+    tracemalloc.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda s: receive_fit_upload(s, s.size, directory=tmp_path), streams))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    expected = sha256(content * copies)
+    assert all(digest == expected for _, digest in results)
+    assert peak < concurrency * 4 * UPLOAD_CHUNK_SIZE
+
+def multipart(content: bytes, chunk_size: int = 64 * 1024):
+    """
+    Yields content in chunks as the "file" part of a multipart body.
+    """
+    yield (b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="ride.fit"\r\n'
+           b"Content-Type: application/octet-stream\r\n\r\n")
+    for start in range(0, len(content), chunk_size):
+        yield content[start:start + chunk_size]
+    yield b"\r\n--boundary--\r\n"
+
+def post_chunked(content: bytes) -> int:
+    """
+    Posts content to /upload with chunked transfer encoding (no Content-Length).
+    Returns the status code.
+    """
+    return client.post("/upload", content=multipart(content),
+                       headers={"Content-Type": "multipart/form-data; boundary=boundary"}).status_code
+
+def test_upload_endpoint_accepts_fit_files(content, short_header):
+    for data in (content, short_header, content + short_header):
+        response = client.post("/upload", files={"file": ("ride.fit", data, "application/octet-stream")})
+        assert response.status_code == 200, response.text
+        assert post_chunked(data) == 200
+
+def test_upload_endpoint_rejects(content):
+    # TestClient sends the whole body before the API answers; how early a real server
+    # stops reading is measured by the upload-endpoint benchmark
+    oversized = ChainedFitStream(content, MAX_UPLOAD_MB * 2**20 // len(content) + 2).read()
+    response = client.post("/upload", files={"file": ("ride.fit", oversized, "application/octet-stream")})
+    assert response.status_code == 413
+    assert post_chunked(oversized) == 413
+    assert post_chunked(np.random.default_rng(0).bytes(len(content))) == 400
+    assert post_chunked(content[:-100]) == 400
+    assert not list(Path(FIT_FILES_DIR).glob(".upload-*"))